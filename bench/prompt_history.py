@@ -0,0 +1,89 @@
+# bench/prompt_history.py - Reply-request size with history embedded vs sent once as chat turns
+#
+# Usage: python -m bench.prompt_history --db [contacts]        (default 200 most recent contacts)
+#        python -m bench.prompt_history corpus.jsonl            (one {"messages": [{"role", "text"}, ...]} per line)
+# Replays every lead turn of each recorded conversation through build_system_prompt +
+# build_chat_messages in both PROMPT_HISTORY_MODEs and compares estimated input tokens.
+# Profile / directive text is a fixed placeholder so the difference is the history alone.
+import json
+import sys
+
+import prompt
+from prompt import build_system_prompt, build_chat_messages, estimate_message_tokens
+
+HISTORY_WINDOW = 10  # memory.CONTEXT_RECENT_LIMIT — what the worker passes as recent_exchanges
+
+
+def load_db_corpus(limit: int) -> list:
+    from db import db_connection
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT contact_id FROM contact_messages
+            WHERE contact_id NOT LIKE 'demo_%%'
+            GROUP BY contact_id HAVING COUNT(*) >= 4
+            ORDER BY MAX(created_at) DESC LIMIT %s
+        """, (limit,))
+        contact_ids = [r["contact_id"] for r in cur.fetchall()]
+        conversations = []
+        for contact_id in contact_ids:
+            cur.execute("""
+                SELECT message_type, message_text FROM contact_messages
+                WHERE contact_id = %s ORDER BY created_at ASC, id ASC
+            """, (contact_id,))
+            conversations.append([{"role": r["message_type"], "text": r["message_text"]} for r in cur.fetchall()])
+    return conversations
+
+
+def load_file_corpus(path: str) -> list:
+    with open(path) as f:
+        return [json.loads(line)["messages"] for line in f if line.strip()]
+
+
+def request_tokens(mode: str, history: list, message: str) -> int:
+    prompt.PROMPT_HISTORY_MODE = mode
+    system_prompt = build_system_prompt(
+        bot_first_name="Grok",
+        timezone="America/Chicago",
+        profile_str="FULL HUMAN IDENTITY:\nBenchmark placeholder profile.",
+        tactical_narrative="STRATEGY: benchmark\nTACTICAL ORDER: benchmark",
+        known_facts=[],
+        story_narrative="",
+        stage="discovery",
+        recent_exchanges=history,
+        message=message,
+    )
+    return estimate_message_tokens(build_chat_messages(system_prompt, history, message))
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or args[0] == "--db":
+        conversations = load_db_corpus(int(args[1]) if len(args) > 1 else 200)
+    else:
+        conversations = load_file_corpus(args[0])
+
+    prompt.PROMPT_TOKEN_BUDGET = 0  # Compare untrimmed sizes
+    totals = {"embedded": 0, "chat": 0}
+    turns = 0
+    for messages in conversations:
+        for i, msg in enumerate(messages):
+            if msg["role"] != "lead":
+                continue
+            history = messages[:i + 1][-HISTORY_WINDOW:]
+            for mode in totals:
+                totals[mode] += request_tokens(mode, history, msg["text"])
+            turns += 1
+
+    if not turns:
+        print("No lead turns in corpus")
+        return
+    saved = totals["embedded"] - totals["chat"]
+    print(f"{len(conversations)} conversations, {turns} reply requests")
+    for mode, total in totals.items():
+        print(f"  {mode:<9} ~{total:>10,} input tokens  (~{total / turns:,.0f} per request)")
+    print(f"  saved     ~{saved:>10,} tokens ({saved / totals['embedded']:.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# bench/tier_queues.py - Pro queue latency while the shared production queue is saturated
+#
+# Usage: python -m bench.tier_queues [redis_url]     (default redis://localhost:6379/15)
+# Use a scratch Redis DB — the benchmark flushes it. Workers run as threads in this
+# process (same ThreadedWarmWorker the real pool uses); jobs are sleeps standing in for
+# I/O-bound webhook tasks.
+import sys
+import time
+import threading
+
+import redis
+from rq import Queue
+
+from fair_queue import location_queue
+from worker import ThreadedWarmWorker
+
+SHARED_WORKERS = 4
+PRO_WORKERS = 2
+FLOOD_LOCATIONS = 20
+FLOOD_JOBS_PER_LOCATION = 10
+FLOOD_JOB_SECONDS = 0.2
+PRO_JOB_SECONDS = 0.1
+PRO_ARRIVAL_INTERVAL = 0.25
+PRO_ARRIVALS = 32
+SIMULATED_JOB = "bench.tier_queues.simulated_job"  # By path: rq refuses __main__ functions
+
+
+def _pct(values: list, pct: float) -> float:
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def simulated_job(seconds: float):
+    time.sleep(seconds)
+
+
+def _start_workers(redis_conn, queue_names_per_worker):
+    workers, threads = [], []
+    for i, names in enumerate(queue_names_per_worker):
+        queues = [Queue(n, connection=redis_conn) for n in names]
+        w = ThreadedWarmWorker(queues, connection=redis_conn, name=f"bench-{i}-{time.time_ns()}", worker_ttl=20)
+        t = threading.Thread(target=w.work, daemon=True)
+        t.start()
+        workers.append(w)
+        threads.append(t)
+    return workers, threads
+
+
+def run_benchmark(redis_conn, tiered: bool) -> dict:
+    """Flood 20 locations, trickle in Pro jobs, return Pro queue-wait percentiles (seconds)."""
+    redis_conn.flushdb()
+    production = Queue("production", connection=redis_conn)
+    pro = Queue("pro", connection=redis_conn)
+
+    if tiered:
+        layout = [["production"]] * SHARED_WORKERS + [["pro"]] * PRO_WORKERS
+        pro_base = pro
+    else:
+        # Before: same total capacity, everyone on the shared queue
+        layout = [["production"]] * (SHARED_WORKERS + PRO_WORKERS)
+        pro_base = production
+
+    for n in range(FLOOD_JOBS_PER_LOCATION):
+        for loc in range(FLOOD_LOCATIONS):
+            location_queue(production, f"flood{loc}", "reply").enqueue(SIMULATED_JOB, FLOOD_JOB_SECONDS)
+
+    workers, threads = _start_workers(redis_conn, layout)
+    pro_jobs = []
+    for _ in range(PRO_ARRIVALS):
+        pro_jobs.append(location_queue(pro_base, "pro_location", "reply").enqueue(SIMULATED_JOB, PRO_JOB_SECONDS))
+        time.sleep(PRO_ARRIVAL_INTERVAL)
+
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        for job in pro_jobs:
+            job.refresh()
+        if all(job.is_finished for job in pro_jobs):
+            break
+        time.sleep(0.2)
+
+    for w in workers:
+        w._stop_requested = True
+    for t in threads:
+        t.join(timeout=30)
+
+    waits = sorted(
+        (job.started_at - job.enqueued_at).total_seconds()
+        for job in pro_jobs if job.started_at and job.enqueued_at
+    )
+    if not waits:
+        return {"completed": 0}
+    return {
+        "completed": len(waits),
+        "p50": _pct(waits, 50),
+        "p95": _pct(waits, 95),
+        "max": waits[-1],
+    }
+
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else "redis://localhost:6379/15"
+    redis_conn = redis.from_url(url)
+    for label, tiered in (("shared queue (before)", False), ("pro queue (after)", True)):
+        result = run_benchmark(redis_conn, tiered)
+        stats = " ".join(f"{k}={v:.2f}s" if isinstance(v, float) else f"{k}={v}" for k, v in result.items())
+        print(f"{label:<24} Pro queue wait: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,15 @@ import logging
 import uuid
 import gspread
 import json
+import threading
+import time
+from contextlib import contextmanager
 from oauth2client.service_account import ServiceAccountCredentials
 from typing import Optional, Dict, Any
 from datetime import datetime
 import psycopg2
 from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -32,18 +36,212 @@ if creds_dict:
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-def get_db_connection() -> Optional[psycopg2.extensions.connection]:
-    """Get a new PostgreSQL connection with RealDictCursor."""
+# --- Connection Pool ---
+# One pool per process. Connections are checked out for a single unit of work and
+# handed back on close(), so TLS/auth handshakes happen once per socket, not per query.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT", "10"))
+DB_POOL_HEALTHCHECK_IDLE = int(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))  # seconds idle before a SELECT 1 probe
+
+_pool: Optional[ThreadedConnectionPool] = None
+_pool_pid: Optional[int] = None
+_pool_slots: Optional[threading.BoundedSemaphore] = None
+_pool_lock = threading.Lock()
+_last_returned: Dict[int, float] = {}
+_inherited_pools: list = []  # Parent pools after fork — never touched, never closed (would kill the parent's sockets)
+
+
+def _get_pool() -> ThreadedConnectionPool:
+    """Return this process's pool, rebuilding it after a fork."""
+    global _pool, _pool_pid, _pool_slots
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+                _last_returned.clear()
+            _pool = ThreadedConnectionPool(
+                DB_POOL_MIN_SIZE,
+                DB_POOL_MAX_SIZE,
+                DATABASE_URL,
+                connect_timeout=10,
+                keepalives=1,
+                keepalives_idle=30,
+            )
+            _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+            _pool_pid = pid
+            logger.info(f"DB pool ready (pid={pid}, min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+    return _pool
+
+
+def _is_healthy(raw) -> bool:
+    """Cheap liveness check; only probes the server if the socket sat idle for a while."""
+    if raw.closed:
+        return False
+    if raw.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    idle_since = _last_returned.get(id(raw))
+    if idle_since is None or time.monotonic() - idle_since < DB_POOL_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with raw.cursor() as cur:
+            cur.execute("SELECT 1")
+        raw.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _session_modified(raw) -> bool:
+    """True if a borrower changed session state that would otherwise carry over to the next one."""
+    return bool(
+        raw.autocommit
+        or raw.isolation_level is not None
+        or raw.readonly is not None
+        or raw.deferrable is not None
+        or raw.cursor_factory is not None
+    )
+
+
+def _release(raw, pool: ThreadedConnectionPool, slots: threading.BoundedSemaphore) -> None:
+    """Hand a raw connection back to the pool, discarding it if it is broken."""
+    try:
+        discard = bool(raw.closed)
+        if not discard and _session_modified(raw):
+            try:
+                raw.reset()  # Rollback + RESET ALL + default isolation / readonly / deferrable
+                raw.autocommit = False
+                raw.cursor_factory = None
+            except psycopg2.Error:
+                discard = True
+        if not discard:
+            status = raw.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    raw.rollback()  # Never leak an open transaction to the next borrower
+                except psycopg2.Error:
+                    discard = True
+        if discard:
+            _last_returned.pop(id(raw), None)
+        else:
+            _last_returned[id(raw)] = time.monotonic()
+        pool.putconn(raw, close=discard)
+    except Exception as e:
+        logger.error(f"DB pool release failed: {e}")
+    finally:
+        slots.release()
+
+
+class PooledConnection:
+    """
+    Thin proxy around a pooled psycopg2 connection.
+    Behaves like the real connection, except close() returns it to the pool.
+    """
+
+    def __init__(self, raw, pool, slots, cursor_factory=RealDictCursor):
+        object.__setattr__(self, "_raw", raw)
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_slots", slots)
+        object.__setattr__(self, "_cursor_factory", cursor_factory)
+        object.__setattr__(self, "_returned", False)
+
+    def cursor(self, *args, **kwargs):
+        if self._cursor_factory is not None and not args:
+            kwargs.setdefault("cursor_factory", self._cursor_factory)
+        return self._raw.cursor(*args, **kwargs)
+
+    def close(self) -> None:
+        if self._returned:
+            return
+        object.__setattr__(self, "_returned", True)
+        _release(self._raw, self._pool, self._slots)
+
+    @property
+    def closed(self) -> int:
+        return 1 if self._returned else self._raw.closed
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Same semantics as psycopg2: end the transaction, keep the connection
+        if exc_type is None:
+            self._raw.commit()
+        else:
+            self._raw.rollback()
+        return False
+
+    def __del__(self):
+        # Safety net for call sites that return early without close()
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def checkout_db_connection(cursor_factory=RealDictCursor) -> PooledConnection:
+    """
+    Borrow a healthy connection from the process pool.
+    Blocks up to DB_POOL_CHECKOUT_TIMEOUT when every slot is in use.
+    Raises psycopg2.Error / PoolError on failure.
+    """
+    if not DATABASE_URL:
+        raise psycopg2.OperationalError("DATABASE_URL not set")
+    pool = _get_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=DB_POOL_CHECKOUT_TIMEOUT):
+        raise PoolError(f"DB pool exhausted ({DB_POOL_MAX_SIZE} in use for {DB_POOL_CHECKOUT_TIMEOUT}s)")
+    try:
+        # A stale socket gets one replacement attempt before we give up
+        for _ in range(2):
+            raw = pool.getconn()
+            if _is_healthy(raw):
+                return PooledConnection(raw, pool, slots, cursor_factory)
+            logger.warning("Discarding unhealthy pooled DB connection")
+            _last_returned.pop(id(raw), None)
+            pool.putconn(raw, close=True)
+        raise psycopg2.OperationalError("No healthy DB connection available")
+    except Exception:
+        slots.release()
+        raise
+
+
+@contextmanager
+def db_connection(cursor_factory=RealDictCursor):
+    """
+    Context-managed checkout: commits on success, rolls back on error,
+    and always returns the connection to the pool.
+    """
+    conn = checkout_db_connection(cursor_factory)
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def get_db_connection(cursor_factory=RealDictCursor) -> Optional[PooledConnection]:
+    """Get a pooled PostgreSQL connection (RealDictCursor by default). close() returns it to the pool."""
     if not DATABASE_URL:
         logger.critical("DATABASE_URL not set")
         return None
     try:
-        return psycopg2.connect(
-            DATABASE_URL,
-            connect_timeout=10,
-            cursor_factory=RealDictCursor,
-        )
-    except psycopg2.Error as e:
+        return checkout_db_connection(cursor_factory)
+    except (psycopg2.Error, PoolError) as e:
         logger.error(f"Database connection failed: {e}", exc_info=True)
         return None
 
@@ -164,6 +362,25 @@ def init_db() -> bool:
         """)
         cur.execute("CREATE INDEX IF NOT EXISTS idx_contact_narratives_updated ON contact_narratives (updated_at);")
         
+        # 6. SMS Outbox (written with the assistant message, drained by sms_outbox.py)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS sms_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                contact_id TEXT NOT NULL,
+                location_id TEXT NOT NULL,
+                message_text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sending', 'sent', 'dead')),
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_status INTEGER,
+                next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                claimed_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sms_outbox_due ON sms_outbox (status, next_attempt_at);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_sms_outbox_contact ON sms_outbox (contact_id, id);")
+        
         conn.commit()
         logger.info("Database initialized: All tables ready (including contact_narratives).")
         return True
@@ -412,6 +629,48 @@ def get_subscriber_info_sql(location_id: str) -> Optional[Dict[str, Any]]:
             conn.close()
 
 
+# === TIER LOOKUP (queue routing) ===
+# /webhook needs a location's plan on every request; cache it per process instead of hitting SQL.
+TIER_CACHE_TTL = int(os.getenv("TIER_CACHE_TTL", "300"))
+TIER_FAILURE_TTL = 30  # After a failed lookup, serve the fallback this long so an outage doesn't block every webhook
+_tier_cache: Dict[str, tuple] = {}  # location_id -> (tier, expires_at)
+
+
+def get_location_tier(location_id: str) -> str:
+    """
+    Effective plan for a location: its own subscription_tier, or agency_pro when the
+    location (or its parent agency) is on Agency Pro. Cached per process for TIER_CACHE_TTL
+    (TIER_FAILURE_TTL when the lookup failed).
+    """
+    cached = _tier_cache.get(location_id)
+    if cached and time.monotonic() < cached[1]:
+        return cached[0]
+
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT s.subscription_tier AS own_tier, ab.subscription_tier AS agency_tier
+                FROM (SELECT %s::text AS location_id) l
+                LEFT JOIN subscribers s ON s.location_id = l.location_id
+                LEFT JOIN agency_billing ab
+                    ON ab.location_id = l.location_id OR ab.agency_email = s.parent_agency_email
+                ORDER BY (ab.subscription_tier = 'agency_pro') DESC NULLS LAST
+                LIMIT 1
+            """, (location_id,))
+            row = cur.fetchone()
+    except Exception as e:
+        logger.warning(f"Tier lookup failed for {location_id}: {e}")
+        tier = cached[0] if cached else "individual"  # Last known tier, else the default
+        _tier_cache[location_id] = (tier, time.monotonic() + TIER_FAILURE_TTL)
+        return tier
+
+    tiers = (row["own_tier"], row["agency_tier"]) if row else (None, None)
+    tier = "agency_pro" if "agency_pro" in tiers else (tiers[0] or tiers[1] or "individual")
+    _tier_cache[location_id] = (tier, time.monotonic() + TIER_CACHE_TTL)
+    return tier
+
+
 def get_subscriber_info_hybrid(location_id: str) -> Optional[Dict[str, Any]]:
     """
     Hybrid Fetcher:
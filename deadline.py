@@ -0,0 +1,58 @@
+# deadline.py - One time budget per job, shared by every outbound call in the task
+import logging
+import os
+import time
+from typing import Optional
+
+from rq import get_current_job
+
+logger = logging.getLogger(__name__)
+
+JOB_DEADLINE_MARGIN = 5.0  # Seconds kept back from job_timeout for saving + logging
+DEFAULT_JOB_BUDGET = 120.0  # Matches the job_timeout /webhook enqueues with
+# Optional stages (observer, underwriting refresh, history sync, calendar prefetch) only run
+# while at least this much is left — enough for the Grok reply and the SMS send.
+OPTIONAL_STAGE_MIN_BUDGET = float(os.getenv("OPTIONAL_STAGE_MIN_BUDGET", "45"))
+MIN_CALL_TIMEOUT = 1.0
+
+
+class Deadline:
+    """Absolute cut-off for a job. Calls ask it for a timeout instead of using fixed ones."""
+
+    def __init__(self, budget_seconds: float):
+        self.budget = budget_seconds
+        self.expires_at = time.monotonic() + budget_seconds
+
+    @classmethod
+    def for_current_job(cls) -> "Deadline":
+        """Budget = the running rq job's timeout minus a safety margin."""
+        try:
+            job = get_current_job()
+            job_timeout = float(job.timeout) if job and job.timeout else DEFAULT_JOB_BUDGET
+        except Exception:
+            job_timeout = DEFAULT_JOB_BUDGET
+        return cls(max(MIN_CALL_TIMEOUT, job_timeout - JOB_DEADLINE_MARGIN))
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: float) -> float:
+        """The call's usual timeout, shrunk to what's left of the budget."""
+        return max(MIN_CALL_TIMEOUT, min(cap, self.remaining()))
+
+    def allows(self, seconds: float) -> bool:
+        return self.remaining() >= seconds
+
+    def allows_optional(self, stage: str) -> bool:
+        if self.allows(OPTIONAL_STAGE_MIN_BUDGET):
+            return True
+        logger.warning(f"⏳ Skipping {stage}: {self.remaining():.1f}s left of {self.budget:.0f}s budget")
+        return False
+
+
+def call_timeout(deadline: Optional[Deadline], cap: float) -> float:
+    """Timeout for one outbound call; callers without a deadline keep their fixed cap."""
+    return deadline.timeout(cap) if deadline else cap
@@ -0,0 +1,140 @@
+# demo_openers.py - Pool of pre-generated demo openers so /demo/init and /demo/reset never wait on Grok
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from rq import Queue, get_current_job
+
+from llm_gateway import chat, llm_configured
+from metrics import record_metric, metric_summary
+from prompt import CORE_UNIFIED_MINDSET, DEMO_OPENER_ADDITIONAL_INSTRUCTIONS
+from utils import clean_ai_reply
+
+logger = logging.getLogger(__name__)
+
+STATIC_DEMO_OPENER = "Quick question are you still with that life insurance plan you mentioned before? There's some new living benefits people have been asking me about and I wanted to make sure yours doesnt just pay out when you're dead."
+
+# Endpoints LPOP a ready opener (O(1)); once the pool drops under DEMO_OPENER_POOL_LOW a
+# refill job on the 'demo' queue tops it back up to DEMO_OPENER_POOL_TARGET. An empty pool
+# serves STATIC_DEMO_OPENER and is counted as a miss.
+DEMO_OPENER_POOL_TARGET = int(os.getenv("DEMO_OPENER_POOL_TARGET", "20"))
+DEMO_OPENER_POOL_LOW = int(os.getenv("DEMO_OPENER_POOL_LOW", str(DEMO_OPENER_POOL_TARGET // 2)))
+REFILL_JOB_TIMEOUT = 600
+POOL_KEY = "demo:openers"
+REFILL_KEY = "demo:openers:refill"  # Set (to the request time) while a refill job is queued or running
+STATS_KEY = "demo:openers:stats"
+
+
+def generate_demo_opener() -> Optional[str]:
+    """One fresh, cleaned opener from Grok, or None if the call failed."""
+    if not llm_configured():
+        return None
+    try:
+        system_content = (
+            CORE_UNIFIED_MINDSET.format(bot_first_name="DEMOGROKBOT")
+            + "\n\n"
+            + DEMO_OPENER_ADDITIONAL_INSTRUCTIONS
+        )
+        opener = chat(
+            [
+                {"role": "system", "content": system_content},
+                {"role": "user", "content": "Generate unique opener."}
+            ],
+            "demo_opener",
+            temperature=0.8,
+            max_tokens=130
+        )
+        return clean_ai_reply(opener.strip().replace('"', '')) or None
+    except Exception as e:
+        logger.error(f"Demo opener failed: {e}")
+        return None
+
+
+def request_refill(queue: Queue) -> bool:
+    """Queue one refill job unless one is already pending. Returns True if a job was queued."""
+    redis_conn = queue.connection
+    if not redis_conn.set(REFILL_KEY, time.time(), nx=True, ex=REFILL_JOB_TIMEOUT):
+        return False
+    try:
+        queue.enqueue(refill_opener_pool, job_timeout=REFILL_JOB_TIMEOUT, result_ttl=0)
+    except Exception:
+        redis_conn.delete(REFILL_KEY)
+        raise
+    return True
+
+
+def take_demo_opener(queue: Queue) -> str:
+    """Pop a pre-generated opener (static fallback if the pool is empty) and top the pool up if low."""
+    redis_conn = queue.connection
+    try:
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.lpop(POOL_KEY)
+        pipe.llen(POOL_KEY)
+        raw, remaining = pipe.execute()
+    except Exception as e:
+        logger.warning(f"⚠ Opener pool unavailable (Redis): {e}")
+        raw, remaining = None, None
+
+    # The opener is already popped — bookkeeping failures must not cost it
+    try:
+        redis_conn.hincrby(STATS_KEY, "hits" if raw else "misses", 1)
+    except Exception as e:
+        logger.debug(f"Opener stats skipped: {e}")
+    if remaining is not None and remaining < DEMO_OPENER_POOL_LOW:
+        try:
+            if request_refill(queue):
+                logger.info(f"🎬 Opener pool at {remaining} — refill queued")
+        except Exception as e:
+            logger.warning(f"⚠ Opener refill not queued: {e}")
+
+    if not raw:
+        if remaining is not None:
+            logger.warning("🎬 Opener pool empty — serving static opener")
+        return STATIC_DEMO_OPENER
+    return json.loads(raw)["text"]
+
+
+def refill_opener_pool() -> int:
+    """rq job ('demo' queue): generate openers until the pool is back at target. Returns how many were added."""
+    redis_conn = get_current_job().connection
+    added = 0
+    try:
+        failures = 0
+        while redis_conn.llen(POOL_KEY) < DEMO_OPENER_POOL_TARGET and failures < 3:
+            text = generate_demo_opener()
+            if not text:
+                failures += 1
+                continue
+            redis_conn.rpush(POOL_KEY, json.dumps({"text": text, "created_at": time.time()}))
+            added += 1
+        requested_at = redis_conn.get(REFILL_KEY)
+        # Lag means request -> pool full; a run that gave up below target doesn't count
+        if requested_at and redis_conn.llen(POOL_KEY) >= DEMO_OPENER_POOL_TARGET:
+            record_metric(redis_conn, "demo_opener_refill_lag", time.time() - float(requested_at))
+    finally:
+        redis_conn.delete(REFILL_KEY)
+    logger.info(f"🎬 Opener pool refilled (+{added}, size {redis_conn.llen(POOL_KEY)}/{DEMO_OPENER_POOL_TARGET})")
+    return added
+
+
+def opener_pool_stats(redis_conn) -> dict:
+    """Pool size, hit rate (pool vs static fallback) and refill lag (request -> pool full)."""
+    try:
+        counts = {(k.decode() if isinstance(k, bytes) else k): int(v) for k, v in redis_conn.hgetall(STATS_KEY).items()}
+        size = redis_conn.llen(POOL_KEY)
+        refilling = bool(redis_conn.exists(REFILL_KEY))
+    except Exception as e:
+        logger.warning(f"Opener pool stats unavailable: {e}")
+        return {}
+    hits, misses = counts.get("hits", 0), counts.get("misses", 0)
+    return {
+        "size": size,
+        "target": DEMO_OPENER_POOL_TARGET,
+        "refilling": refilling,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+        "refill_lag": metric_summary(redis_conn, "demo_opener_refill_lag"),
+    }
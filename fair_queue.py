@@ -0,0 +1,324 @@
+# fair_queue.py - Per-location, per-priority sub-queues for production
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import redis
+from rq import Queue
+from rq.registry import StartedJobRegistry, clean_registries
+from rq.utils import str_to_date
+
+from metrics import record_metric, metric_summary
+
+logger = logging.getLogger(__name__)
+
+# /webhook puts each job on production:<location_id>:<class>. Production workers rotate
+# across locations (round robin, shared cursor in Redis) and skip any location already
+# holding FAIR_LOCATION_MAX_INFLIGHT running jobs. The plain 'production' queue stays
+# in the rotation for scheduled/legacy jobs. The same layout applies to each tier queue below.
+FAIR_SCHEDULING = os.getenv("FAIR_SCHEDULING", "true").lower() == "true"
+FAIR_LOCATION_MAX_INFLIGHT = int(os.getenv("FAIR_LOCATION_MAX_INFLIGHT", "2"))
+FAIR_REFRESH_SECONDS = 1  # How often an idle worker re-reads the set of location queues
+# An idle worker also blocks on up to FAIR_IDLE_WAKE_QUEUES empty sub-queues (highest class
+# first) so a new job wakes it at once instead of at the next refresh. Empty sub-queues are
+# unregistered at most every FAIR_PRUNE_SECONDS; LocationQueue registers a queue again on its next enqueue.
+# Sub-queues are listed in a per-base set (fair:queues:<base>) written at enqueue time, so
+# re-planning never scans rq's global queue set.
+FAIR_IDLE_WAKE_QUEUES = int(os.getenv("FAIR_IDLE_WAKE_QUEUES", "16"))
+FAIR_PRUNE_SECONDS = 300
+PRUNE_LOCK_KEY = "fair:prune"
+INFLIGHT_STALE_SECONDS = 300  # Longer than any job_timeout — entries past this are from dead workers
+
+PRODUCTION_QUEUE = "production"
+
+
+# === TIER QUEUES ===
+# Agency Pro locations get their own base queue ('pro') with the same per-location /
+# per-class layout, consumed only by the worker-pro pool so their capacity stays reserved.
+TIER_QUEUES = {"agency_pro": "pro"}
+FAIR_BASE_QUEUES = {PRODUCTION_QUEUE, *TIER_QUEUES.values()}
+
+
+def tier_queue_name(tier: Optional[str]) -> str:
+    return TIER_QUEUES.get(tier or "", PRODUCTION_QUEUE)
+
+
+# === PRIORITY CLASSES ===
+# Within a location, the class with the highest effective priority goes first:
+#   base rank + (seconds its oldest job has waited / PRIORITY_AGING_SECONDS)
+# so outreach that has waited long enough overtakes fresh replies instead of starving.
+# Each class queue is FIFO, so a later reply never jumps an older one.
+PRIORITY_CLASSES = {"closing": 3, "reply": 2, "outreach": 1, "demo": 0}
+PRIORITY_AGING_SECONDS = float(os.getenv("PRIORITY_AGING_SECONDS", "60"))
+CLOSING_STAGES = {"closing"}
+STAGE_TTL = 7 * 86400
+
+
+def _stage_key(contact_id: str) -> str:
+    return f"contact:stage:{contact_id}"
+
+
+def remember_contact_stage(redis_conn, contact_id: str, stage: str):
+    """Called by the task once the director has picked a stage; read back at ingress."""
+    if redis_conn is None or not contact_id or not stage:
+        return
+    try:
+        redis_conn.set(_stage_key(contact_id), stage, ex=STAGE_TTL)
+    except Exception as e:
+        logger.debug(f"Stage not cached for {contact_id}: {e}")
+
+
+def contact_stage(redis_conn, contact_id: Optional[str]) -> Optional[str]:
+    """Last director stage seen for this contact, if any (None = never answered by the bot)."""
+    try:
+        stage = redis_conn.get(_stage_key(contact_id)) if contact_id else None
+    except Exception:
+        return None
+    return stage.decode() if isinstance(stage, bytes) else stage
+
+
+def priority_class(stage: Optional[str], is_demo: bool, is_reply: bool) -> str:
+    if is_demo:
+        return "demo"
+    if not is_reply:
+        return "outreach"
+    return "closing" if stage in CLOSING_STAGES else "reply"
+
+
+def _sub_queues_key(base_name: str) -> str:
+    return f"fair:queues:{base_name}"
+
+
+class LocationQueue(Queue):
+    """A <base>:<location>:<class> queue that lists itself in its base's sub-queue set on every enqueue."""
+
+    def enqueue_job(self, job, pipeline=None, at_front=False, **kwargs):
+        job = super().enqueue_job(job, pipeline=pipeline, at_front=at_front, **kwargs)
+        # After the push, so a concurrent prune either sees the job or loses its WATCH
+        (pipeline if pipeline is not None else self.connection).sadd(_sub_queues_key(self.name.partition(":")[0]), self.name)
+        return job
+
+
+def location_queue(base: Queue, location_id: str, job_class: str = "reply") -> Queue:
+    """The sub-queue /webhook should use (the base queue if fairness is off)."""
+    if not FAIR_SCHEDULING or not location_id:
+        return base
+    return LocationQueue(f"{base.name}:{location_id}:{job_class}", connection=base.connection)
+
+
+def _parse(queue_name: str) -> Tuple[Optional[str], Optional[str]]:
+    """<base>:<loc>:<class> -> (loc, class); other queues -> (None, class-or-None)."""
+    base, _, rest = queue_name.partition(":")
+    if base in FAIR_BASE_QUEUES and rest:
+        loc, _, cls = rest.rpartition(":")
+        if loc and cls in PRIORITY_CLASSES:
+            return loc, cls
+    return None, ("demo" if queue_name == "demo" else None)
+
+
+def _inflight_key(location_id: str) -> str:
+    return f"fair:inflight:{location_id}"
+
+
+def _queue_key(name: str) -> str:
+    return f"{Queue.redis_queue_namespace_prefix}{name}"
+
+
+def _started_key(name: str) -> str:
+    return StartedJobRegistry.key_template.format(name)
+
+
+def location_queue_names(redis_conn, base_name: Optional[str] = None) -> List[str]:
+    """Every live <base>:<location>:<class> queue (optionally for one base)."""
+    bases = [base_name] if base_name else sorted(FAIR_BASE_QUEUES)
+    pipe = redis_conn.pipeline(transaction=False)
+    for name in bases:
+        pipe.smembers(_sub_queues_key(name))
+    names = {k.decode() if isinstance(k, bytes) else k for members in pipe.execute() for k in members}
+    return sorted(n for n in names if _parse(n)[0])
+
+
+def fair_queue_order(base: Queue) -> List[Queue]:
+    """
+    Queues to hand to dequeue_any, in the order this pass should try them:
+    locations under their cap, rotated by a shared round-robin cursor, and within
+    each location its non-empty classes by effective (aged) priority.
+    """
+    redis_conn = base.connection
+    names = location_queue_names(redis_conn, base.name)
+    if not names:
+        return [base]
+
+    cutoff = time.time() - INFLIGHT_STALE_SECONDS
+    locations = sorted({_parse(n)[0] for n in names})
+    pipe = redis_conn.pipeline(transaction=False)
+    for name in names:
+        pipe.lindex(_queue_key(name), 0)  # Oldest job id (class queues are FIFO)
+    for loc in locations:
+        pipe.zremrangebyscore(_inflight_key(loc), "-inf", cutoff)
+        pipe.zcard(_inflight_key(loc))
+    pipe.incr("fair:cursor")
+    results = pipe.execute()
+    heads = dict(zip(names, results[:len(names)]))
+    inflight = {loc: results[len(names) + 2 * i + 1] for i, loc in enumerate(locations)}
+    cursor = results[-1]
+
+    # Age of each non-empty class queue's oldest job
+    waiting = [n for n in names if heads[n] and inflight[_parse(n)[0]] < FAIR_LOCATION_MAX_INFLIGHT]
+    pipe = redis_conn.pipeline(transaction=False)
+    for name in waiting:
+        job_id = heads[name].decode() if isinstance(heads[name], bytes) else heads[name]
+        pipe.hget(f"{Queue.job_class.redis_job_namespace_prefix}{job_id}", "enqueued_at")
+    enqueued = pipe.execute() if waiting else []
+
+    now = time.time()
+    by_location: Dict[str, List[Tuple[float, str]]] = {}
+    for name, enqueued_at in zip(waiting, enqueued):
+        loc, cls = _parse(name)
+        age = max(0.0, now - str_to_date(enqueued_at).timestamp()) if enqueued_at else 0.0
+        effective = PRIORITY_CLASSES[cls] + age / PRIORITY_AGING_SECONDS
+        by_location.setdefault(loc, []).append((effective, name))
+
+    rotation = sorted(by_location) + [base.name]
+    offset = cursor % len(rotation)
+    ordered: List[Queue] = []
+    for loc in rotation[offset:] + rotation[:offset]:
+        if loc == base.name:
+            ordered.append(base)
+            continue
+        for _, name in sorted(by_location[loc], reverse=True):
+            ordered.append(Queue(name, connection=redis_conn))
+
+    # A few empty queues of locations under their cap go last so a blocking dequeue wakes on their next job
+    empty = [n for n in names if not heads[n]]
+    idle = [n for n in empty if inflight[_parse(n)[0]] < FAIR_LOCATION_MAX_INFLIGHT]
+    idle.sort(key=lambda n: PRIORITY_CLASSES[_parse(n)[1]], reverse=True)
+    ordered.extend(Queue(n, connection=redis_conn) for n in idle[:FAIR_IDLE_WAKE_QUEUES])
+    if redis_conn.set(PRUNE_LOCK_KEY, 1, nx=True, ex=FAIR_PRUNE_SECONDS):  # One worker per FAIR_PRUNE_SECONDS
+        adopt_registered_queues(redis_conn)
+        prune_empty_queues(redis_conn, empty)
+    return ordered
+
+
+def adopt_registered_queues(redis_conn) -> int:
+    """Add non-empty sub-queues rq knows about but the per-base sets don't (e.g. enqueued before they existed)."""
+    prefix = Queue.redis_queue_namespace_prefix
+    names = [k.decode() if isinstance(k, bytes) else k for k in redis_conn.smembers(Queue.redis_queues_keys)]
+    names = [n[len(prefix):] for n in names if n.startswith(prefix) and _parse(n[len(prefix):])[0]]
+    known = set(location_queue_names(redis_conn))
+    missing = [n for n in names if n not in known and redis_conn.llen(_queue_key(n))]
+    for name in missing:
+        redis_conn.sadd(_sub_queues_key(name.partition(":")[0]), name)
+    if missing:
+        logger.info(f"🧭 Adopted {len(missing)} sub-queues into the fair queue sets")
+    return len(missing)
+
+
+def prune_empty_queues(redis_conn, names: List[str]) -> int:
+    """
+    Drop empty sub-queues with no running jobs from rq's queue set and the per-base set. Returns how many.
+    WATCH makes each removal lose to a concurrent enqueue or dequeue instead of stranding a job.
+    """
+    pruned = 0
+    for name in names:
+        with redis_conn.pipeline() as pipe:
+            try:
+                pipe.watch(_queue_key(name), _started_key(name))
+                if pipe.llen(_queue_key(name)) or pipe.zcard(_started_key(name)):
+                    continue  # Still listed so clean_location_registries can reap its running jobs
+                pipe.multi()
+                pipe.srem(Queue.redis_queues_keys, _queue_key(name))
+                pipe.srem(_sub_queues_key(name.partition(":")[0]), name)
+                pruned += pipe.execute()[1]
+            except redis.WatchError:
+                continue
+    if pruned:
+        logger.info(f"🧹 Unregistered {pruned} empty sub-queues")
+    return pruned
+
+
+def clean_location_registries(queue: Queue, exception_handlers: Optional[list] = None):
+    """
+    rq's clean_registries for one sub-queue (workers only clean the queues they listen on).
+    Jobs abandoned by a dead worker also stop counting against their location's cap.
+    """
+    loc, _ = _parse(queue.name)
+    abandoned = StartedJobRegistry(queue.name, connection=queue.connection).get_expired_job_ids()
+    clean_registries(queue, exception_handlers)
+    if loc and abandoned:
+        queue.connection.zrem(_inflight_key(loc), *abandoned)
+        logger.warning(f"🧟 Reaped {len(abandoned)} abandoned job(s) from {queue.name}")
+
+
+def mark_started(redis_conn, job, queue_name: str):
+    """Count the job against its location's cap and record how long it sat in the queue."""
+    loc, cls = _parse(queue_name)
+    if job.enqueued_at:
+        waited = time.time() - job.enqueued_at.timestamp()
+        record_metric(redis_conn, f"queue_wait:{loc or queue_name}", waited)
+        if cls:
+            record_metric(redis_conn, f"queue_wait_class:{cls}", waited)
+        base_name = queue_name.partition(":")[0]
+        if base_name in FAIR_BASE_QUEUES:
+            record_metric(redis_conn, f"queue_wait_tier:{base_name}", waited)
+    if loc:
+        try:
+            redis_conn.zadd(_inflight_key(loc), {job.id: time.time()})
+        except Exception as e:
+            logger.warning(f"⚠ In-flight tracking failed for {loc}: {e}")
+
+
+def mark_finished(redis_conn, job, queue_name: str):
+    loc, _ = _parse(queue_name)
+    if loc:
+        try:
+            redis_conn.zrem(_inflight_key(loc), job.id)
+        except Exception as e:
+            logger.warning(f"⚠ In-flight release failed for {loc}: {e}")
+
+
+def queue_pressure(redis_conn, base_name: str) -> Dict[str, float]:
+    """Jobs waiting across a base queue and its sub-queues, and the age of the oldest one."""
+    names = location_queue_names(redis_conn, base_name) + [base_name]
+    pipe = redis_conn.pipeline(transaction=False)
+    for name in names:
+        pipe.llen(_queue_key(name))
+        pipe.lindex(_queue_key(name), 0)
+    results = pipe.execute()
+    depth = sum(results[0::2])
+    heads = [h.decode() if isinstance(h, bytes) else h for h in results[1::2] if h]
+
+    oldest_age = 0.0
+    if heads:
+        pipe = redis_conn.pipeline(transaction=False)
+        for job_id in heads:
+            pipe.hget(f"{Queue.job_class.redis_job_namespace_prefix}{job_id}", "enqueued_at")
+        now = time.time()
+        ages = [now - str_to_date(ts).timestamp() for ts in pipe.execute() if ts]
+        oldest_age = max(ages, default=0.0)
+    return {"depth": depth, "oldest_age": round(max(0.0, oldest_age), 2)}
+
+
+def fair_queue_stats(redis_conn) -> Dict[str, dict]:
+    """Backlog, running jobs and queue-wait percentiles per location, priority class and tier."""
+    locations: Dict[str, dict] = {}
+    for name in location_queue_names(redis_conn):
+        loc, cls = _parse(name)
+        entry = locations.setdefault(loc, {
+            "queue": name.partition(":")[0],
+            "queued": {},
+            "in_flight": redis_conn.zcard(_inflight_key(loc)),
+            "queue_wait": metric_summary(redis_conn, f"queue_wait:{loc}"),
+        })
+        entry["queued"][cls] = redis_conn.llen(_queue_key(name))
+    for base_name in sorted(FAIR_BASE_QUEUES):
+        locations[base_name] = {
+            "queue": base_name,
+            "queued": redis_conn.llen(_queue_key(base_name)),
+            "in_flight": None,
+            "queue_wait": metric_summary(redis_conn, f"queue_wait:{base_name}"),
+        }
+    classes = {cls: metric_summary(redis_conn, f"queue_wait_class:{cls}") for cls in PRIORITY_CLASSES}
+    tiers = {name: metric_summary(redis_conn, f"queue_wait_tier:{name}") for name in sorted(FAIR_BASE_QUEUES)}
+    return {"locations": locations, "classes": classes, "tiers": tiers}
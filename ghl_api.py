@@ -1,25 +1,43 @@
 # ghl_api.py - GHL OAuth & API Helpers (Flawless 2026)
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 import os
 from datetime import datetime, timedelta
 from db import get_subscriber_info_hybrid, update_subscriber_token
+from deadline import Deadline, call_timeout
 
 logger = logging.getLogger(__name__)
 
 GHL_TOKEN_URL = "https://services.leadconnectorhq.com/oauth/token"
 GHL_HEADERS = {"Version": "2021-04-15", "Content-Type": "application/json"}
 
-def get_valid_token(location_id: str) -> str | None:
+# One keep-alive session per process: warm workers reuse TLS connections to GHL across jobs
+_ghl_session = None
+_ghl_session_pid = None
+
+def ghl_session() -> requests.Session:
+    """Process-wide pooled HTTP session for all GHL calls (rebuilt after fork)."""
+    global _ghl_session, _ghl_session_pid
+    if _ghl_session is None or _ghl_session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(os.getenv("GHL_HTTP_POOL_SIZE", "20")))
+        session.mount("https://", adapter)
+        _ghl_session = session
+        _ghl_session_pid = os.getpid()
+    return _ghl_session
+
+def get_valid_token(location_id: str, subscriber: dict | None = None, deadline: Deadline | None = None) -> str | None:
     """
     Returns a valid Bearer access token or None on failure.
     Refreshes if expired (5-min buffer). Falls back to persistent token if no refresh_token.
+    Pass an already-loaded subscriber row to skip the lookup, and the job's deadline to cap the refresh call.
     """
     if location_id in {'DEMO', 'DEMO_LOC', 'TEST_LOCATION_456'}:
         print(f"ℹ️ Internal Mode: Skipping auth for {location_id}")
         return 'DEMO'
 
-    sub = get_subscriber_info_hybrid(location_id)
+    sub = subscriber or get_subscriber_info_hybrid(location_id)
     if not sub:
         logger.error(f"No subscriber config for {location_id}")
         return None
@@ -51,7 +69,7 @@ def get_valid_token(location_id: str) -> str | None:
     }
 
     try:
-        resp = requests.post(GHL_TOKEN_URL, data=payload, timeout=10)
+        resp = ghl_session().post(GHL_TOKEN_URL, data=payload, timeout=call_timeout(deadline, 10))
         resp.raise_for_status()
         data = resp.json()
 
@@ -75,14 +93,15 @@ def get_valid_token(location_id: str) -> str | None:
         logger.error(f"Token refresh failed: {e}", exc_info=True)
         return None
 
-def fetch_targeted_ghl_history(contact_id: str, location_id: str, access_token: str = None, limit: int = 20) -> list:
+def fetch_targeted_ghl_history(contact_id: str, location_id: str, access_token: str = None, limit: int = 20,
+                               deadline: Deadline | None = None) -> list:
     """
     Fetches messages for the specific contact's conversation.
     Returns list of {'role': str, 'text': str, 'timestamp': str} or empty on failure.
     Handles malformed API responses gracefully (e.g., strings instead of dicts).
     """
     if not access_token:
-        access_token = get_valid_token(location_id)
+        access_token = get_valid_token(location_id, deadline=deadline)
         if not access_token:
             logger.error(f"No valid token for history fetch {location_id}/{contact_id}")
             return []
@@ -94,7 +113,7 @@ def fetch_targeted_ghl_history(contact_id: str, location_id: str, access_token:
     try:
         # Step 1: Find conversation ID
         search_url = f"https://services.leadconnectorhq.com/conversations/search?locationId={location_id}&contactId={contact_id}"
-        search_res = requests.get(search_url, headers=headers, timeout=10)
+        search_res = ghl_session().get(search_url, headers=headers, timeout=call_timeout(deadline, 10))
         search_res.raise_for_status()
         convos = search_res.json().get("conversations", [])
 
@@ -106,7 +125,7 @@ def fetch_targeted_ghl_history(contact_id: str, location_id: str, access_token:
 
         # Step 2: Fetch messages
         msg_url = f"https://services.leadconnectorhq.com/conversations/{convo_id}/messages?limit={limit}"
-        msg_res = requests.get(msg_url, headers=headers, timeout=10)
+        msg_res = ghl_session().get(msg_url, headers=headers, timeout=call_timeout(deadline, 10))
         msg_res.raise_for_status()
 
         raw_messages = msg_res.json().get("messages", [])
@@ -6,6 +6,8 @@ import time as time_module
 from datetime import datetime, timedelta, timezone, time
 from zoneinfo import ZoneInfo
 import re
+from ghl_api import ghl_session
+from deadline import Deadline, call_timeout
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +15,7 @@ GHL_CALENDAR_URL = "https://services.leadconnectorhq.com/calendars/{cal_id}/free
 GHL_BOOK_URL = "https://services.leadconnectorhq.com/calendars/events/appointments"
 
 CACHE_TTL = 1800  # 30 minutes
-cache = {}  # Simple in-memory cache — fine for single-worker RQ
+cache = {}  # Simple in-memory cache — per process; survives across jobs under WORKER_MODE=warm
 
 def get_cached_data(key: str):
     if key in cache:
@@ -30,12 +32,14 @@ def consolidated_calendar_op(
     subscriber_data: dict,
     contact_id: str = None,
     first_name: str = None,
-    selected_time: str = None
+    selected_time: str = None,
+    deadline: Deadline = None
 ) -> any:
     """
     Unified calendar operation: fetch slots or book appointment.
     Returns formatted string (slots) or bool (booking success).
     Demo-safe: returns placeholder on demo mode.
+    GHL call timeouts shrink to the job's remaining budget when a deadline is given.
     """
     access_token = subscriber_data.get("access_token") or subscriber_data.get("crm_api_key")
     location_id = subscriber_data.get("location_id")
@@ -83,7 +87,7 @@ def consolidated_calendar_op(
                 params["userId"] = crm_user_id
 
             try:
-                resp = requests.get(url, headers=headers, params=params, timeout=20)
+                resp = ghl_session().get(url, headers=headers, params=params, timeout=call_timeout(deadline, 20))
                 resp.raise_for_status()
                 data = resp.json()
 
@@ -200,7 +204,7 @@ def consolidated_calendar_op(
         }
 
         try:
-            resp = requests.post(GHL_BOOK_URL, json=payload, headers=headers, timeout=30)
+            resp = ghl_session().post(GHL_BOOK_URL, json=payload, headers=headers, timeout=call_timeout(deadline, 30))
             if resp.status_code in [200, 201]:
                 logger.info(f"Appointment booked for {contact_id} at {start_dt}")
                 return True
@@ -2,13 +2,21 @@
 import logging
 import os
 import time as time_module
+import random
+import json
 import requests
+from typing import Optional, Dict
 from datetime import datetime, timedelta
+from rq import Queue, get_current_job
 from db import get_db_connection
+from ghl_api import ghl_session, get_valid_token
+from deadline import Deadline, MIN_CALL_TIMEOUT, call_timeout
 
 logger = logging.getLogger(__name__)
 
 GHL_MESSAGES_URL = "https://services.leadconnectorhq.com/conversations/messages"
+DUPLICATE_WINDOW_SECONDS = 300  # Same text to the same contact inside this window is skipped
+
 
 def send_sms_via_ghl(
     contact_id: str,
@@ -16,13 +24,15 @@ def send_sms_via_ghl(
     access_token: str,
     location_id: str,
     max_retries: int = 3,
-    retry_delay: int = 5
+    retry_delay: int = 5,
+    deadline: Optional[Deadline] = None
 ) -> bool:
     """
     Sends an SMS via GoHighLevel Conversations API.
     - Uses modern OAuth Bearer token (access_token)
     - Includes duplicate prevention (5-min window via DB check)
-    - Retries on transient failures
+    - Retries on transient failures: inside a worker job as a scheduled retry job
+      (see SCHEDULED RETRIES below), otherwise in place without sleeping past the deadline
     - Demo-safe: returns True without sending if access_token == 'DEMO'
     """
     if not contact_id or contact_id == "unknown":
@@ -49,9 +59,9 @@ def send_sms_via_ghl(
                 WHERE contact_id = %s
                   AND message_type = 'assistant'
                   AND message_text = %s
-                  AND created_at > NOW() - INTERVAL '5 minutes'
+                  AND created_at > NOW() - make_interval(secs => %s)
                 LIMIT 1
-            """, (contact_id, message.strip()))
+            """, (contact_id, message.strip(), DUPLICATE_WINDOW_SECONDS))
             if cur.fetchone():
                 logger.warning(f"SKIP DUPLICATE SMS: same message sent recently to {contact_id}")
                 return True  # Treat as success (already sent)
@@ -61,40 +71,160 @@ def send_sms_via_ghl(
             cur.close()
             conn.close()
 
+    # Inside a worker job the first failure becomes a scheduled retry job, so the
+    # worker moves on instead of sleeping; elsewhere (or SMS_RETRY_MODE=inline) retry in place.
+    job = get_current_job() if SMS_RETRY_MODE == "scheduled" else None
+
+    for attempt in range(1, max_retries + 1):
+        status = deliver_sms(contact_id, message, access_token, location_id, attempt, deadline)
+        if 200 <= status < 300:
+            logger.info(f"SMS sent successfully to {contact_id} on attempt {attempt}")
+            return True
+        if job is not None:
+            # Schedules attempt 2, or dead-letters right away on 401/403
+            schedule_sms_retry(job.connection, job.origin, contact_id, message, location_id, 1, status)
+            return False
+        if status in (401, 403):  # Auth issue — don't retry
+            logger.error(f"Auth failure — aborting retries")
+            break
+        if status == 429:  # Rate limit — longer wait
+            if deadline and not deadline.allows(SMS_RATE_LIMIT_DELAY + MIN_CALL_TIMEOUT):
+                logger.error(f"Rate limited with {deadline.remaining():.1f}s left — aborting retries")
+                break
+            time_module.sleep(SMS_RATE_LIMIT_DELAY)
+
+        if attempt < max_retries:
+            if deadline and not deadline.allows(retry_delay * attempt + MIN_CALL_TIMEOUT):
+                logger.error(f"Job deadline too close for another SMS attempt ({deadline.remaining():.1f}s left)")
+                break
+            time_module.sleep(retry_delay * attempt)  # Linear backoff: retry_delay, 2x, 3x ...
+
+    logger.error(f"Failed to send SMS to {contact_id} after {max_retries} attempts")
+    return False
+
+
+def deliver_sms(contact_id: str, message: str, access_token: str, location_id: str,
+                attempt: int = 1, deadline: Optional[Deadline] = None) -> int:
+    """One POST to GHL, no duplicate check or retry. Returns the HTTP status (0 = network error)."""
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Version": "2021-04-15",
         "Content-Type": "application/json"
     }
-
     payload = {
         "type": "SMS",
         "contactId": contact_id,
         "message": message.strip(),
         "locationId": location_id
     }
+    try:
+        resp = ghl_session().post(GHL_MESSAGES_URL, json=payload, headers=headers, timeout=call_timeout(deadline, 15))
+        resp.raise_for_status()
+        return resp.status_code
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else 0
+        logger.warning(f"GHL SMS attempt {attempt} failed ({status}): {e.response.text if e.response is not None else 'No response'}")
+        return status
+    except requests.RequestException as e:
+        logger.warning(f"GHL SMS attempt {attempt} network error: {e}")
+        return 0
 
-    for attempt in range(1, max_retries + 1):
-        try:
-            resp = requests.post(GHL_MESSAGES_URL, json=payload, headers=headers, timeout=15)
-            resp.raise_for_status()
 
-            logger.info(f"SMS sent successfully to {contact_id} on attempt {attempt}")
-            return True
+# === SCHEDULED RETRIES ===
+# A failed send is re-enqueued with exponential backoff and full jitter
+# (uniform(0, min(MAX_DELAY, BASE_DELAY * 2^(attempt-1))), never under the 429 floor),
+# on the job's base queue so the worker scheduler picks it up. After SMS_RETRY_MAX_ATTEMPTS
+# (or an auth failure) the message lands in the sms:dead_letter sorted set for follow-up.
+SMS_RETRY_MODE = os.getenv("SMS_RETRY_MODE", "scheduled").lower()  # scheduled | inline
+SMS_RETRY_MAX_ATTEMPTS = int(os.getenv("SMS_RETRY_MAX_ATTEMPTS", "5"))
+SMS_RETRY_BASE_DELAY = float(os.getenv("SMS_RETRY_BASE_DELAY", "5"))
+SMS_RETRY_MAX_DELAY = float(os.getenv("SMS_RETRY_MAX_DELAY", "300"))
+SMS_RATE_LIMIT_DELAY = 10
+SMS_DEAD_LETTER_KEY = "sms:dead_letter"
+SMS_DEAD_LETTER_MAX = 1000
+SMS_RETRY_STATS_KEY = "sms:retry_stats"
 
-        except requests.HTTPError as e:
-            status = e.response.status_code if e.response else 0
-            logger.warning(f"GHL SMS attempt {attempt} failed ({status}): {e.response.text if e.response else 'No response'}")
-            if status == 429:  # Rate limit — longer wait
-                time_module.sleep(10)
-            elif status in (401, 403):  # Auth issue — don't retry
-                logger.error(f"Auth failure — aborting retries")
-                break
-        except requests.RequestException as e:
-            logger.warning(f"GHL SMS attempt {attempt} network error: {e}")
-        
-        if attempt < max_retries:
-            time_module.sleep(retry_delay * attempt)  # Exponential backoff feel
 
-    logger.error(f"Failed to send SMS to {contact_id} after {max_retries} attempts")
-    return False
\ No newline at end of file
+def sms_retry_delay(attempt: int, status: int) -> float:
+    """Seconds to wait before attempt + 1."""
+    ceiling = min(SMS_RETRY_MAX_DELAY, SMS_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    delay = random.uniform(0, ceiling)
+    if status == 429:
+        delay = max(delay, SMS_RATE_LIMIT_DELAY)
+    return delay
+
+
+def schedule_sms_retry(redis_conn, origin: str, contact_id: str, message: str, location_id: str,
+                       attempt: int, status: int) -> bool:
+    """Queue attempt + 1 after a backoff, or dead-letter the message. Returns True if a retry was queued."""
+    if status in (401, 403) or attempt >= SMS_RETRY_MAX_ATTEMPTS:
+        dead_letter_sms(redis_conn, contact_id, message, location_id, attempt, status)
+        return False
+    delay = sms_retry_delay(attempt, status)
+    # Sub-queues (production:<loc>:<class>) aren't served by the scheduler — use the base queue
+    queue = Queue(origin.partition(":")[0], connection=redis_conn)
+    try:
+        queue.enqueue_in(
+            timedelta(seconds=delay), retry_sms_task,
+            contact_id, message, location_id, attempt + 1,
+            job_timeout=60, result_ttl=0
+        )
+        redis_conn.hincrby(SMS_RETRY_STATS_KEY, "scheduled", 1)
+    except Exception as e:
+        logger.error(f"Could not schedule SMS retry for {contact_id}: {e}")
+        dead_letter_sms(redis_conn, contact_id, message, location_id, attempt, status)
+        return False
+    logger.info(f"🔁 SMS retry {attempt + 1}/{SMS_RETRY_MAX_ATTEMPTS} for {contact_id} in {delay:.1f}s (last status {status})")
+    return True
+
+
+def dead_letter_sms(redis_conn, contact_id: str, message: str, location_id: str, attempts: int, status: int):
+    entry = json.dumps({
+        "contact_id": contact_id,
+        "location_id": location_id,
+        "message": message,
+        "attempts": attempts,
+        "last_status": status,
+        "failed_at": datetime.utcnow().isoformat(),
+    })
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.zadd(SMS_DEAD_LETTER_KEY, {entry: time_module.time()})
+        pipe.zremrangebyrank(SMS_DEAD_LETTER_KEY, 0, -SMS_DEAD_LETTER_MAX - 1)
+        pipe.hincrby(SMS_RETRY_STATS_KEY, "dead_lettered", 1)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Dead-letter write failed for {contact_id}: {e}")
+    logger.error(f"☠ SMS to {contact_id} dead-lettered after {attempts} attempts (last status {status})")
+
+
+def retry_sms_task(contact_id: str, message: str, location_id: str, attempt: int) -> bool:
+    """rq job: one more send attempt with a freshly validated token."""
+    job = get_current_job()
+    access_token = get_valid_token(location_id)
+    if not access_token:
+        dead_letter_sms(job.connection, contact_id, message, location_id, attempt, 401)
+        return False
+
+    # No duplicate check here: the pipeline already saved this reply locally when the first send failed
+    status = deliver_sms(contact_id, message, access_token, location_id, attempt)
+    if 200 <= status < 300:
+        job.connection.hincrby(SMS_RETRY_STATS_KEY, "recovered", 1)
+        logger.info(f"SMS sent successfully to {contact_id} on retry attempt {attempt}")
+        return True
+    schedule_sms_retry(job.connection, job.origin, contact_id, message, location_id, attempt, status)
+    return False
+
+
+def sms_retry_stats(redis_conn) -> Dict[str, int]:
+    """Retry counters plus the current dead-letter size."""
+    try:
+        counts = redis_conn.hgetall(SMS_RETRY_STATS_KEY)
+        size = redis_conn.zcard(SMS_DEAD_LETTER_KEY)
+    except Exception as e:
+        logger.warning(f"SMS retry stats unavailable: {e}")
+        return {}
+    stats = {"scheduled": 0, "recovered": 0, "dead_lettered": 0}
+    stats.update({(k.decode() if isinstance(k, bytes) else k): int(v) for k, v in counts.items()})
+    stats["dead_letter_size"] = size
+    return stats
@@ -7,12 +7,17 @@ from typing import List, Optional, Dict, Tuple
 
 logger = logging.getLogger(__name__)
 
+# With story_slot=True the story is left as this marker; build_system_prompt fills it in
+# (possibly trimmed to the token budget)
+STORY_SLOT = "{{EVOLVING_STORY}}"
+
 def build_comprehensive_profile(
     story_narrative: str,
     known_facts: List[str],
     first_name: Optional[str] = None,
     age: Optional[str] = None,
-    address: Optional[str] = None
+    address: Optional[str] = None,
+    story_slot: bool = False
 ) -> Tuple[str, Dict]:
     """
     Returns:
@@ -165,11 +170,12 @@ def build_comprehensive_profile(
 
     # Evolving story (use narrative_safe as foundation)
     narrative_body = " ".join(profile_sections)
+    story_text = (STORY_SLOT if story_slot else narrative_safe) if narrative_safe else "Building trust and identifying primary gap."
     final_narrative = f"""FULL HUMAN IDENTITY:
 {narrative_body or "No confirmed demographics yet — still building rapport."}
 
 EVOLVING STORY & NUANCE:
-{narrative_safe or "Building trust and identifying primary gap."}
+{story_text}
 
 CURRENT VIBE:
 {profile_context['current_vibe'].title()} (confidence: {profile_context['vibe_confidence']:.1f})
@@ -0,0 +1,328 @@
+# ingress.py - Redis-backed checks around /webhook: dedupe, bursts, ordering and admission
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+from rq.job import Job
+
+from fair_queue import queue_pressure
+
+logger = logging.getLogger(__name__)
+
+DEMO_LOCATIONS = {'DEMO', 'DEMO_LOC', 'DEMO_ACCOUNT_SALES_ONLY', 'TEST_LOCATION_456'}
+
+
+def payload_location_id(payload: dict) -> Optional[str]:
+    """Same fallback order process_webhook_task uses."""
+    location = payload.get("location")
+    return (
+        (location.get("id") if isinstance(location, dict) else None) or
+        payload.get("location_id") or
+        payload.get("locationId")
+    )
+
+
+def payload_message_body(payload: dict) -> str:
+    raw = payload.get("message", {})
+    body = raw.get("body", "") if isinstance(raw, dict) else raw
+    return str(body or "").strip()
+
+
+# === IDEMPOTENCY FAST-PATH ===
+# GHL retries a webhook until it sees a 2xx, so storms of the same message are common.
+# A Redis SET NX claim drops repeats before they reach the queue; processed_webhooks in
+# Postgres (checked inside process_webhook_task) stays the durable backstop.
+WEBHOOK_DEDUPE_ENABLED = os.getenv("WEBHOOK_DEDUPE_ENABLED", "true").lower() == "true"
+WEBHOOK_DEDUPE_TTL = int(os.getenv("WEBHOOK_DEDUPE_TTL", "86400"))
+# Payloads without a message_id are keyed on contact + body inside this time bucket
+WEBHOOK_DEDUPE_BUCKET_SECONDS = int(os.getenv("WEBHOOK_DEDUPE_BUCKET_SECONDS", "60"))
+
+
+def webhook_dedupe_key(payload: dict) -> Optional[str]:
+    """Redis key identifying this delivery, or None when there is nothing stable to key on."""
+    message_id = payload.get("message_id") or payload.get("id")
+    if message_id:
+        return f"webhook:seen:id:{message_id}"
+
+    contact_id = payload.get("contact_id")
+    body = payload_message_body(payload)
+    if not contact_id or not body:
+        return None
+    bucket = int(time.time()) // WEBHOOK_DEDUPE_BUCKET_SECONDS
+    digest = hashlib.sha1(f"{contact_id}|{body}|{bucket}".encode("utf-8")).hexdigest()
+    return f"webhook:seen:hash:{digest}"
+
+
+def claim_webhook(redis_conn, payload: dict) -> Tuple[bool, Optional[str]]:
+    """
+    Atomically claim this delivery. Returns (is_new, claimed_key); pass the key to
+    release_webhook if enqueueing fails. Demo traffic is never deduped here, and Redis
+    errors fail open — Postgres still catches the duplicate later.
+    """
+    if not WEBHOOK_DEDUPE_ENABLED or payload_location_id(payload) in DEMO_LOCATIONS:
+        return True, None
+    key = webhook_dedupe_key(payload)
+    if not key:
+        return True, None
+
+    ttl = WEBHOOK_DEDUPE_TTL if ":id:" in key else WEBHOOK_DEDUPE_BUCKET_SECONDS * 2
+    try:
+        if redis_conn.set(key, int(time.time()), nx=True, ex=ttl):
+            return True, key
+        return False, key
+    except Exception as e:
+        logger.warning(f"⚠ Dedupe check skipped (Redis): {e}")
+        return True, None
+
+
+def release_webhook(redis_conn, key: Optional[str]):
+    """Undo a claim so GHL's retry is accepted (used when the enqueue itself failed)."""
+    if not key:
+        return
+    try:
+        redis_conn.delete(key)
+    except Exception as e:
+        logger.warning(f"⚠ Could not release dedupe key {key}: {e}")
+
+
+# === BURST COALESCING ===
+# Leads often fire off 3-4 texts in a few seconds. The first message of a burst schedules
+# one job BURST_WINDOW_SECONDS out; messages landing inside the window are buffered in Redis
+# and that job answers all of them at once. 0 disables (every message is its own job).
+BURST_WINDOW_SECONDS = float(os.getenv("BURST_WINDOW_SECONDS", "0"))
+BURST_KEY_TTL = 600  # Safety net if the scheduled job is lost after enqueue; a failed enqueue calls cancel_burst
+
+
+def _burst_keys(contact_id: str) -> Tuple[str, str]:
+    return f"burst:buffer:{contact_id}", f"burst:open:{contact_id}"
+
+
+def buffer_burst_message(redis_conn, payload: dict) -> Optional[bool]:
+    """
+    Add a message to its contact's burst buffer.
+    True  — this message opened the burst; caller schedules the job.
+    False — a job is already scheduled and will pick this message up.
+    None  — Redis failed; caller should enqueue normally.
+    """
+    buffer_key, open_key = _burst_keys(payload.get("contact_id"))
+    try:
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.rpush(buffer_key, json.dumps(payload))
+        pipe.expire(buffer_key, BURST_KEY_TTL)
+        pipe.set(open_key, int(time.time()), nx=True, ex=BURST_KEY_TTL)
+        opened = pipe.execute()[-1]
+        return bool(opened)
+    except Exception as e:
+        logger.warning(f"⚠ Burst buffer unavailable (Redis): {e}")
+        return None
+
+
+def cancel_burst(redis_conn, contact_id: str):
+    """Undo an opened burst whose job never got queued, so the contact's next text opens a new one."""
+    try:
+        redis_conn.delete(*_burst_keys(contact_id))
+    except Exception as e:
+        logger.warning(f"⚠ Could not cancel burst for {contact_id} (clears in {BURST_KEY_TTL}s): {e}")
+
+
+def drain_burst(redis_conn, payload: dict) -> Optional[dict]:
+    """
+    Close the burst and merge every buffered message into one payload (latest metadata,
+    bodies joined in arrival order). Returns None if another job already drained it.
+    """
+    buffer_key, open_key = _burst_keys(payload.get("contact_id"))
+    try:
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.lrange(buffer_key, 0, -1)
+        pipe.delete(buffer_key, open_key)
+        raw_items = pipe.execute()[0]
+    except Exception as e:
+        logger.warning(f"⚠ Burst drain failed (Redis) — answering the first message only: {e}")
+        return payload
+
+    items = [json.loads(raw) for raw in raw_items]
+    if not items:
+        return None
+
+    merged = dict(items[-1])
+    bodies = [b for b in (payload_message_body(p) for p in items) if b]
+    message = merged.get("message")
+    merged["message"] = dict(message, body="\n".join(bodies)) if isinstance(message, dict) else "\n".join(bodies)
+    merged["coalesced_message_ids"] = [p.get("message_id") or p.get("id") for p in items if p.get("message_id") or p.get("id")]
+    if len(items) > 1:
+        logger.info(f"🧺 Coalesced {len(items)} messages for contact {payload.get('contact_id')}")
+    return merged
+
+
+# === PER-CONTACT ORDERING ===
+# Every production job gets a ticket in contact:pending:{id}, scored by arrival time.
+# A job only runs once its ticket is the oldest one left, so a contact's messages are
+# answered one at a time and in the order they arrived (even though replies are queued
+# at_front) while different contacts still run in parallel across workers. A job that
+# is early doesn't hold its worker: it is re-scheduled CONTACT_TURN_RETRY_SECONDS out, and
+# after CONTACT_TURN_MAX_WAIT of that it runs out of turn.
+# Each ticket is bound to the rq job currently holding it (contact:holders:{id}), so a
+# ticket is dropped once that job is gone or finished without releasing it, however long
+# it sat in a queue. Unbound tickets fall back to CONTACT_TICKET_STALE_SECONDS.
+CONTACT_ORDERING_ENABLED = os.getenv("CONTACT_ORDERING_ENABLED", "true").lower() == "true"
+CONTACT_TURN_MAX_WAIT = float(os.getenv("CONTACT_TURN_MAX_WAIT", "30"))
+CONTACT_TURN_RETRY_SECONDS = int(os.getenv("CONTACT_TURN_RETRY_SECONDS", "2"))
+CONTACT_TICKET_STALE_SECONDS = 300  # Unbound tickets older than this were never enqueued
+TICKET_DEAD_STATUSES = {"finished", "failed", "stopped", "canceled"}
+
+
+def _pending_key(contact_id: str) -> str:
+    return f"contact:pending:{contact_id}"
+
+
+def _holders_key(contact_id: str) -> str:
+    return f"contact:holders:{contact_id}"
+
+
+def register_contact_turn(redis_conn, contact_id: str) -> Optional[str]:
+    """Take a place in line for this contact. Returns the ticket (None = ordering skipped)."""
+    if not CONTACT_ORDERING_ENABLED or not contact_id:
+        return None
+    ticket = uuid.uuid4().hex
+    try:
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.zadd(_pending_key(contact_id), {ticket: time.time()})
+        pipe.expire(_pending_key(contact_id), 86400)
+        pipe.execute()
+        return ticket
+    except Exception as e:
+        logger.warning(f"⚠ Contact ordering skipped (Redis): {e}")
+        return None
+
+
+def bind_contact_turn(redis_conn, contact_id: str, ticket: Optional[str], job_id: str):
+    """Record the rq job now holding this ticket (call after every enqueue that carries it)."""
+    if not ticket:
+        return
+    try:
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.hset(_holders_key(contact_id), ticket, job_id)
+        pipe.expire(_holders_key(contact_id), 86400)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"⚠ Could not bind contact turn for {contact_id}: {e}")
+
+
+def _ticket_abandoned(redis_conn, contact_id: str, ticket, since: float) -> bool:
+    """True if no live job holds this ticket any more."""
+    job_id = redis_conn.hget(_holders_key(contact_id), ticket)
+    if job_id is None:
+        return since < time.time() - CONTACT_TICKET_STALE_SECONDS
+    job_id = job_id.decode() if isinstance(job_id, bytes) else job_id
+    status = redis_conn.hget(f"{Job.redis_job_namespace_prefix}{job_id}", "status")
+    status = status.decode() if isinstance(status, bytes) else status
+    return status is None or status in TICKET_DEAD_STATUSES
+
+
+def contact_turn_ready(redis_conn, contact_id: str, ticket: Optional[str]) -> bool:
+    """True once every older ticket for this contact has finished (or Redis can't tell us)."""
+    if not ticket:
+        return True
+    key = _pending_key(contact_id)
+    try:
+        while True:
+            head = redis_conn.zrange(key, 0, 0, withscores=True)
+            if not head or head[0][0] in (ticket, ticket.encode()):
+                return True
+            held, since = head[0]
+            if not _ticket_abandoned(redis_conn, contact_id, held, since):
+                return False
+            logger.warning(f"⚠ Dropping abandoned contact turn for {contact_id}")
+            finish_contact_turn(redis_conn, contact_id, held)
+    except Exception as e:
+        logger.warning(f"⚠ Contact ordering check failed (Redis), running now: {e}")
+        return True
+
+
+def finish_contact_turn(redis_conn, contact_id: str, ticket: Optional[str]):
+    """Hand the contact to the next waiting job."""
+    if not ticket:
+        return
+    try:
+        pipe = redis_conn.pipeline(transaction=True)
+        pipe.zrem(_pending_key(contact_id), ticket)
+        pipe.hdel(_holders_key(contact_id), ticket)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"⚠ Could not release contact turn for {contact_id}: {e}")
+
+
+# === ADMISSION CONTROL ===
+# /webhook reads queue depth and the oldest job's age (cached ~1s per process) for the
+# base queue a job is headed to:
+#   normal     — admit everything
+#   elevated   — initial outreach is deferred (scheduled ~ADMISSION_DEFER_SECONDS out, jittered
+#                so a spike's deferrals don't all return at once, then re-admitted — see tasks.py)
+#   overloaded — outreach and replies from leads the bot hasn't engaged get 429 + Retry-After;
+#                replies from engaged leads (a director stage on record) are always admitted
+ADMISSION_CONTROL_ENABLED = os.getenv("ADMISSION_CONTROL_ENABLED", "true").lower() == "true"
+ADMISSION_SOFT_DEPTH = int(os.getenv("ADMISSION_SOFT_DEPTH", "300"))
+ADMISSION_HARD_DEPTH = int(os.getenv("ADMISSION_HARD_DEPTH", "1000"))
+ADMISSION_SOFT_AGE = float(os.getenv("ADMISSION_SOFT_AGE", "60"))
+ADMISSION_HARD_AGE = float(os.getenv("ADMISSION_HARD_AGE", "240"))
+ADMISSION_DEFER_SECONDS = int(os.getenv("ADMISSION_DEFER_SECONDS", "120"))
+ADMISSION_DEFER_JITTER = float(os.getenv("ADMISSION_DEFER_JITTER", "0.5"))  # Delay drawn from DEFER x (1 ± JITTER)
+ADMISSION_MAX_DEFERRALS = int(os.getenv("ADMISSION_MAX_DEFERRALS", "3"))  # Then the job is queued whatever the pressure
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "30"))
+ADMISSION_CACHE_SECONDS = 1.0
+
+_pressure_cache: Dict[str, dict] = {}
+_pressure_lock = threading.Lock()
+
+
+def admission_state(redis_conn, base_name: str) -> dict:
+    """Depth, oldest job age and pressure level for a base queue; refreshed at most once a second."""
+    with _pressure_lock:
+        cached = _pressure_cache.get(base_name)
+        if cached and time.monotonic() - cached["_at"] < ADMISSION_CACHE_SECONDS:
+            return cached
+    try:
+        state = queue_pressure(redis_conn, base_name)
+    except Exception as e:
+        logger.warning(f"⚠ Queue pressure unavailable (Redis): {e}")
+        state = {"depth": None, "oldest_age": None}
+
+    depth, age = state["depth"] or 0, state["oldest_age"] or 0.0
+    if depth >= ADMISSION_HARD_DEPTH or age >= ADMISSION_HARD_AGE:
+        state["level"] = "overloaded"
+    elif depth >= ADMISSION_SOFT_DEPTH or age >= ADMISSION_SOFT_AGE:
+        state["level"] = "elevated"
+    else:
+        state["level"] = "normal"
+    state["queue"] = base_name
+    state["_at"] = time.monotonic()
+    with _pressure_lock:
+        _pressure_cache[base_name] = state
+    return state
+
+
+def admission_decision(redis_conn, base_name: str, job_class: str, engaged: bool) -> Tuple[str, dict]:
+    """Returns ("admit" | "defer" | "reject", state)."""
+    if not ADMISSION_CONTROL_ENABLED or job_class == "demo":
+        return "admit", {}
+    state = admission_state(redis_conn, base_name)
+    level = state["level"]
+    if level == "overloaded":
+        if job_class != "outreach" and engaged:
+            return "admit", state
+        return "reject", state
+    if level == "elevated" and job_class == "outreach":
+        return "defer", state
+    return "admit", state
+
+
+def defer_delay() -> float:
+    """Seconds to hold a deferred job: ADMISSION_DEFER_SECONDS spread by ±ADMISSION_DEFER_JITTER."""
+    spread = ADMISSION_DEFER_SECONDS * ADMISSION_DEFER_JITTER
+    return max(1.0, ADMISSION_DEFER_SECONDS + random.uniform(-spread, spread))
@@ -0,0 +1,329 @@
+# llm_gateway.py - One xAI client for the web app and every worker: pooled HTTP, a Redis-wide
+# concurrency cap, a shared circuit breaker and per-call latency / token metrics
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import httpx
+import redis
+from openai import OpenAI, APIConnectionError, APIStatusError, APITimeoutError
+
+from deadline import Deadline, call_timeout
+from metrics import record_metric, metric_summary
+
+logger = logging.getLogger(__name__)
+
+XAI_API_KEY = os.getenv("XAI_API_KEY")
+XAI_BASE_URL = os.getenv("XAI_BASE_URL", "https://api.x.ai/v1")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+DEFAULT_MODEL = os.getenv("LLM_MODEL", "grok-4-1-fast-reasoning")
+DEFAULT_TIMEOUT = 60.0
+
+# === HTTP POOL ===
+# One keep-alive pool per process, shared by every thread (warm workers, stage pool, gunicorn)
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_SDK_RETRIES = int(os.getenv("LLM_SDK_RETRIES", "1"))  # The SDK's own retry on connection errors / 429 / 5xx
+
+
+class LLMUnavailable(Exception):
+    """Raised without calling xAI: no API key, breaker open, or no concurrency slot in time."""
+
+
+class LLMStreamTimeout(Exception):
+    """A streamed call ran past its total cap — our budget ran out, not a provider failure."""
+
+
+_client: Optional[OpenAI] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+_redis_conn = None
+
+
+def get_client() -> OpenAI:
+    global _client, _client_pid
+    if not XAI_API_KEY:
+        raise LLMUnavailable("XAI_API_KEY not set")
+    with _client_lock:
+        # A forked child (rq ForkWorker) must not reuse the parent's keep-alive sockets
+        if _client is None or _client_pid != os.getpid():
+            _client_pid = os.getpid()
+            _client = OpenAI(
+                api_key=XAI_API_KEY,
+                base_url=XAI_BASE_URL,
+                max_retries=LLM_SDK_RETRIES,
+                http_client=httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                        keepalive_expiry=60,
+                    ),
+                    timeout=httpx.Timeout(DEFAULT_TIMEOUT, connect=5.0),
+                ),
+            )
+    return _client
+
+
+def llm_configured() -> bool:
+    return bool(XAI_API_KEY)
+
+
+def _redis():
+    global _redis_conn
+    if _redis_conn is None:
+        _redis_conn = redis.from_url(REDIS_URL)
+    return _redis_conn
+
+
+# === CONCURRENCY CAP ===
+# At most LLM_MAX_CONCURRENCY calls in flight across all processes. Slots live in a sorted
+# set scored by acquire time; slots older than LLM_SLOT_STALE_SECONDS belong to dead
+# processes and are pruned. Redis errors fail open (no cap) rather than blocking replies.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_SLOT_WAIT_SECONDS = float(os.getenv("LLM_SLOT_WAIT_SECONDS", "10"))
+LLM_SLOT_STALE_SECONDS = 180  # Longer than any call timeout
+LLM_SLOT_POLL_SECONDS = 0.05
+SLOTS_KEY = "llm:inflight"
+
+
+def _try_acquire(redis_conn, slot: str) -> bool:
+    now = time.time()
+    pipe = redis_conn.pipeline(transaction=True)
+    pipe.zremrangebyscore(SLOTS_KEY, "-inf", now - LLM_SLOT_STALE_SECONDS)
+    pipe.zadd(SLOTS_KEY, {slot: now})
+    pipe.zrank(SLOTS_KEY, slot)
+    rank = pipe.execute()[-1]
+    if rank is not None and rank < LLM_MAX_CONCURRENCY:
+        return True
+    redis_conn.zrem(SLOTS_KEY, slot)
+    return False
+
+
+def acquire_slot(max_wait: float) -> Optional[str]:
+    """Wait up to max_wait for a slot. Returns the slot id ('' if Redis is down) or raises LLMUnavailable."""
+    slot = uuid.uuid4().hex
+    give_up = time.monotonic() + max_wait
+    try:
+        redis_conn = _redis()
+        while not _try_acquire(redis_conn, slot):
+            if time.monotonic() >= give_up:
+                _count("rejected_busy")
+                raise LLMUnavailable(f"all {LLM_MAX_CONCURRENCY} LLM slots busy for {max_wait:.1f}s")
+            time.sleep(LLM_SLOT_POLL_SECONDS)
+    except redis.RedisError as e:
+        logger.warning(f"⚠ LLM concurrency cap skipped (Redis): {e}")
+        return ""
+    return slot
+
+
+def release_slot(slot: Optional[str]):
+    if not slot:
+        return
+    try:
+        _redis().zrem(SLOTS_KEY, slot)
+    except redis.RedisError as e:
+        logger.warning(f"⚠ LLM slot release failed (pruned after {LLM_SLOT_STALE_SECONDS}s): {e}")
+
+
+# === CIRCUIT BREAKER ===
+# LLM_BREAKER_FAILURES provider failures (timeouts, connection errors, 429, 5xx) inside
+# LLM_BREAKER_WINDOW seconds open the breaker for every process: calls raise LLMUnavailable
+# at once and callers use their canned fallback reply. After LLM_BREAKER_COOLDOWN one probe
+# call is let through; success closes the breaker, failure re-opens it.
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "30"))
+LLM_BREAKER_COOLDOWN = int(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+BREAKER_OPEN_KEY = "llm:breaker:open"
+BREAKER_TRIPPED_KEY = "llm:breaker:tripped"  # Set while open or half-open
+BREAKER_PROBE_KEY = "llm:breaker:probe"
+STATS_KEY = "llm:stats"
+
+
+def _count(field: str):
+    try:
+        _redis().hincrby(STATS_KEY, field, 1)
+    except redis.RedisError:
+        pass
+
+
+def _breaker_admits() -> bool:
+    """False while open; while half-open only the caller that wins the probe gets through."""
+    try:
+        redis_conn = _redis()
+        if redis_conn.exists(BREAKER_OPEN_KEY):
+            return False
+        if redis_conn.exists(BREAKER_TRIPPED_KEY):
+            return bool(redis_conn.set(BREAKER_PROBE_KEY, 1, nx=True, ex=LLM_BREAKER_COOLDOWN))
+    except redis.RedisError:
+        pass
+    return True
+
+
+def _record_failure(error: Exception):
+    try:
+        redis_conn = _redis()
+        window_key = f"llm:failures:{int(time.time()) // LLM_BREAKER_WINDOW}"
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.incr(window_key)
+        pipe.expire(window_key, LLM_BREAKER_WINDOW * 2)
+        pipe.exists(BREAKER_TRIPPED_KEY)
+        failures, _, half_open = pipe.execute()
+        if half_open or failures >= LLM_BREAKER_FAILURES:
+            pipe = redis_conn.pipeline(transaction=False)
+            pipe.set(BREAKER_OPEN_KEY, 1, ex=LLM_BREAKER_COOLDOWN)
+            pipe.set(BREAKER_TRIPPED_KEY, 1, ex=LLM_BREAKER_COOLDOWN * 10)
+            pipe.delete(BREAKER_PROBE_KEY)
+            pipe.hincrby(STATS_KEY, "breaker_opened", 1)
+            pipe.execute()
+            logger.error(f"🔌 LLM circuit breaker OPEN for {LLM_BREAKER_COOLDOWN}s ({failures} failures; last: {error})")
+    except redis.RedisError:
+        pass
+
+
+def _record_success():
+    try:
+        redis_conn = _redis()
+        if redis_conn.exists(BREAKER_TRIPPED_KEY):
+            redis_conn.delete(BREAKER_TRIPPED_KEY, BREAKER_PROBE_KEY)
+            logger.info("🔌 LLM circuit breaker closed")
+    except redis.RedisError:
+        pass
+
+
+def _is_provider_failure(error: Exception, full_timeout: bool) -> bool:
+    """
+    Failures that count toward the breaker. A timeout only counts when the call had the
+    caller's full timeout — a deadline-shortened cap timing out says nothing about xAI.
+    """
+    if isinstance(error, APITimeoutError):
+        return full_timeout
+    if isinstance(error, APIConnectionError):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+
+# === CALLS ===
+
+def _stream_completion(client: OpenAI, request: dict, start: float):
+    """
+    Streamed call: returns (text, usage, seconds to first token). The request timeout only
+    bounds each read, so the total is capped here and the stream closed once it runs out.
+    """
+    parts, usage, ttft = [], None, None
+    total_cap = request["timeout"]
+    with client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request) as stream:
+        for chunk in stream:
+            if time.perf_counter() - start > total_cap:
+                raise LLMStreamTimeout(f"stream exceeded {total_cap:.1f}s")
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(chunk.choices[0].delta.content)
+    return "".join(parts), usage, ttft
+
+
+def chat(
+    messages: List[Dict[str, str]],
+    purpose: str,
+    model: Optional[str] = None,
+    temperature: float = 0.85,
+    max_tokens: int = 200,
+    timeout: float = DEFAULT_TIMEOUT,
+    deadline: Optional[Deadline] = None,
+    stream: bool = False,
+    **kwargs
+) -> str:
+    """
+    One chat completion; returns the message text. `purpose` labels the metrics
+    (llm_latency / llm_prompt_tokens / llm_cached_tokens / llm_completion_tokens:<purpose>;
+    stream=True also records time to first token as llm_ttft:<purpose>).
+    Raises LLMUnavailable without calling xAI when the breaker is open or no slot frees up,
+    and re-raises provider errors — callers keep their own fallback replies.
+    """
+    client = get_client()
+    if not _breaker_admits():
+        _count("rejected_open")
+        raise LLMUnavailable("circuit breaker open")
+
+    call_cap = call_timeout(deadline, timeout)
+    slot = acquire_slot(min(LLM_SLOT_WAIT_SECONDS, call_cap))
+    request = dict(
+        model=model or DEFAULT_MODEL,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        timeout=call_cap,
+        **kwargs
+    )
+    start = time.perf_counter()
+    try:
+        if stream:
+            content, usage, ttft = _stream_completion(client, request, start)
+        else:
+            response = client.chat.completions.create(**request)
+            content, usage, ttft = response.choices[0].message.content or "", getattr(response, "usage", None), None
+    except Exception as e:
+        _count("failures")
+        if _is_provider_failure(e, full_timeout=call_cap >= timeout):
+            _record_failure(e)
+        raise
+    finally:
+        release_slot(slot)
+
+    latency = time.perf_counter() - start
+    _count("calls")
+    _record_success()
+    redis_conn = _redis()
+    record_metric(redis_conn, f"llm_latency:{purpose}", latency)
+    if ttft is not None:
+        record_metric(redis_conn, f"llm_ttft:{purpose}", ttft)
+    if usage:
+        # Cached prompt tokens are billed at the provider's discounted rate
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+        record_metric(redis_conn, f"llm_prompt_tokens:{purpose}", usage.prompt_tokens or 0)
+        record_metric(redis_conn, f"llm_cached_tokens:{purpose}", cached)
+        record_metric(redis_conn, f"llm_completion_tokens:{purpose}", usage.completion_tokens or 0)
+    return content
+
+
+LLM_METRICS = ("latency", "ttft", "prompt_tokens", "cached_tokens", "completion_tokens")
+
+
+def _purposes(redis_conn) -> List[str]:
+    """Every purpose label that has recorded a call (e.g. reply:stable, observer)."""
+    prefix = "metrics:llm_latency:"
+    keys = (k.decode() if isinstance(k, bytes) else k for k in redis_conn.scan_iter(match=f"{prefix}*", count=100))
+    return sorted(k[len(prefix):] for k in keys)
+
+
+def llm_stats() -> dict:
+    """Breaker state, slot usage, counters and per-purpose latency / TTFT / token percentiles."""
+    try:
+        redis_conn = _redis()
+        counts = {(k.decode() if isinstance(k, bytes) else k): int(v) for k, v in redis_conn.hgetall(STATS_KEY).items()}
+        if redis_conn.exists(BREAKER_OPEN_KEY):
+            breaker = "open"
+        elif redis_conn.exists(BREAKER_TRIPPED_KEY):
+            breaker = "half_open"
+        else:
+            breaker = "closed"
+        in_flight = redis_conn.zcard(SLOTS_KEY)
+        purposes = _purposes(redis_conn)
+    except redis.RedisError as e:
+        logger.warning(f"LLM stats unavailable: {e}")
+        return {}
+    return {
+        "breaker": breaker,
+        "in_flight": in_flight,
+        "max_concurrency": LLM_MAX_CONCURRENCY,
+        "counts": counts,
+        "purposes": {
+            p: {m: metric_summary(redis_conn, f"llm_{m}:{p}") for m in LLM_METRICS}
+            for p in purposes
+        },
+    }
@@ -10,7 +10,6 @@ import redis
 import requests
 import secrets
 import httpx
-from openai import OpenAI
 from oauth2client.service_account import ServiceAccountCredentials
 from dotenv import load_dotenv
 from flask import Flask, render_template, render_template_string, request, redirect, url_for, flash, session, make_response
@@ -21,19 +20,30 @@ from flask import jsonify as flask_jsonify
 from wtforms import StringField, PasswordField, SubmitField, TextAreaField, SelectField
 from wtforms.validators import DataRequired, Email, EqualTo
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
 from rq import Queue
 from psycopg2.extras import RealDictCursor
 
 # === IMPORTS ===
-from db import get_subscriber_info_hybrid, get_db_connection, init_db, User
+from db import get_subscriber_info_hybrid, get_db_connection, get_location_tier, init_db, User
 from sync_subscribers import sync_subscribers
 # CRITICAL IMPORT: This connects main.py to the logic in tasks.py
-from tasks import process_webhook_task  
-from memory import get_known_facts, get_narrative, get_recent_messages 
+from tasks import process_webhook_task, observer_is_deferred, enqueue_narrative_observer, defer_webhook
+from ghl_message import sms_retry_stats
+from llm_gateway import chat, llm_stats
+from model_router import route_reply, record_route, route_stats
+from demo_openers import take_demo_opener, request_refill, opener_pool_stats
+from metrics import metric_summary
+from sms_outbox import outbox_stats
+from memory import get_known_facts, get_narrative, get_recent_messages, load_contact_context
 from individual_profile import build_comprehensive_profile 
-from utils import make_json_serializable, clean_ai_reply
-from prompt import CORE_UNIFIED_MINDSET, DEMO_OPENER_ADDITIONAL_INSTRUCTIONS
+from utils import make_json_serializable
+from fair_queue import location_queue, fair_queue_stats, priority_class, contact_stage, tier_queue_name
+from ingress import (
+    claim_webhook, release_webhook, buffer_burst_message, cancel_burst, BURST_WINDOW_SECONDS,
+    register_contact_turn, bind_contact_turn, finish_contact_turn,
+    admission_decision, admission_state, ADMISSION_CONTROL_ENABLED, ADMISSION_RETRY_AFTER
+)
 load_dotenv()
 
 app = Flask(__name__)
@@ -54,8 +64,9 @@ redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
 try:
     conn = redis.from_url(redis_url)
     
-    # Create TWO queues
+    # Create the queues
     q_production = Queue('production', connection=conn) # High Priority
+    q_pro        = Queue('pro',        connection=conn) # Agency Pro — reserved worker-pro pool
     q_demo       = Queue('demo',       connection=conn) # Low Priority
     
     logger.info("✅ Redis Connection Successful")
@@ -65,19 +76,14 @@ except Exception as e:
 # === INITIALIZATION ===
 sync_subscribers()
 init_db() 
+try:
+    request_refill(q_demo)  # Warm the demo opener pool before the first visitor
+except Exception as e:
+    logger.warning(f"⚠ Demo opener pool not primed: {e}")
 
 # == SECRET SESSION ==
 app.secret_key = os.getenv("SESSION_SECRET", "fallback-insecure-key")
 
-# === API CLIENT ===
-XAI_API_KEY = os.getenv("XAI_API_KEY")
-client = None
-if XAI_API_KEY:
-    client = OpenAI(
-        api_key=XAI_API_KEY,
-        base_url="https://api.x.ai/v1"
-    )
-
 # == STRIPE & DOMAIN ==
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 YOUR_DOMAIN = os.getenv("YOUR_DOMAIN", "http://localhost:8080")
@@ -151,39 +157,9 @@ class ReviewForm(FlaskForm):
 
 @app.route('/api/demo/reset', methods=['POST'])
 def demo_reset():
-    # Call the bold function we just built
-    opener = generate_demo_opener()
+    opener = take_demo_opener(q_demo)
     return flask_jsonify({"message": opener})
 
-def generate_demo_opener():
-    if not client:
-        return "Quick question are you still with that life insurance plan you mentioned before? There's some new living benefits people have been asking me about and I wanted to make sure yours doesnt just pay out when you're dead."
-    try:
-        system_content = (
-            CORE_UNIFIED_MINDSET.format(bot_first_name="DEMOGROKBOT")
-            + "\n\n"
-            + DEMO_OPENER_ADDITIONAL_INSTRUCTIONS
-        )
-        response = client.chat.completions.create(
-            model="grok-4-1-fast-reasoning",
-            messages=[
-                {"role": "system", "content": system_content},
-                {"role": "user", "content": "Generate unique opener."}
-            ],
-            temperature=0.8,
-            max_tokens=130
-        )
-
-        # 1. Get raw text & basic cleanup (strip whitespace, remove quotes)
-        raw_text = response.choices[0].message.content.strip().replace('"', '')
-        
-        # 2. Run your specific cleaner
-        cleaned_content = clean_ai_reply(raw_text)
-        
-        return cleaned_content
-    except Exception as e:
-        logger.error(f"Demo opener failed: {e}")
-        return "Quick question are you still with that life insurance plan you mentioned before? There's some new living benefits people have been asking me about and I wanted to make sure yours doesnt just pay out when you're dead."
 # =====================================================
 #  THE ASYNC WEBHOOK ENDPOINT
 # =====================================================
@@ -198,6 +174,14 @@ def webhook():
     contact_id = payload.get("contact_id")
     message_body = payload.get("message", {}).get("body") or payload.get("message")
 
+    # 0. IDEMPOTENCY FAST-PATH: drop GHL retries before they cost a pipeline run
+    ticket = None
+    opened_burst = None
+    is_new, dedupe_key = claim_webhook(q_production.connection, payload)
+    if not is_new:
+        logger.info(f"♻ Duplicate webhook dropped at ingress | {dedupe_key}")
+        return safe_jsonify({"status": "duplicate"}), 200
+
     # 1. DEMO SPEED OPTIMIZATION: Write User Msg Immediately
     # This ensures the UI updates instantly when they hit send.
     if location_id in ['DEMO_LOC', 'DEMO'] and contact_id and message_body:
@@ -222,29 +206,115 @@ def webhook():
         # CHECK IF DEMO
         is_demo = location_id in ['DEMO_LOC', 'DEMO', 'TEST_LOCATION_456']
 
-        # Select the appropriate queue
-        target_queue = q_demo if is_demo else q_production
-
-        # PRIORITY SYSTEM: Replies jump to front, initial outreach goes to back
-        # This prevents 255 initial outreach messages from blocking real conversations
+        # PRIORITY SYSTEM: closing-stage replies > other replies > initial outreach > demo.
+        # Each class is its own FIFO sub-queue and workers age waiting jobs upward (fair_queue.py),
+        # so 255 outreach messages can't block real conversations and can't starve forever either
         is_reply = message_body and message_body.strip() and message_body.strip().lower() not in {".", ",", "k"}
+        stage = None if is_demo else contact_stage(q_production.connection, contact_id)
+        job_class = priority_class(stage, is_demo, is_reply)
+
+        # Select the appropriate queue: tier picks the base (cached lookup), then it's split per location + class
+        base_queue = q_production
+        if not is_demo and location_id and tier_queue_name(get_location_tier(location_id)) == q_pro.name:
+            base_queue = q_pro
+        target_queue = q_demo if is_demo else location_queue(base_queue, location_id, job_class)
+        # Only the unsplit legacy queue (FAIR_SCHEDULING=false) still needs at_front
+        at_front = bool(is_reply) and target_queue is base_queue
+
+        # BACKPRESSURE: shed outreach first; replies from leads the bot is already working stay protected
+        engaged = stage not in (None, "initial_outreach")
+        admission, pressure = admission_decision(base_queue.connection, base_queue.name, job_class, engaged)
+        if admission == "reject":
+            release_webhook(q_production.connection, dedupe_key)  # The retry must not look like a duplicate
+            logger.warning(f"🚦 Throttled {job_class} | {base_queue.name} depth={pressure['depth']} oldest={pressure['oldest_age']}s")
+            response = safe_jsonify({"status": "throttled", "retry_after": ADMISSION_RETRY_AFTER})
+            response.headers["Retry-After"] = str(ADMISSION_RETRY_AFTER)
+            return response, 429
+        if admission == "defer":
+            # Re-checked when it comes due, then routed like a fresh webhook (sub-queue + contact ticket)
+            job, delay = defer_webhook(base_queue, payload, job_class, engaged)
+            logger.info(f"⏸ Deferred {job_class} job {job.id} by {delay:.0f}s | {base_queue.name} is {pressure['level']}")
+            return safe_jsonify({"status": "deferred", "job_id": job.id, "queue": base_queue.name, "priority": job_class}), 202
+
+        # BURST COALESCING: texts that land inside the window ride along with the first one's job
+        opened_burst = None
+        if not is_demo and contact_id and BURST_WINDOW_SECONDS > 0:
+            opened_burst = buffer_burst_message(target_queue.connection, payload)
+            if opened_burst is False:
+                logger.info(f"🧺 Buffered into open burst | contact={contact_id}")
+                return safe_jsonify({"status": "coalesced", "queue": target_queue.name}), 202
+
+        # ORDERING: take a place in this contact's line so at_front can't reorder their messages
+        ticket = None if is_demo else register_contact_turn(target_queue.connection, contact_id)
+
+        if opened_burst:
+            # rq's scheduler only serves queues workers listen on, so bursts go via the base queue
+            target_queue = base_queue
+            job = target_queue.enqueue_in(
+                timedelta(seconds=BURST_WINDOW_SECONDS),
+                process_webhook_task,
+                payload,
+                coalesce=True,
+                ticket=ticket,
+                job_timeout=120,
+                result_ttl=86400,
+                at_front=at_front
+            )
+        else:
+            job = target_queue.enqueue(
+                process_webhook_task,
+                payload,
+                ticket=ticket,
+                job_timeout=120,
+                result_ttl=86400,
+                at_front=at_front
+            )
 
-        job = target_queue.enqueue(
-            process_webhook_task,
-            payload,
-            job_timeout=120,
-            result_ttl=86400,
-            at_front=is_reply  # Replies skip to front of queue
-        )
-
-        priority_label = "HIGH PRIORITY" if is_reply else "NORMAL"
-        logger.info(f"📥 Queued job {job.id} | Queue: {target_queue.name} | Priority: {priority_label}")
+        bind_contact_turn(target_queue.connection, contact_id, ticket, job.id)
+        logger.info(f"📥 Queued job {job.id} | Queue: {target_queue.name} | Priority: {job_class}")
 
-        return safe_jsonify({"status": "queued", "job_id": job.id, "queue": target_queue.name, "priority": priority_label}), 202
+        return safe_jsonify({"status": "queued", "job_id": job.id, "queue": target_queue.name, "priority": job_class}), 202
     except Exception as e:
         logger.error(f"Queue failed: {e}")
+        release_webhook(q_production.connection, dedupe_key)  # Let GHL's retry through
+        finish_contact_turn(q_production.connection, contact_id, ticket)
+        if opened_burst:
+            cancel_burst(q_production.connection, contact_id)  # Otherwise later texts are "coalesced" into nothing
         return safe_jsonify({"status": "error"}), 500
 
+def _ops_authorized() -> bool:
+    ops_token = os.getenv("OPS_TOKEN")
+    return bool(ops_token) and secrets.compare_digest(request.headers.get("X-Ops-Token", ""), ops_token)
+
+
+@app.route("/ops/queue-stats")
+def queue_stats():
+    """Backlog, running jobs and queue-wait percentiles per location and priority class. Needs X-Ops-Token."""
+    if not _ops_authorized():
+        return flask_jsonify({"error": "not found"}), 404
+    return safe_jsonify(fair_queue_stats(q_production.connection))
+
+
+@app.route("/ops/status")
+def ops_status():
+    """Admission-control view of each queue plus SMS, LLM gateway and demo opener pool health. Needs X-Ops-Token."""
+    if not _ops_authorized():
+        return flask_jsonify({"error": "not found"}), 404
+    queues = {}
+    for q in (q_production, q_pro):
+        state = admission_state(q.connection, q.name)
+        queues[q.name] = {k: v for k, v in state.items() if not k.startswith("_")}
+    return safe_jsonify({
+        "admission_control": ADMISSION_CONTROL_ENABLED,
+        "queues": queues,
+        "sms_retries": sms_retry_stats(q_production.connection),
+        "sms_outbox": outbox_stats(q_production.connection),
+        "llm": llm_stats(),
+        "llm_routes": route_stats(q_production.connection),
+        "demo_openers": opener_pool_stats(q_demo.connection),
+        "prompt_tokens": metric_summary(q_production.connection, "prompt_tokens"),
+    })
+
 # =====================================================
 #  BELOW THIS LINE: KEEP YOUR EXISTING @app.route("/") 
 #  AND OTHER UI CODE EXACTLY AS IT IS
@@ -947,6 +1017,7 @@ def create_portal_session():
 
 # At the top, add a demo-specific contact ID
 DEMO_CONTACT_ID = "demo_web_visitor"
+DEMO_HISTORY_LIMIT = 16  # Messages of demo history fed to the director / prompt
 
 def run_demo_janitor():
     """
@@ -1035,35 +1106,25 @@ def demo_chat_api():
             VALUES (%s, 'lead', %s)
         """, (contact_id, message))
         conn.commit()
-
-        # 2. Get conversation history
-        cur.execute("""
-            SELECT message_type, message_text
-            FROM contact_messages
-            WHERE contact_id = %s
-            ORDER BY created_at DESC
-            LIMIT 16
-        """, (contact_id,))
-
-        rows = cur.fetchall()
-        recent_exchanges = []
-        for row in reversed(rows):
-            role = "lead" if row['message_type'] == 'lead' else "assistant"
-            recent_exchanges.append({"role": role, "text": row['message_text']})
-
         cur.close()
         conn.close()
 
+        # 2. Get conversation history (+ facts & narrative in the same roundtrip)
+        contact_context = load_contact_context(contact_id, recent_limit=DEMO_HISTORY_LIMIT)
+        recent_exchanges = contact_context["recent_messages"]
+
         # 3. Use your full brain
         from sales_director import generate_strategic_directive
-        from prompt import build_system_prompt
+        from prompt import build_system_prompt, build_chat_messages
 
         director_output = generate_strategic_directive(
             contact_id=contact_id,
             message=message,
             first_name="Demo User",
             age=None,
-            address=None
+            address=None,
+            context=contact_context,
+            run_observer=not observer_is_deferred()
         )
 
         if "Silence required" in director_output["tactical_narrative"]:
@@ -1088,21 +1149,13 @@ def demo_chat_api():
             lead_vendor=""
         )
 
-        grok_messages = [{"role": "system", "content": system_prompt}]
-        for msg in recent_exchanges[-8:]:
-            role = "user" if msg["role"] == "lead" else "assistant"
-            grok_messages.append({"role": role, "content": msg["text"]})
-        grok_messages.append({"role": "user", "content": message})
+        grok_messages = build_chat_messages(system_prompt, recent_exchanges, message, history_limit=8)
 
         # 4. Call Grok
-        response = client.chat.completions.create(
-            model="grok-4-1-fast-reasoning",
-            messages=grok_messages,
-            temperature=0.85,
-            max_tokens=200,
-        )
-
-        reply = response.choices[0].message.content.strip()
+        route = route_reply(director_output.get("logic"), message)
+        record_route(q_demo.connection, route)
+        logger.info(f"🧭 DEMO ROUTE | {route.name} ({route.model}) | {route.reason}")
+        reply = chat(grok_messages, f"demo_chat:{route.name}", model=route.model, temperature=0.85, max_tokens=200).strip()
 
         # Clean reply
         reply = re.sub(r'<thinking>[\s\S]*?</thinking>', '', reply)
@@ -1122,6 +1175,9 @@ def demo_chat_api():
             cur.close()
             conn.close()
 
+        if observer_is_deferred():
+            enqueue_narrative_observer(contact_id, message, connection=q_demo.connection)
+
         # 6. Return response directly to frontend
         return flask_jsonify({
             "reply": reply,
@@ -1152,7 +1208,7 @@ def demo_init_api():
         count = cur.fetchone()['cnt']
 
         if count == 0:
-            opener = generate_demo_opener()
+            opener = take_demo_opener(q_demo)
             cur.execute("""
                 INSERT INTO contact_messages (contact_id, message_type, message_text)
                 VALUES (%s, 'assistant', %s)
@@ -1200,7 +1256,7 @@ def demo_reset_api():
             conn.close()
 
     new_id = f"demo_{uuid.uuid4()}"
-    opener = generate_demo_opener()
+    opener = take_demo_opener(q_demo)
 
     conn = get_db_connection()
     if conn:
@@ -3,23 +3,17 @@
 
 import os
 import logging
-from typing import List, Dict, Optional
-from openai import OpenAI
+from typing import List, Dict, Optional, Any
 from db import get_db_connection
 from psycopg2.extras import execute_values
 from datetime import datetime
 import httpx
+from deadline import Deadline
+from llm_gateway import chat
+from prompt import NEW_LEAD_STORY
 
 logger = logging.getLogger(__name__)
 
-XAI_API_KEY = os.getenv("XAI_API_KEY")
-
-client = None
-if XAI_API_KEY:
-    client = OpenAI(
-        api_key=XAI_API_KEY,
-        base_url="https://api.x.ai/v1"
-    )
 # ===================================
 # MESSAGE STORAGE & RETRIEVAL
 # ===================================
@@ -166,6 +160,90 @@ def get_known_facts(contact_id: str) -> List[str]:
             cur.close()
             conn.close()
 
+# ===================================
+# CONTACT CONTEXT (Single Roundtrip)
+# ===================================
+
+CONTEXT_RECENT_LIMIT = 10
+
+def load_contact_context(contact_id: str, recent_limit: int = CONTEXT_RECENT_LIMIT) -> Dict[str, Any]:
+    """
+    Load everything the worker pipeline needs about a contact in ONE query:
+    recent messages (oldest first), known facts, story narrative and total message count.
+    Returns an empty snapshot on failure so callers never have to None-check.
+    (The SMS duplicate check re-reads contact_messages at send time, not this snapshot.)
+    """
+    context = {
+        "recent_messages": [],
+        "known_facts": [],
+        "story_narrative": "",
+        "message_count": 0,
+    }
+    if not contact_id:
+        return context
+
+    conn = get_db_connection()
+    if not conn:
+        logger.error("DB connection failed in load_contact_context")
+        return context
+
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            WITH recent AS (
+                SELECT message_type, message_text, created_at
+                FROM contact_messages
+                WHERE contact_id = %(contact_id)s
+                ORDER BY created_at DESC
+                LIMIT %(recent_limit)s
+            ),
+            facts AS (
+                SELECT fact_text, created_at
+                FROM contact_facts
+                WHERE contact_id = %(contact_id)s
+            )
+            SELECT
+                (SELECT COUNT(*) FROM contact_messages WHERE contact_id = %(contact_id)s) AS message_count,
+                (SELECT story_narrative FROM contact_narratives WHERE contact_id = %(contact_id)s) AS story_narrative,
+                COALESCE((
+                    SELECT json_agg(json_build_object('role', message_type, 'text', message_text) ORDER BY created_at)
+                    FROM recent
+                ), '[]'::json) AS recent_messages,
+                COALESCE((
+                    SELECT json_agg(fact_text ORDER BY created_at) FROM facts
+                ), '[]'::json) AS known_facts
+        """, {
+            "contact_id": contact_id,
+            "recent_limit": recent_limit,
+        })
+        row = cur.fetchone()
+        if not row:
+            return context
+
+        context["message_count"] = row["message_count"] or 0
+        context["story_narrative"] = row["story_narrative"] or ""
+        context["known_facts"] = list(row["known_facts"] or [])
+        context["recent_messages"] = [
+            {"role": "lead" if m["role"] == "lead" else "assistant", "text": (m["text"] or "").strip()}
+            for m in (row["recent_messages"] or [])
+        ]
+        return context
+    except Exception as e:
+        logger.error(f"load_contact_context failed for {contact_id}: {e}", exc_info=True)
+        return context
+    finally:
+        if conn:
+            cur.close()
+            conn.close()
+
+def append_to_context(context: Dict[str, Any], role: str, text: str, recent_limit: int = CONTEXT_RECENT_LIMIT) -> None:
+    """Mirror a just-saved message into an already-loaded snapshot (no re-query)."""
+    if not text or not text.strip():
+        return
+    entry = {"role": "lead" if role == "lead" else "assistant", "text": text.strip()}
+    context["recent_messages"] = (context.get("recent_messages", []) + [entry])[-recent_limit:]
+    context["message_count"] = context.get("message_count", 0) + 1
+
 # ===================================
 # NARRATIVE OBSERVER (Evolving Story)
 # ===================================
@@ -223,17 +301,23 @@ def update_narrative(contact_id: str, new_story: str) -> bool:
             cur.close()
             conn.close()
 
-def run_narrative_observer(contact_id: str, lead_message: str) -> str:
+def run_narrative_observer(contact_id: str, lead_message: str, current_story: Optional[str] = None,
+                           deadline: Optional[Deadline] = None) -> str:
     """
     The 'Invisible Bot' that evolves the contact's life story.
     Only runs Grok if the message has meaningful content.
+    Pass current_story (e.g. from load_contact_context) to skip the narrative read,
+    and the job's deadline to cap the Grok call at what's left of it.
     Returns updated narrative (or current if failed/skipped).
     """
+    if current_story is None:
+        current_story = get_narrative(contact_id)
+
     if not contact_id or not lead_message or not lead_message.strip():
         logger.warning(f"Skipping observer: invalid input contact={contact_id}, msg_length={len(lead_message or '')}")
-        return get_narrative(contact_id) or ""
+        return current_story or ""
 
-    current_story = get_narrative(contact_id) or "Brand new lead. No history yet."
+    current_story = current_story or NEW_LEAD_STORY
 
     # Skip trivial messages to save API cost & prevent narrative bloat
     if len(lead_message.strip()) < 5 or lead_message.strip().lower() in {"ok", "yes", ".", "k", "cool", "thanks"}:
@@ -261,14 +345,14 @@ OUTPUT ONLY the updated narrative paragraph.
 """
 
     try:
-        response = client.chat.completions.create(
-            model="grok-4-1-fast-reasoning",
-            messages=[{"role": "system", "content": observer_prompt}],
+        updated_story = chat(
+            [{"role": "system", "content": observer_prompt}],
+            "observer",
             temperature=0.3,  # Low for factual consistency
             max_tokens=250,
-            timeout=15.0  # Prevent hanging
-        )
-        updated_story = response.choices[0].message.content.strip()
+            timeout=15.0,  # Prevent hanging
+            deadline=deadline
+        ).strip()
 
         if len(updated_story) < 20:
             logger.warning(f"Narrative update too short: {contact_id}")
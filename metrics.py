@@ -0,0 +1,48 @@
+# metrics.py - Rolling timing samples kept in Redis (shared by web + workers)
+import logging
+import os
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+METRIC_SAMPLES = int(os.getenv("METRIC_SAMPLES", "1000"))  # Newest N samples per metric
+
+
+def _key(name: str) -> str:
+    return f"metrics:{name}"
+
+
+def record_metric(redis_conn, name: str, value: float):
+    """Push one sample; never lets a metrics hiccup break the caller."""
+    if redis_conn is None:
+        return
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.lpush(_key(name), round(float(value), 4))
+        pipe.ltrim(_key(name), 0, METRIC_SAMPLES - 1)
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"Metric {name} not recorded: {e}")
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def metric_summary(redis_conn, name: str) -> Optional[Dict[str, float]]:
+    """count / p50 / p95 / p99 / max over the retained samples, or None if there are none."""
+    try:
+        values = sorted(float(v) for v in redis_conn.lrange(_key(name), 0, -1))
+    except Exception as e:
+        logger.warning(f"Metric {name} unavailable: {e}")
+        return None
+    if not values:
+        return None
+    return {
+        "count": len(values),
+        "p50": _percentile(values, 50),
+        "p95": _percentile(values, 95),
+        "p99": _percentile(values, 99),
+        "max": values[-1],
+    }
@@ -0,0 +1,88 @@
+# model_router.py - Pick the Grok model per reply from the conversation engine's LogicSignal
+#
+# Turns the rules already classify confidently (booked / closed, short acknowledgements in
+# closing, one-word objections) go to a cheaper non-reasoning model; discovery, consequence,
+# resistance, pain and anything long stay on the reasoning model (LLM_MODEL).
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from conversation_engine import LogicSignal, ConversationStage
+from llm_gateway import DEFAULT_MODEL
+
+logger = logging.getLogger(__name__)
+
+LLM_ROUTER_ENABLED = os.getenv("LLM_ROUTER_ENABLED", "false").lower() == "true"
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "grok-4-1-fast-non-reasoning")
+LLM_FAST_MAX_CHARS = int(os.getenv("LLM_FAST_MAX_CHARS", "60"))  # Longer lead messages always get the reasoning model
+ROUTES_KEY = "llm:routes"
+
+REASONING_STAGES = {ConversationStage.DISCOVERY, ConversationStage.CONSEQUENCE, ConversationStage.RESISTANCE}
+SHORT_TURN_STAGES = {ConversationStage.CLOSING, ConversationStage.INITIAL_OUTREACH}
+
+
+@dataclass
+class Route:
+    name: str    # "fast" or "reasoning" — also the metrics label
+    model: str
+    reason: str
+
+
+def _fast(reason: str) -> Route:
+    return Route("fast", LLM_FAST_MODEL, reason)
+
+
+def _reasoning(reason: str) -> Route:
+    return Route("reasoning", DEFAULT_MODEL, reason)
+
+
+def route_reply(logic: Optional[LogicSignal], message: str, merged: bool = False, booking_made: bool = False) -> Route:
+    """Choose the model for one lead reply. First matching rule wins."""
+    if not LLM_ROUTER_ENABLED:
+        return _reasoning("router_off")
+    if merged:
+        return _reasoning("merged_json")  # Reply + narrative rewrite in one call
+    if booking_made or (logic and logic.stage == ConversationStage.CLOSED):
+        return _fast("closed")
+    if logic is None:
+        return _reasoning("no_signal")
+    if logic.pain_score > 0 or logic.gap_signal:
+        return _reasoning("pain")
+    if logic.stage in REASONING_STAGES:
+        return _reasoning(f"stage:{logic.stage.value}")
+
+    short = len(message.strip()) <= LLM_FAST_MAX_CHARS
+    if logic.stage == ConversationStage.OBJECTION_HANDLING:
+        if short and logic.depth_score <= 1:
+            return _fast(f"short_{logic.last_move_type}")
+        return _reasoning("stage:objection")
+    if logic.stage in SHORT_TURN_STAGES and short:
+        return _fast(f"short_{logic.stage.value}")
+    return _reasoning("long_message")
+
+
+def record_route(redis_conn, route: Route):
+    """Count decisions per route/reason; latency per route is in llm_stats under reply:<layout>:<route>."""
+    try:
+        redis_conn.hincrby(ROUTES_KEY, f"{route.name}:{route.reason}", 1)
+    except Exception as e:
+        logger.debug(f"Route count skipped: {e}")
+
+
+def route_stats(redis_conn) -> dict:
+    try:
+        counts = {(k.decode() if isinstance(k, bytes) else k): int(v) for k, v in redis_conn.hgetall(ROUTES_KEY).items()}
+    except Exception as e:
+        logger.warning(f"Route stats unavailable: {e}")
+        return {"enabled": LLM_ROUTER_ENABLED}
+    totals = {}
+    for key, n in counts.items():
+        name = key.split(":", 1)[0]
+        totals[name] = totals.get(name, 0) + n
+    return {
+        "enabled": LLM_ROUTER_ENABLED,
+        "models": {"fast": LLM_FAST_MODEL, "reasoning": DEFAULT_MODEL},
+        "totals": totals,
+        "reasons": counts,
+    }
@@ -27,7 +27,8 @@ from psycopg2.extras import RealDictCursor
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Tuple
 from enum import Enum
-from contextlib import contextmanager
+
+from db import db_connection
 
 logger = logging.getLogger(__name__)
 
@@ -47,18 +48,9 @@ class VibeClassification(Enum):
     BOOKING_READY = "booking_ready"
 
 
-@contextmanager
 def get_db_connection():
-    """Get a database connection using DATABASE_URL."""
-    conn = psycopg2.connect(os.environ.get("DATABASE_URL"))
-    try:
-        yield conn
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        conn.close()
+    """Borrow a pooled connection (plain tuple cursors); commits on success, rolls back on error."""
+    return db_connection(cursor_factory=None)
 
 
 def init_tables():
@@ -1,10 +1,15 @@
 # prompt.py - Full Restored Sales Engine (2026)
 
 import logging
-from typing import List, Dict, Optional
+import os
+from typing import Callable, List, Dict, Optional
 import random
+
+from individual_profile import STORY_SLOT
 logger = logging.getLogger(__name__)
 
+NEW_LEAD_STORY = "Brand new lead. No history yet."  # Stored story until the narrative observer writes one
+
 # ===================================================
 # PERMANENT UNIFIED MINDSET - This is GrokBot's brain
 # ===================================================
@@ -105,6 +110,53 @@ NEVER ASK TWO QUESTIONS IN A SINGLE RESPONSE !IMPORTANT!
 WORDS NOT TO USE = "quote" replace with "policy review", "free" (noone values free), "just following up", "just checking in", "did you have time to". ANY corporate jargon.
 THE GOLDEN RULE: NEVER ASK "SAY NO" QUESTIONS = Questions where the answer could be no UNLESS using the "no" as a chris voss autonomy protection which still equals a yes. You always want agreement; tie downs, chris voss no means yes, questions should ALWAYS be guided to a yes or agreement. 
 """
+EXECUTION_PROTOCOL = """
+EXECUTION PROTOCOL:
+1. Read profile + narrative + history first — this is your Quiet Intuition.
+2. ANTI-TEMPLATE: If response feels scripted/robotic, rewrite uniquely.
+3. DO NOT BE OBNOXIOUS; be humble, and focused.
+""".strip()
+
+# =============================================
+# PROMPT LAYOUT
+# =============================================
+# legacy — mindset, identity, lead state, history, protocol (the protocol trails per-lead text)
+# stable — STATIC_PROMPT_PREFIX (byte-identical for every request, so the provider's prompt
+#          cache can reuse it), then the per-subscriber block, then per-lead state
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "legacy").lower()
+STATIC_PROMPT_PREFIX = f"{CORE_UNIFIED_MINDSET.strip()}\n\n{EXECUTION_PROTOCOL}"
+
+# =============================================
+# MERGED OUTPUT - reply + narrative + facts in one call
+# =============================================
+
+MERGED_OUTPUT_INSTRUCTIONS = """
+=== OUTPUT FORMAT (STRICT JSON) ===
+You are also the Narrative Observer for this lead. In the SAME response, return ONE JSON object and nothing else:
+{{
+  "reply": "<the SMS you send the lead — all rules above apply, plain text>",
+  "narrative": "<the lead's full updated life story>",
+  "new_facts": ["<short standalone fact>", ...]
+}}
+
+NARRATIVE RULES (evolve this CURRENT STORY using only what the lead just said):
+{current_story}
+- Rewrite the full narrative as a flowing, human-readable paragraph (max 150 words).
+- Extract specific entities (insurance companies, coverage amounts, family members, health issues, etc.).
+- Capture hints & subtext (hesitation, family influence, financial stress) and connect dots.
+- Do NOT add assumptions or fabricate details. If nothing new was learned, return the CURRENT STORY unchanged.
+
+NEW_FACTS RULES:
+- Only concrete facts stated by the lead in this message (e.g. "Has term policy through work", "Married, 2 kids").
+- Empty list if none. Never repeat facts already known.
+"""
+
+def build_merged_output_instructions(current_story: str) -> str:
+    """Output contract for the single reply+narrative+facts call."""
+    return MERGED_OUTPUT_INSTRUCTIONS.format(
+        current_story=(current_story or NEW_LEAD_STORY).strip()
+    ).strip()
+
 # =============================================
 # BUILD SYSTEM PROMPT - The Engine
 # =============================================
@@ -124,8 +176,20 @@ def build_system_prompt(
     lead_vendor: str = "",
     lead_first_name: Optional[str] = None,
     lead_age: Optional[str] = None,
-    lead_address: Optional[str] = None
+    lead_address: Optional[str] = None,
+    underwriting_context: str = "",
+    include_history: Optional[bool] = None,
+    merged_output: bool = False
 ) -> str:
+    """
+    Full system prompt, trimmed to PROMPT_TOKEN_BUDGET (see TOKEN BUDGET below).
+    include_history=False leaves out the conversation flow and the lead's last message
+    (they travel as chat turns instead); None follows PROMPT_HISTORY_MODE.
+    The story goes into profile_str's STORY_SLOT. merged_output=True appends the merged
+    JSON contract, which carries the full story itself (the model rewrites it), inside the budget.
+    """
+    if include_history is None:
+        include_history = PROMPT_HISTORY_MODE != "chat"
 
     identity = f"""
 You are {bot_first_name} — high-status helper, never chaser. 
@@ -141,14 +205,7 @@ Silent leads = busy. Re-engage with fresh value, never chase replies.
     elif "mortgage" in lv:
         lead_vendor_context = "Mortgage protection lead — payoff home, protect family."
 
-    # Flow with role labels for clarity
-    flow_str = "\n".join([
-        f"{'Lead' if msg['role'] == 'lead' else 'You'}: {msg['text']}"
-        for msg in recent_exchanges[-8:]
-    ])
-
     calendar_str = f"\nAvailable slots (use exactly):\n{calendar_slots}" if calendar_slots else ""
-    nudge_str = f"\nNote: {context_nudge}" if context_nudge else ""
 
     subtext_str = (
         "Subtext: Minimal/none detected — infer from history, tone, reply length: short=impatient, silence=busy, vague=guarded."
@@ -156,12 +213,54 @@ Silent leads = busy. Re-engage with fresh value, never chase replies.
         else f"Subtext in lead's message: Infer emotional tone, hesitation, agreement, frustration, or openness."
     )
 
-    return f"""
+    full_story = (story_narrative or "").strip()
+    output_rules = f"\n\n{build_merged_output_instructions(full_story)}" if merged_output else ""
+
+    def render(exchanges: List[Dict[str, str]], underwriting: str, story: str) -> str:
+        # Flow with role labels for clarity
+        flow_str = "\n".join([
+            f"{'Lead' if msg['role'] == 'lead' else 'You'}: {msg['text']}"
+            for msg in exchanges
+        ])
+        history_str = f"""
+RECENT CONVERSATION FLOW:
+{flow_str}
+
+LEAD JUST SAID: "{message}"
+""" if include_history else ""
+        nudge = "\n".join(part for part in (context_nudge, underwriting) if part).strip()
+        nudge_str = f"\nNote: {nudge}" if nudge else ""
+        if merged_output:
+            story = "(see CURRENT STORY in the output rules below)"
+        profile = profile_str.replace(STORY_SLOT, story)
+
+        if PROMPT_LAYOUT == "stable":
+            return f"""{STATIC_PROMPT_PREFIX}
+
+=== YOU ===
+{identity}
+
+=== LEAD ===
+{profile}
+
+=== TACTICAL SITUATION REPORT ===
+{tactical_narrative}
+==================================================
+
+CURRENT LEAD STATE:
+Stage: {stage}
+{subtext_str}
+{nudge_str}
+{lead_vendor_context}
+{calendar_str}
+{history_str}""".strip() + output_rules
+
+        return f"""
 {CORE_UNIFIED_MINDSET}
 
 {identity}
 
-{profile_str}
+{profile}
 
 === TACTICAL SITUATION REPORT ===
 {tactical_narrative}
@@ -173,14 +272,96 @@ Stage: {stage}
 {nudge_str}
 {lead_vendor_context}
 {calendar_str}
+{history_str}
+{EXECUTION_PROTOCOL}
+""".strip() + output_rules
 
-RECENT CONVERSATION FLOW:
-{flow_str}
+    exchanges = recent_exchanges[-8:] if include_history else []
+    # Only a story rendered through the slot can be trimmed; the merged contract needs it whole
+    trimmable_story = full_story if STORY_SLOT in profile_str and not merged_output else ""
+    return fit_to_budget(render, exchanges, (underwriting_context or "").strip(), trimmable_story)
 
-LEAD JUST SAID: "{message}"
+# =============================================
+# CHAT MESSAGES
+# =============================================
+# embedded (legacy) — history sits in the system prompt AND is replayed as chat turns, and the
+#                     lead's message is appended once more although it is already the last turn
+# chat              — the system prompt carries only state; history goes once, as chat turns
+PROMPT_HISTORY_MODE = os.getenv("PROMPT_HISTORY_MODE", "embedded").lower()
+
+def build_chat_messages(system_prompt: str, recent_exchanges: List[Dict[str, str]], message: str,
+                        history_limit: Optional[int] = None) -> List[Dict[str, str]]:
+    """Message list for the reply call. The oldest turns go first if the whole request is over budget."""
+    def turn(msg):
+        return {"role": "user" if msg["role"] == "lead" else "assistant", "content": msg["text"]}
+
+    system = {"role": "system", "content": system_prompt}
+    recent = recent_exchanges[-history_limit:] if history_limit else recent_exchanges
+    history = [turn(msg) for msg in recent]
+    if PROMPT_HISTORY_MODE != "chat":
+        if message:
+            history.append({"role": "user", "content": message})
+    # The lead's message is normally already the last turn (saved before the director ran)
+    elif message and not (history and history[-1] == {"role": "user", "content": message}):
+        history.append({"role": "user", "content": message})
+    while (PROMPT_TOKEN_BUDGET > 0 and len(history) > PROMPT_MIN_EXCHANGES
+           and estimate_message_tokens([system] + history) > PROMPT_TOKEN_BUDGET):
+        history.pop(0)
+    return [system] + history
 
-EXECUTION PROTOCOL:
-1. Read profile + narrative + history first — this is your Quiet Intuition.
-2. ANTI-TEMPLATE: If response feels scripted/robotic, rewrite uniquely.
-3. DO NOT BE OBNOXIOUS; be humble, and focused.
-""".strip()
\ No newline at end of file
+# =============================================
+# TOKEN BUDGET
+# =============================================
+# The system prompt is kept under PROMPT_TOKEN_BUDGET estimated tokens by trimming, in order:
+# oldest exchanges (down to PROMPT_MIN_EXCHANGES), underwriting rules (last lines first), then
+# the story narrative (tail first; only when it sits in the profile's STORY_SLOT). Mindset,
+# directive, lead state, the merged output contract and the latest message are never cut.
+# build_chat_messages then drops the oldest chat turns so the whole request fits too; in embedded
+# mode those turns repeat history the system prompt already carries.
+# 0 disables the budget.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "4500"))  # CORE_UNIFIED_MINDSET alone is ~2.7k
+PROMPT_MIN_EXCHANGES = 2
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: str) -> int:
+    """~4 characters per token: close enough to budget English prose, not for billing."""
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def estimate_message_tokens(messages: List[Dict[str, str]]) -> int:
+    """Estimate for a whole chat request (content plus a few tokens of per-message overhead)."""
+    return sum(estimate_tokens(m.get("content", "")) + 4 for m in messages)
+
+def fit_to_budget(render: Callable[[List[Dict[str, str]], str, str], str],
+                  exchanges: List[Dict[str, str]], underwriting: str, story: str) -> str:
+    prompt = render(exchanges, underwriting, story)
+    before = estimate_tokens(prompt)
+    if PROMPT_TOKEN_BUDGET <= 0 or before <= PROMPT_TOKEN_BUDGET:
+        return prompt
+
+    trimmed = []
+    while estimate_tokens(prompt) > PROMPT_TOKEN_BUDGET and len(exchanges) > PROMPT_MIN_EXCHANGES:
+        exchanges = exchanges[1:]
+        prompt = render(exchanges, underwriting, story)
+        trimmed.append("exchange")
+
+    uw_lines = underwriting.splitlines()
+    while estimate_tokens(prompt) > PROMPT_TOKEN_BUDGET and uw_lines:
+        uw_lines.pop()
+        underwriting = "\n".join(uw_lines)
+        prompt = render(exchanges, underwriting, story)
+        trimmed.append("underwriting line")
+
+    over = estimate_tokens(prompt) - PROMPT_TOKEN_BUDGET
+    if over > 0 and story:
+        keep = max(0, len(story) - over * CHARS_PER_TOKEN)
+        story = (story[:keep].rsplit(" ", 1)[0] + " …") if keep else "(trimmed for length)"
+        prompt = render(exchanges, underwriting, story)
+        trimmed.append("narrative")
+
+    after = estimate_tokens(prompt)
+    summary = ", ".join(f"{trimmed.count(t)} {t}(s)" for t in dict.fromkeys(trimmed))
+    if after > PROMPT_TOKEN_BUDGET:
+        logger.warning(f"✂ Prompt still over budget after trimming {summary}: ~{after} > {PROMPT_TOKEN_BUDGET} tokens")
+    else:
+        logger.info(f"✂ Prompt trimmed {summary}: ~{before} -> ~{after} tokens")
+    return prompt
\ No newline at end of file
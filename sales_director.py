@@ -6,32 +6,53 @@ from conversation_engine import analyze_logic_flow, LogicSignal, ConversationSta
 from individual_profile import build_comprehensive_profile
 from underwriting import get_underwriting_context
 from insurance_companies import get_company_context, find_company_in_message, normalize_company_name
-from memory import get_recent_messages, get_known_facts, get_narrative, run_narrative_observer
+from typing import Optional
+from memory import load_contact_context, run_narrative_observer
+from prompt import NEW_LEAD_STORY
+from deadline import Deadline
 
 logger = logging.getLogger(__name__)
 
 
-def generate_strategic_directive(contact_id: str, message: str, first_name: str, age: str, address: str) -> dict:
+def generate_strategic_directive(
+    contact_id: str,
+    message: str,
+    first_name: str,
+    age: str,
+    address: str,
+    context: Optional[dict] = None,
+    run_observer: bool = True,
+    deadline: Optional[Deadline] = None
+) -> dict:
     """
     Generate strategic sales directive based on conversation analysis.
+    Pass a load_contact_context() snapshot as `context` to avoid re-querying.
+    Set run_observer=False when the caller already ran the narrative observer;
+    it is also skipped when the job's deadline has too little time left.
     Returns dict with profile, tactical narrative, stage, and context.
     """
-    
+    if context is None:
+        context = load_contact_context(contact_id)
+
     # 1. GATHER INTELLIGENCE (Narrative Observer updates FIRST)
-    run_narrative_observer(contact_id, message)
-    
-    recent_exchanges = get_recent_messages(contact_id, limit=10)
-    story_narrative = get_narrative(contact_id)
-    known_facts = get_known_facts(contact_id)
+    story_narrative = context["story_narrative"]
+    if run_observer and (deadline is None or deadline.allows_optional("observer")):
+        updated_story = run_narrative_observer(contact_id, message, current_story=story_narrative, deadline=deadline)
+        if updated_story and updated_story != NEW_LEAD_STORY:
+            story_narrative = updated_story
+            context["story_narrative"] = updated_story
+
+    recent_exchanges = context["recent_messages"]
+    known_facts = context["known_facts"]
     
     # 2. PROCESS HEMISPHERES
     logic: LogicSignal = analyze_logic_flow(recent_exchanges)
-    profile_str, profile_ctx = build_comprehensive_profile(story_narrative, known_facts, first_name, age, address)
+    profile_str, profile_ctx = build_comprehensive_profile(story_narrative, known_facts, first_name, age, address, story_slot=True)
     
     # Underwriting & Company Context
     underwriting_ctx = ""
     if "health" in message.lower() or "medic" in message.lower() or profile_ctx.get("health_issues"):
-        underwriting_ctx = get_underwriting_context(message)
+        underwriting_ctx = get_underwriting_context(message, deadline=deadline)
     
     company_ctx = ""
     raw_company = find_company_in_message(message)
@@ -75,7 +96,8 @@ def generate_strategic_directive(contact_id: str, message: str, first_name: str,
             "company_context": company_ctx,
             "known_facts": known_facts,
             "story_narrative": story_narrative,
-            "recent_exchanges": recent_exchanges
+            "recent_exchanges": recent_exchanges,
+            "logic": logic
         }
 
     # === FIXED: CLOSED STAGE RETURNS EARLY ===
@@ -97,7 +119,8 @@ def generate_strategic_directive(contact_id: str, message: str, first_name: str,
             "company_context": company_ctx,
             "known_facts": known_facts,
             "story_narrative": story_narrative,
-            "recent_exchanges": recent_exchanges
+            "recent_exchanges": recent_exchanges,
+            "logic": logic
         }
 
     # --- IMMEDIATE CLOSING TRIGGERS ---
@@ -243,5 +266,6 @@ def generate_strategic_directive(contact_id: str, message: str, first_name: str,
         "company_context": company_ctx,
         "known_facts": known_facts,
         "story_narrative": story_narrative,
-        "recent_exchanges": recent_exchanges
+        "recent_exchanges": recent_exchanges,
+        "logic": logic
     }
\ No newline at end of file
@@ -0,0 +1,283 @@
+# sms_outbox.py - Transactional SMS outbox and the sender process that drains it
+#
+# Usage: python sms_outbox.py      (Procfile: sms-sender)
+# With SMS_OUTBOX_ENABLED, process_webhook_task no longer posts to GHL itself: the reply is
+# saved to contact_messages and sms_outbox in one transaction and the LLM worker moves on.
+# The sender claims due rows in batches (FOR UPDATE SKIP LOCKED, so several senders can run),
+# fetches one token per location per batch, caps sends per location per second, and retries
+# failures with the same backoff + dead-letter rules as scheduled retries (ghl_message.py).
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+from db import db_connection
+from ghl_api import get_valid_token
+from ghl_message import deliver_sms, sms_retry_delay, dead_letter_sms, SMS_RETRY_MAX_ATTEMPTS, DUPLICATE_WINDOW_SECONDS
+from metrics import record_metric, metric_summary
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+# Off until an sms-sender process is running — otherwise replies would sit in the outbox
+SMS_OUTBOX_ENABLED = os.getenv("SMS_OUTBOX_ENABLED", "false").lower() == "true"
+SMS_SENDER_BATCH_SIZE = int(os.getenv("SMS_SENDER_BATCH_SIZE", "50"))
+SMS_SENDER_THREADS = int(os.getenv("SMS_SENDER_THREADS", "4"))  # Locations sent to in parallel
+SMS_SENDER_POLL_SECONDS = float(os.getenv("SMS_SENDER_POLL_SECONDS", "1"))
+SMS_LOCATION_RATE_PER_SECOND = int(os.getenv("SMS_LOCATION_RATE_PER_SECOND", "5"))
+SMS_OUTBOX_RETENTION_DAYS = int(os.getenv("SMS_OUTBOX_RETENTION_DAYS", "7"))
+SMS_CLAIM_STALE_SECONDS = 300  # 'sending' rows older than this belong to a crashed sender
+SMS_PRUNE_INTERVAL = 3600
+TOKEN_UNAVAILABLE = 0  # Recorded status when no token could be fetched (same as a network error)
+OUTBOX_WAKE_KEY = "sms:outbox:wake"
+
+
+# === WRITE SIDE (LLM workers) ===
+
+def save_reply_to_outbox(contact_id: str, location_id: str, reply: str) -> Optional[int]:
+    """
+    Save the assistant message and its outbox row in one transaction.
+    Returns the outbox id, 0 if the same text went out in the last 5 min (message saved,
+    nothing queued), or None if the DB write failed — the caller then sends directly.
+    The duplicate check reads contact_messages inside that transaction, so a reply saved
+    earlier in this job (or by a concurrent one) is seen.
+    """
+    text = reply.strip()
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT 1 FROM contact_messages
+                WHERE contact_id = %s AND message_type = 'assistant' AND message_text = %s
+                  AND created_at > CURRENT_TIMESTAMP - make_interval(secs => %s)
+                LIMIT 1
+            """, (contact_id, text, DUPLICATE_WINDOW_SECONDS))
+            duplicate = cur.fetchone() is not None
+            cur.execute("""
+                INSERT INTO contact_messages (contact_id, message_type, message_text, created_at)
+                VALUES (%s, 'assistant', %s, CURRENT_TIMESTAMP)
+                ON CONFLICT DO NOTHING
+            """, (contact_id, text))
+            if duplicate:
+                logger.warning(f"SKIP DUPLICATE SMS: same message sent recently to {contact_id}")
+                return 0
+            cur.execute("""
+                INSERT INTO sms_outbox (contact_id, location_id, message_text)
+                VALUES (%s, %s, %s)
+                RETURNING id
+            """, (contact_id, location_id, text))
+            return cur.fetchone()["id"]
+    except Exception as e:
+        logger.error(f"Outbox write failed for {contact_id}: {e}", exc_info=True)
+        return None
+
+
+def notify_sender(redis_conn):
+    """Wake an idle sender now instead of at its next poll."""
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.lpush(OUTBOX_WAKE_KEY, 1)
+        pipe.ltrim(OUTBOX_WAKE_KEY, 0, 0)
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"Sender wake-up skipped: {e}")
+
+
+# === SEND SIDE (sms-sender process) ===
+
+def claim_batch(limit: int = SMS_SENDER_BATCH_SIZE) -> List[dict]:
+    """
+    Mark up to `limit` due rows as 'sending' and return them oldest first. A row is skipped
+    while an older row for the same contact is still unsent, so a contact's texts keep their order.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE sms_outbox SET status = 'sending', claimed_at = CURRENT_TIMESTAMP
+            WHERE id IN (
+                SELECT o.id FROM sms_outbox o
+                WHERE ((o.status = 'pending' AND o.next_attempt_at <= CURRENT_TIMESTAMP)
+                    OR (o.status = 'sending' AND o.claimed_at < CURRENT_TIMESTAMP - make_interval(secs => %s)))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM sms_outbox earlier
+                      WHERE earlier.contact_id = o.contact_id
+                        AND earlier.id < o.id
+                        AND earlier.status IN ('pending', 'sending')
+                  )
+                ORDER BY o.id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, contact_id, location_id, message_text, attempts,
+                      EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - created_at)) AS age_seconds
+        """, (SMS_CLAIM_STALE_SECONDS, limit))
+        rows = cur.fetchall()
+    return sorted(rows, key=lambda r: r["id"])
+
+
+def _take_rate_slot(redis_conn, location_id: str) -> bool:
+    """Per-location, per-second send counter shared by every sender process."""
+    key = f"sms:rate:{location_id}:{int(time.time())}"
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.incr(key)
+        pipe.expire(key, 2)
+        count = pipe.execute()[0]
+    except Exception as e:
+        logger.warning(f"⚠ SMS rate limit check skipped (Redis): {e}")
+        return True
+    return count <= SMS_LOCATION_RATE_PER_SECOND
+
+
+def _send_location(redis_conn, location_id: str, rows: List[dict]) -> List[Tuple[dict, Optional[int]]]:
+    """
+    Send one location's rows in order. Status None = deferred by the rate limit (not an attempt);
+    TOKEN_UNAVAILABLE = no token this batch, retried like a network error.
+    """
+    started = time.monotonic()
+    access_token = get_valid_token(location_id)
+    results = []
+    throttled = False
+    for row in rows:
+        if not access_token:
+            # get_valid_token also returns None on refresh / DB hiccups — retry with backoff, don't dead-letter
+            results.append((row, TOKEN_UNAVAILABLE))
+            continue
+        # Once throttled, defer the rest too so later texts don't overtake earlier ones
+        throttled = throttled or not _take_rate_slot(redis_conn, location_id)
+        if throttled:
+            results.append((row, None))
+            continue
+        status = deliver_sms(row["contact_id"], row["message_text"], access_token, location_id, row["attempts"] + 1)
+        if 200 <= status < 300:
+            record_metric(redis_conn, "sms_outbox_delivery", float(row["age_seconds"]) + time.monotonic() - started)
+        results.append((row, status))
+    return results
+
+
+def record_results(redis_conn, results: List[Tuple[dict, Optional[int]]]) -> Dict[str, int]:
+    """Write every outcome of a batch back in one transaction. Returns counts per outcome."""
+    counts = {"sent": 0, "retry": 0, "dead": 0, "deferred": 0}
+    dead = []
+    with db_connection() as conn:
+        cur = conn.cursor()
+        for row, status in results:
+            if status is None:
+                counts["deferred"] += 1
+                cur.execute("""
+                    UPDATE sms_outbox SET status = 'pending', next_attempt_at = CURRENT_TIMESTAMP + INTERVAL '1 second'
+                    WHERE id = %s
+                """, (row["id"],))
+            elif 200 <= status < 300:
+                counts["sent"] += 1
+                cur.execute("""
+                    UPDATE sms_outbox SET status = 'sent', attempts = attempts + 1, last_status = %s, sent_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                """, (status, row["id"]))
+            elif status in (401, 403) or row["attempts"] + 1 >= SMS_RETRY_MAX_ATTEMPTS:
+                counts["dead"] += 1
+                dead.append((row, status))
+                cur.execute("""
+                    UPDATE sms_outbox SET status = 'dead', attempts = attempts + 1, last_status = %s
+                    WHERE id = %s
+                """, (status, row["id"]))
+            else:
+                counts["retry"] += 1
+                cur.execute("""
+                    UPDATE sms_outbox SET status = 'pending', attempts = attempts + 1, last_status = %s,
+                           next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                    WHERE id = %s
+                """, (status, sms_retry_delay(row["attempts"] + 1, status), row["id"]))
+    for row, status in dead:
+        dead_letter_sms(redis_conn, row["contact_id"], row["message_text"], row["location_id"], row["attempts"] + 1, status)
+    return counts
+
+
+def prune_sent(days: int = SMS_OUTBOX_RETENTION_DAYS) -> int:
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            DELETE FROM sms_outbox
+            WHERE status = 'sent' AND sent_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+        """, (days,))
+        return cur.rowcount
+
+
+def outbox_stats(redis_conn) -> dict:
+    """Rows per status (sent = last hour) and delivery latency (enqueue -> GHL accepted)."""
+    counts = {"pending": 0, "sending": 0, "sent_last_hour": 0, "dead": 0}
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT status, COUNT(*) AS n FROM sms_outbox
+                WHERE status <> 'sent' OR sent_at > CURRENT_TIMESTAMP - INTERVAL '1 hour'
+                GROUP BY status
+            """)
+            for row in cur.fetchall():
+                counts["sent_last_hour" if row["status"] == "sent" else row["status"]] = row["n"]
+    except Exception as e:
+        logger.warning(f"Outbox stats unavailable: {e}")
+        return {"enabled": SMS_OUTBOX_ENABLED}
+    return {"enabled": SMS_OUTBOX_ENABLED, "rows": counts,
+            "delivery": metric_summary(redis_conn, "sms_outbox_delivery")}
+
+
+def run_sender():
+    redis_conn = redis.from_url(REDIS_URL)
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    logger.info(f"📤 SMS sender up (batch={SMS_SENDER_BATCH_SIZE}, threads={SMS_SENDER_THREADS}, "
+                f"{SMS_LOCATION_RATE_PER_SECOND}/s per location)")
+    last_prune = 0.0
+    with ThreadPoolExecutor(max_workers=SMS_SENDER_THREADS, thread_name_prefix="sms") as pool:
+        while not stop.is_set():
+            if time.time() - last_prune > SMS_PRUNE_INTERVAL:
+                try:
+                    logger.info(f"🧹 Pruned {prune_sent()} sent outbox rows")
+                except Exception as e:
+                    logger.warning(f"Outbox prune failed: {e}")
+                last_prune = time.time()
+
+            try:
+                rows = claim_batch()
+            except Exception as e:
+                logger.error(f"Outbox claim failed: {e}")
+                stop.wait(5)
+                continue
+            if not rows:
+                try:
+                    redis_conn.blpop(OUTBOX_WAKE_KEY, timeout=max(1, int(SMS_SENDER_POLL_SECONDS)))
+                except Exception:
+                    stop.wait(SMS_SENDER_POLL_SECONDS)
+                continue
+
+            by_location: Dict[str, List[dict]] = {}
+            for row in rows:
+                by_location.setdefault(row["location_id"], []).append(row)
+            results = []
+            for location_results in pool.map(lambda item: _send_location(redis_conn, *item), by_location.items()):
+                results.extend(location_results)
+            try:
+                counts = record_results(redis_conn, results)
+            except Exception as e:
+                # Rows stay 'sending' and are reclaimed after SMS_CLAIM_STALE_SECONDS
+                logger.error(f"Outbox result write failed: {e}", exc_info=True)
+                continue
+            logger.info(f"📤 Outbox batch: {counts['sent']} sent, {counts['retry']} retrying, "
+                        f"{counts['dead']} dead, {counts['deferred']} rate-limited "
+                        f"across {len(by_location)} locations")
+    logger.info("📤 SMS sender stopped")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(name)s | %(levelname)s | %(message)s')
+    run_sender()
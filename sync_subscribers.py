@@ -6,6 +6,8 @@ import io
 import logging
 import psycopg2
 from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError
+from db import checkout_db_connection
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -72,8 +74,7 @@ def sync_subscribers() -> bool:
     # ─── Database Connection & Migration ───
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        conn.autocommit = False
+        conn = checkout_db_connection(cursor_factory=None)
         cur = conn.cursor()
 
         # Fix legacy columns (safe, idempotent)
@@ -146,7 +147,7 @@ def sync_subscribers() -> bool:
 
         return True
 
-    except psycopg2.Error as e:
+    except (psycopg2.Error, PoolError) as e:
         logger.critical(f"PostgreSQL sync failed: {e}", exc_info=True)
         if conn:
             conn.rollback()
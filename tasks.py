@@ -1,31 +1,192 @@
 # tasks.py - The Background Engine (2026) - FULLY FIXED VERSION
 # Fixes: Booking execution, idempotency race condition, typos
+import json
 import logging
 import re
 import os
 import time
-from typing import Tuple, Optional
-from openai import OpenAI
-from db import get_subscriber_info_hybrid, get_db_connection, get_message_count, sync_messages_to_db
-from memory import save_message, save_new_facts
+import redis
+from datetime import timedelta
+from rq import Queue, get_current_job
+from rq.timeouts import JobTimeoutException
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional, Callable, Dict, Any, List
+from db import get_subscriber_info_hybrid, get_db_connection, sync_messages_to_db
+from memory import (
+    save_message, save_new_facts, load_contact_context, append_to_context,
+    run_narrative_observer, update_narrative
+)
 from sales_director import generate_strategic_directive
 from age import calculate_age_from_dob
-from prompt import build_system_prompt
+from prompt import (
+    build_system_prompt, build_chat_messages, estimate_message_tokens, PROMPT_LAYOUT, NEW_LEAD_STORY
+)
 from ghl_message import send_sms_via_ghl
 from ghl_calendar import consolidated_calendar_op
 from ghl_api import fetch_targeted_ghl_history, get_valid_token 
+from ingress import (
+    drain_burst, contact_turn_ready, register_contact_turn, bind_contact_turn, finish_contact_turn, CONTACT_TURN_MAX_WAIT,
+    CONTACT_TURN_RETRY_SECONDS, admission_decision, defer_delay, payload_location_id, ADMISSION_MAX_DEFERRALS
+)
+from metrics import record_metric
+from fair_queue import remember_contact_stage, location_queue, contact_stage
+from deadline import Deadline
+from sms_outbox import SMS_OUTBOX_ENABLED, save_reply_to_outbox, notify_sender
+from llm_gateway import chat, LLMUnavailable
+from model_router import route_reply, record_route
 
 logger = logging.getLogger('rq.worker')
 
-# === API CLIENT ===
-XAI_API_KEY = os.getenv("XAI_API_KEY")
+GROK_FALLBACK_REPLY = "Got it — let's circle back when you're free. Anything specific on your mind about coverage?"
 
-client = None
-if XAI_API_KEY:
-    client = OpenAI(
-        api_key=XAI_API_KEY,
-        base_url="https://api.x.ai/v1"
-    )
+
+# === STAGE EXECUTION ===
+# Independent network stages (GHL history, observer Grok call, calendar prefetch)
+# run on a small per-task thread pool. Set CONCURRENT_STAGES=false to run them in order.
+CONCURRENT_STAGES = os.getenv("CONCURRENT_STAGES", "true").lower() == "true"
+STAGE_POOL_SIZE = int(os.getenv("STAGE_POOL_SIZE", "4"))
+
+
+# === NARRATIVE OBSERVER MODE ===
+# inline   — observer Grok call runs before the reply (narrative is fresh for this turn)
+# deferred — reply uses the last persisted narrative + raw message; observer runs
+#            afterwards as its own job on the 'observer' queue (worker-observer)
+NARRATIVE_OBSERVER_MODE = os.getenv("NARRATIVE_OBSERVER_MODE", "inline").lower()
+OBSERVER_QUEUE = "observer"
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+
+def observer_is_deferred() -> bool:
+    return NARRATIVE_OBSERVER_MODE == "deferred" and not reply_is_merged()
+
+
+# === REPLY MODE ===
+# split  — observer and reply are separate Grok calls (see NARRATIVE_OBSERVER_MODE)
+# merged — one Grok call returns JSON {reply, narrative, new_facts}; no observer call at all
+LLM_REPLY_MODE = os.getenv("LLM_REPLY_MODE", "split").lower()
+
+
+def reply_is_merged() -> bool:
+    return LLM_REPLY_MODE == "merged"
+
+
+def parse_merged_response(content: str) -> Tuple[str, str, List[str]]:
+    """
+    Split a merged JSON response into (reply, narrative, new_facts).
+    Truncated / invalid JSON or a missing reply gives an empty reply — raw model output is never an SMS.
+    """
+    raw = (content or "").strip()
+    # Tolerate ```json fences
+    raw = re.sub(r'^```(?:json)?\s*|\s*```$', '', raw)
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        match = re.search(r'\{[\s\S]*\}', raw)
+        try:
+            data = json.loads(match.group()) if match else None
+        except ValueError:
+            data = None
+
+    if not isinstance(data, dict):
+        logger.warning(f"Merged response was not valid JSON ({len(raw)} chars): {raw[:80]!r}")
+        return "", "", []
+
+    reply = str(data.get("reply") or "").strip()
+    if not reply:
+        logger.warning("Merged response had no reply field")
+    narrative = str(data.get("narrative") or "").strip()
+    facts = data.get("new_facts") or []
+    if not isinstance(facts, list):
+        facts = [facts]
+    return reply, narrative, [str(f).strip() for f in facts if f and str(f).strip()]
+
+
+def enqueue_narrative_observer(contact_id: str, message: str, connection=None) -> bool:
+    """
+    Queue a follow-up narrative update for this contact.
+    Falls back to running it inline if Redis is unavailable so the story never stalls.
+    """
+    if not contact_id or not message or not message.strip():
+        return False
+    try:
+        if connection is None:
+            job = get_current_job()
+            connection = job.connection if job else redis.from_url(REDIS_URL)
+        observer_job = Queue(OBSERVER_QUEUE, connection=connection).enqueue(
+            run_narrative_observer,
+            contact_id,
+            message,
+            job_timeout=60,
+            result_ttl=0
+        )
+        logger.info(f"🧠 Observer deferred | contact={contact_id} | job={observer_job.id}")
+        return True
+    except Exception as e:
+        logger.error(f"Observer enqueue failed for {contact_id}, running inline: {e}")
+        run_narrative_observer(contact_id, message)
+        return False
+
+
+def _persist_merged_memory(contact_id: str, context: dict, narrative: str, facts: List[str]) -> None:
+    """Store the narrative/facts half of a merged response (same guards as the observer)."""
+    if narrative and len(narrative) >= 20 and narrative != context.get("story_narrative"):
+        if update_narrative(contact_id, narrative):
+            context["story_narrative"] = narrative
+            logger.info(f"Narrative updated (merged) for {contact_id} ({len(narrative)} chars)")
+    elif narrative and len(narrative) < 20:
+        logger.warning(f"Merged narrative too short: {contact_id}")
+
+    known = {f.lower() for f in context.get("known_facts", [])}
+    fresh = [f for f in facts if f.lower() not in known]
+    if fresh and contact_id != "unknown":
+        save_new_facts(contact_id, fresh)
+        context["known_facts"] = context.get("known_facts", []) + fresh
+
+
+def _timed(timings: Dict[str, float], stage: str, fn: Callable, *args, **kwargs):
+    """Call fn and record its wall time under `stage`."""
+    stage_start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        timings[stage] = time.perf_counter() - stage_start
+
+
+def _run_stages(timings: Dict[str, float], stages: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+    """
+    Run independent zero-arg stages and join on all of them.
+    Concurrent on a bounded thread pool when enabled, sequential otherwise.
+    Per-stage wall time lands in `timings`; the first stage exception is re-raised.
+    On a job timeout, stages not yet started are cancelled and running ones are left to
+    finish on their own call timeouts instead of holding the timed-out job open.
+    """
+    if not stages:
+        return {}
+    if not CONCURRENT_STAGES or len(stages) == 1:
+        return {name: _timed(timings, name, fn) for name, fn in stages.items()}
+
+    pool = ThreadPoolExecutor(max_workers=min(STAGE_POOL_SIZE, len(stages)), thread_name_prefix="stage")
+    timed_out = False
+    try:
+        futures = {name: pool.submit(_timed, timings, name, fn) for name, fn in stages.items()}
+        return {name: future.result() for name, future in futures.items()}
+    except JobTimeoutException:
+        timed_out = True
+        raise
+    finally:
+        pool.shutdown(wait=not timed_out, cancel_futures=timed_out)
+
+
+def _sync_ghl_history(contact_id: str, location_id: str, auth_token: str, db_count: int,
+                      deadline: Optional[Deadline] = None) -> int:
+    """Backfill GHL history when the DB is empty or thin. Returns rows inserted."""
+    if db_count == 0:
+        logger.info(f"🚨 DB empty for {contact_id} — fetching full GHL history")
+        ghl_history = fetch_targeted_ghl_history(contact_id, location_id, auth_token, limit=50, deadline=deadline)
+    else:
+        logger.info(f"🧐 Small DB count ({db_count}) for {contact_id} — syncing recent")
+        ghl_history = fetch_targeted_ghl_history(contact_id, location_id, auth_token, limit=10, deadline=deadline)
+    return sync_messages_to_db(contact_id, location_id, ghl_history)
 
 
 def detect_booking_request(message: str, recent_exchanges: list, stage: str) -> Tuple[bool, Optional[str]]:
@@ -123,10 +284,143 @@ def detect_booking_request(message: str, recent_exchanges: list, stage: str) ->
     return False, None
 
 
-def process_webhook_task(payload: dict):
+def _closing_likely(redis_conn, contact_id: str, message: str, recent_exchanges: list) -> bool:
+    """
+    Before the director runs: was the last turn in closing, or does this message already read
+    as booking intent? Only then is the calendar prefetch worth a GHL round trip.
+    """
+    previous_stage = contact_stage(redis_conn, contact_id) if redis_conn is not None else None
+    if previous_stage == "closing":
+        return True
+    return detect_booking_request(message, recent_exchanges, previous_stage or "")[0]
+
+
+def _record_prompt_size(prompt_tokens: int, grok_seconds: float):
+    """Prompt size per job, plus Grok latency bucketed by size (<1k, 1-2k, 2-3k, ...)."""
+    redis_conn = _job_redis()
+    bucket = f"{prompt_tokens // 1000}-{prompt_tokens // 1000 + 1}k" if prompt_tokens >= 1000 else "<1k"
+    record_metric(redis_conn, "prompt_tokens", prompt_tokens)
+    record_metric(redis_conn, f"grok_latency_by_prompt_size:{bucket}", grok_seconds)
+
+
+def _job_redis():
+    job = get_current_job()
+    return job.connection if job else redis.from_url(REDIS_URL)
+
+
+# === DEFERRED ADMISSION ===
+# /webhook defers outreach while its queue is elevated. The deferred job is only a light
+# re-admission check on the base queue (rq's scheduler serves base queues): when it runs,
+# pressure is checked again and the webhook is either deferred once more (new jittered delay)
+# or queued like a fresh one — location / priority-class sub-queue plus a contact ticket.
+
+def defer_webhook(base_queue: Queue, payload: dict, job_class: str, engaged: bool, deferrals: int = 0):
+    """Schedule a re-admission check for this webhook. Returns (job, delay seconds)."""
+    delay = defer_delay()
+    job = base_queue.enqueue_in(
+        timedelta(seconds=delay),
+        admit_deferred_webhook,
+        payload, job_class, engaged, deferrals + 1,
+        job_timeout=30,
+        result_ttl=0
+    )
+    return job, delay
+
+
+def admit_deferred_webhook(payload: dict, job_class: str, engaged: bool, deferrals: int):
+    """rq job: re-run admission for a deferred webhook, then queue it for real or defer again."""
+    job = get_current_job()
+    redis_conn = job.connection
+    base_queue = Queue(job.origin.partition(":")[0], connection=redis_conn)
+    contact_id = payload.get("contact_id")
+
+    decision, pressure = admission_decision(redis_conn, base_queue.name, job_class, engaged)
+    if decision != "admit" and deferrals < ADMISSION_MAX_DEFERRALS:
+        _, delay = defer_webhook(base_queue, payload, job_class, engaged, deferrals)
+        logger.info(f"⏸ Re-deferred {job_class} for {contact_id} by {delay:.0f}s | {base_queue.name} is {pressure.get('level')}")
+        return {"status": "deferred", "deferrals": deferrals}
+
+    ticket = register_contact_turn(redis_conn, contact_id)
+    target_queue = location_queue(base_queue, payload_location_id(payload), job_class)
+    try:
+        webhook_job = target_queue.enqueue(
+            process_webhook_task,
+            payload,
+            ticket=ticket,
+            job_timeout=120,
+            result_ttl=86400
+        )
+    except Exception:
+        finish_contact_turn(redis_conn, contact_id, ticket)
+        raise
+    bind_contact_turn(redis_conn, contact_id, ticket, webhook_job.id)
+    logger.info(f"📥 Admitted deferred job {webhook_job.id} | Queue: {target_queue.name} | after {deferrals} deferral(s)")
+    return {"status": "queued", "job_id": webhook_job.id, "queue": target_queue.name}
+
+
+def _requeue_for_turn(redis_conn, payload: dict, coalesce: bool, ticket: str, turn_since: float) -> bool:
+    """Schedule this job again shortly instead of holding the worker. False if it must run now."""
+    job = get_current_job()
+    if not job:
+        return False
+    try:
+        # rq's scheduler only serves queues workers listen on, so retries go via the base queue
+        retry = Queue(job.origin.partition(":")[0], connection=redis_conn).enqueue_in(
+            timedelta(seconds=CONTACT_TURN_RETRY_SECONDS),
+            process_webhook_task,
+            payload,
+            coalesce=coalesce,
+            ticket=ticket,
+            turn_since=turn_since,
+            job_timeout=job.timeout,
+            result_ttl=86400
+        )
+        bind_contact_turn(redis_conn, payload.get("contact_id"), ticket, retry.id)  # Before this job finishes
+        return True
+    except Exception as e:
+        logger.warning(f"⚠ Could not re-schedule for contact turn, running now: {e}")
+        return False
+
+
+def process_webhook_task(payload: dict, coalesce: bool = False, ticket: Optional[str] = None,
+                         turn_since: Optional[float] = None):
     """
     Main webhook processor — handles demo + real GHL traffic.
-    Fully resilient, demo-safe, with booking execution.
+    coalesce=True means /webhook opened a burst: answer every buffered message at once.
+    ticket is this job's place in the contact's line; while an older job for the contact is
+    unfinished this job re-schedules itself (turn_since = when it first found the contact busy).
+    """
+    contact_id = payload.get("contact_id") or "unknown"
+    redis_conn = _job_redis() if (coalesce or ticket) else None
+
+    if not contact_turn_ready(redis_conn, contact_id, ticket):
+        turn_since = turn_since or time.time()
+        if time.time() - turn_since < CONTACT_TURN_MAX_WAIT:
+            if _requeue_for_turn(redis_conn, payload, coalesce, ticket, turn_since):
+                return {"status": "requeued", "reason": "earlier job for contact still running"}
+        else:
+            logger.warning(f"⚠ Contact {contact_id} still busy after {CONTACT_TURN_MAX_WAIT:.0f}s — running out of turn")
+
+    deadline = Deadline.for_current_job()
+    waited = time.time() - turn_since if turn_since else 0.0
+    if ticket:
+        record_metric(redis_conn, "contact_lock_wait", waited)
+        if waited > 1:
+            logger.info(f"⏳ Waited {waited:.2f}s for earlier job on contact {contact_id}")
+    try:
+        if coalesce:
+            payload = drain_burst(redis_conn, payload)
+            if payload is None:
+                logger.info("⏭ SKIP: Burst already answered by another job")
+                return {"status": "skipped", "reason": "burst already drained"}
+        return _run_webhook_pipeline(payload, {"contact_wait": waited} if ticket else {}, deadline)
+    finally:
+        finish_contact_turn(redis_conn, contact_id, ticket)
+
+
+def _run_webhook_pipeline(payload: dict, timings: Dict[str, float], deadline: Optional[Deadline] = None):
+    """
+    The reply pipeline itself. Fully resilient, demo-safe, with booking execution.
     """
     start_time = time.time()
     contact_id = payload.get("contact_id") or "unknown"
@@ -136,6 +430,8 @@ def process_webhook_task(payload: dict):
         payload.get("locationId")
     )
     logger.info(f"▶ START TASK | loc={location_id} | contact={contact_id}")
+    job = get_current_job()
+    job_redis = job.connection if job else None  # Stage cache, route counts, sender wake-up; skipped outside a worker
 
     try:
         if not location_id:
@@ -156,12 +452,13 @@ def process_webhook_task(payload: dict):
             }
             auth_token = 'DEMO'
         else:
-            subscriber = get_subscriber_info_hybrid(location_id)
+            subscriber = _timed(timings, "subscriber", get_subscriber_info_hybrid, location_id)
             if not subscriber:
                 logger.error(f"❌ ABORT: No subscriber config for {location_id}")
                 return {"status": "error", "reason": "no subscriber config"}
 
-            auth_token = get_valid_token(location_id)
+            # Reuse the row we just fetched — no second subscriber lookup
+            auth_token = _timed(timings, "token", get_valid_token, location_id, subscriber=subscriber, deadline=deadline)
             if not auth_token:
                 logger.error(f"❌ ABORT: Token refresh failed for {location_id}")
                 return {"status": "error", "reason": "token refresh failed"}
@@ -177,33 +474,13 @@ def process_webhook_task(payload: dict):
         lead_vendor = payload.get("lead_vendor", "")
         age = calculate_age_from_dob(date_of_birth=dob_str) if dob_str else None
 
-        initial_facts = []
-        if first_name: initial_facts.append(f"First name: {first_name}")
-        if age and age != "unknown": initial_facts.append(f"Age: {age}")
-        if address: initial_facts.append(f"Address: {address}")
-        if intent: initial_facts.append(f"Intent: {intent}")
-
-        if initial_facts and contact_id != "unknown":
-            save_new_facts(contact_id, initial_facts)
-
-        # === History Sync (only if DB empty or gap) ===
-        db_count = get_message_count(contact_id)
-        if not is_demo:
-            if db_count == 0:
-                logger.info(f"🚨 DB empty for {contact_id} — fetching full GHL history")
-                ghl_history = fetch_targeted_ghl_history(contact_id, location_id, auth_token, limit=50)
-                sync_messages_to_db(contact_id, location_id, ghl_history)
-            elif db_count <= 3:
-                logger.info(f"🧐 Small DB count ({db_count}) for {contact_id} — syncing recent")
-                ghl_history = fetch_targeted_ghl_history(contact_id, location_id, auth_token, limit=10)
-                sync_messages_to_db(contact_id, location_id, ghl_history)
-
         # === Message Extraction ===
         raw_message = payload.get("message", {})
         message = raw_message.get("body", "").strip() if isinstance(raw_message, dict) else str(raw_message).strip()
         message_id = payload.get("message_id") or payload.get("id")
 
         # === FIXED: Atomic Idempotency Check ===
+        # Runs before any sync / LLM work so duplicate webhooks cost one INSERT
         if not is_demo and message_id:
             conn = get_db_connection()
             if conn:
@@ -227,8 +504,50 @@ def process_webhook_task(payload: dict):
                     cur.close()
                     conn.close()
 
+        initial_facts = []
+        if first_name: initial_facts.append(f"First name: {first_name}")
+        if age and age != "unknown": initial_facts.append(f"Age: {age}")
+        if address: initial_facts.append(f"Address: {address}")
+        if intent: initial_facts.append(f"Intent: {intent}")
+
+        if initial_facts and contact_id != "unknown":
+            save_new_facts(contact_id, initial_facts)
+
+        # === Contact Snapshot (messages, facts, narrative, count — one roundtrip) ===
+        contact_context = _timed(timings, "context", load_contact_context, contact_id)
+        db_count = contact_context["message_count"]
+
+        # === Independent I/O Stages (overlapped when CONCURRENT_STAGES is on) ===
+        # History sync (GHL), narrative observer (Grok) and calendar prefetch (GHL)
+        # don't depend on each other — join before prompt construction.
+        # Optional stages are dropped when the job's budget can no longer cover them plus the reply.
+        if deadline is None:
+            deadline = Deadline.for_current_job()
+        stages = {}
+        if not observer_is_deferred() and not reply_is_merged() and deadline.allows_optional("observer"):
+            stages["observer"] = lambda: run_narrative_observer(
+                contact_id, message, current_story=contact_context["story_narrative"], deadline=deadline
+            )
+        if not is_demo and db_count <= 3 and deadline.allows_optional("history_sync"):
+            stages["history_sync"] = lambda: _sync_ghl_history(contact_id, location_id, auth_token, db_count, deadline)
+        if CONCURRENT_STAGES and not is_demo and subscriber.get("calendar_id") and _closing_likely(
+            job_redis, contact_id, message, contact_context["recent_messages"]
+        ) and deadline.allows_optional("calendar_prefetch"):
+            # Speculative: only worth it when it overlaps other work (slots are cached 30 min)
+            stages["calendar_prefetch"] = lambda: consolidated_calendar_op("fetch_slots", subscriber, deadline=deadline)
+
+        stage_results = _run_stages(timings, stages)
+
+        if stage_results.get("history_sync"):
+            contact_context = _timed(timings, "context_reload", load_contact_context, contact_id)
+
+        updated_story = stage_results.get("observer")
+        if updated_story and updated_story != NEW_LEAD_STORY:
+            contact_context["story_narrative"] = updated_story
+
         if message:
             save_message(contact_id, message, "lead")
+            append_to_context(contact_context, "lead", message)
 
         # === Core Conversation Logic ===
         bot_first_name = subscriber.get('bot_first_name', 'Grok')
@@ -242,15 +561,22 @@ def process_webhook_task(payload: dict):
         # Allow empty messages to proceed - conversation_engine will detect
         # no lead messages and set stage to INITIAL_OUTREACH automatically
 
-        director_output = generate_strategic_directive(
+        director_output = _timed(
+            timings, "director", generate_strategic_directive,
             contact_id=contact_id,
             message=message,
             first_name=first_name,
             age=age,
-            address=address
+            address=address,
+            context=contact_context,
+            run_observer=False,  # Already ran in the I/O stage above
+            deadline=deadline
         )
 
         recent_exchanges = director_output["recent_exchanges"]
+        if not is_demo:
+            # /webhook reads this back to queue the contact's next reply in the right priority class
+            remember_contact_stage(job_redis, contact_id, director_output["stage"])
 
         # ============================================================
         # BOOKING DETECTION & EXECUTION
@@ -270,12 +596,14 @@ def process_webhook_task(payload: dict):
                 booking_made = True
             else:
                 # Real booking via GHL API
-                booking_result = consolidated_calendar_op(
+                booking_result = _timed(
+                    timings, "booking", consolidated_calendar_op,
                     operation="book",
                     subscriber_data=subscriber,
                     contact_id=contact_id,
                     first_name=first_name,
-                    selected_time=booking_time_str
+                    selected_time=booking_time_str,
+                    deadline=deadline
                 )
                 
                 if booking_result:
@@ -291,7 +619,9 @@ def process_webhook_task(payload: dict):
                 # FIXED: Typo "Tomrorow" -> "Tomorrow"
                 calendar_slots = "Tomorrow at 2:00 PM, Tomorrow at 4:30 PM, or Friday at 10:00 AM"
             else:
-                calendar_slots = consolidated_calendar_op("fetch_slots", subscriber)
+                calendar_slots = stage_results.get("calendar_prefetch") or _timed(
+                    timings, "calendar", consolidated_calendar_op, "fetch_slots", subscriber, deadline=deadline
+                )
 
         context_nudge = ""
         if message and "covered" in message.lower():
@@ -301,10 +631,9 @@ def process_webhook_task(payload: dict):
         if booking_made:
             context_nudge += "\n⚠️ APPOINTMENT JUST BOOKED SUCCESSFULLY. Confirm the time warmly, thank them, and STOP selling."
         
-        final_nudge = f"{context_nudge}\n{director_output['underwriting_context']}".strip()
-
         # Generate bot reply using Grok
         reply = ""
+        merged = reply_is_merged()
         system_prompt = build_system_prompt(
             bot_first_name=bot_first_name,
             timezone=timezone,
@@ -316,28 +645,57 @@ def process_webhook_task(payload: dict):
             recent_exchanges=recent_exchanges,
             message=message,
             calendar_slots=calendar_slots,
-            context_nudge=final_nudge,
-            lead_vendor=lead_vendor
+            context_nudge=context_nudge.strip(),
+            underwriting_context=director_output["underwriting_context"],
+            lead_vendor=lead_vendor,
+            merged_output=merged
         )
 
-        grok_messages = [{"role": "system", "content": system_prompt}]
-        for msg in recent_exchanges:
-            role = "user" if msg["role"] == "lead" else "assistant"
-            grok_messages.append({"role": role, "content": msg["text"]})
-        if message:
-            grok_messages.append({"role": "user", "content": message})
+        grok_messages = build_chat_messages(system_prompt, recent_exchanges, message)
 
+        prompt_tokens = estimate_message_tokens(grok_messages)
+        route = route_reply(director_output.get("logic"), message, merged=merged, booking_made=booking_made)
+        record_route(job_redis, route)
+        logger.info(f"🧭 ROUTE | contact={contact_id} | {route.name} ({route.model}) | {route.reason}")
+        grok_start = time.perf_counter()
         try:
-            response = client.chat.completions.create(
-                model="grok-4-1-fast-reasoning",
-                messages=grok_messages,
-                temperature=0.85,
-                max_tokens=200,
-            )
-            reply = response.choices[0].message.content.strip()
+            if merged:
+                # Purpose carries the layout and route so TTFT / tokens / latency compare per variant
+                content = chat(
+                    grok_messages, f"reply_merged:{PROMPT_LAYOUT}:{route.name}",
+                    model=route.model,
+                    stream=True,
+                    temperature=0.85,
+                    max_tokens=600,  # reply + ~150-word narrative + facts
+                    timeout=45.0,
+                    deadline=deadline,
+                    response_format={"type": "json_object"},
+                )
+                reply, new_narrative, new_facts = parse_merged_response(content)
+                _persist_merged_memory(contact_id, contact_context, new_narrative, new_facts)
+                if not reply:
+                    logger.warning(f"⚡ Merged reply unusable for {contact_id} — sending fallback reply")
+                    reply = GROK_FALLBACK_REPLY
+            else:
+                reply = chat(
+                    grok_messages, f"reply:{PROMPT_LAYOUT}:{route.name}",
+                    model=route.model,
+                    stream=True,
+                    temperature=0.85,
+                    max_tokens=200,
+                    timeout=45.0,
+                    deadline=deadline,
+                ).strip()
+        except LLMUnavailable as e:
+            logger.warning(f"⚡ Grok skipped ({e}) — sending fallback reply")
+            reply = GROK_FALLBACK_REPLY
         except Exception as e:
             logger.error(f"❌ GROK FAILURE: {e}", exc_info=True)
-            reply = "Got it — let's circle back when you're free. Anything specific on your mind about coverage?"
+            reply = GROK_FALLBACK_REPLY
+        finally:
+            timings["grok"] = time.perf_counter() - grok_start
+            _record_prompt_size(prompt_tokens, timings["grok"])
+            logger.info(f"🧮 PROMPT | contact={contact_id} | ~{prompt_tokens} tokens | grok {timings['grok']:.2f}s ({route.name})")
 
         # Cleanup reply
         reply = re.sub(r'<thinking>[\s\S]*?</thinking>', '', reply)
@@ -355,8 +713,18 @@ def process_webhook_task(payload: dict):
         if reply:
             logger.info(f"📨 SENDING: '{reply[:50]}...'")
 
-            if not is_demo:
-                sent = send_sms_via_ghl(contact_id, reply, auth_token, location_id)
+            if not is_demo and SMS_OUTBOX_ENABLED and _timed(
+                timings, "outbox", save_reply_to_outbox, contact_id, location_id, reply
+            ) is not None:
+                # Message and outbox row committed together; the sms-sender process delivers it
+                notify_sender(job_redis)
+                logger.info("📤 Reply handed to SMS outbox")
+            elif not is_demo:
+                sent = _timed(
+                    timings, "sms", send_sms_via_ghl,
+                    contact_id, reply, auth_token, location_id,
+                    deadline=deadline  # Duplicate check re-reads the DB now, not the job-start snapshot
+                )
                 if sent:
                     save_message(contact_id, reply, "assistant")
                     logger.info("✅ Message sent to GHL")
@@ -367,6 +735,10 @@ def process_webhook_task(payload: dict):
                 save_message(contact_id, reply, "assistant")
                 logger.info("⚠ DEMO MODE: Message saved internally")
 
+        # Reply is out — now let the observer catch the story up off the critical path
+        if observer_is_deferred() and message:
+            _timed(timings, "observer_enqueue", enqueue_narrative_observer, contact_id, message)
+
         return {"status": "success", "reply_sent": bool(reply), "booking_made": booking_made}
 
     except Exception as e:
@@ -374,4 +746,7 @@ def process_webhook_task(payload: dict):
         return {"status": "error", "reason": str(e)}
     finally:
         elapsed = time.time() - start_time
+        if timings:
+            stage_str = " ".join(f"{name}={secs:.2f}s" for name, secs in timings.items())
+            logger.info(f"⏱ STAGES | contact={contact_id} | {stage_str}")
         logger.info(f"⏹ TASK END | contact={contact_id} | took {elapsed:.2f}s")
\ No newline at end of file
@@ -0,0 +1,102 @@
+# test_fair_queue.py - Dequeue order across locations and priority classes
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from rq import Queue
+from rq.utils import utcformat
+
+import fair_queue
+from fair_queue import fair_queue_order, location_queue, mark_started
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def base(monkeypatch):
+    monkeypatch.setattr(fair_queue, "FAIR_SCHEDULING", True)
+    monkeypatch.setattr(fair_queue, "FAIR_LOCATION_MAX_INFLIGHT", 2)
+    monkeypatch.setattr(fair_queue, "PRIORITY_AGING_SECONDS", 60.0)
+    return Queue("production", connection=fakeredis.FakeRedis())
+
+
+def _enqueue(base, location_id, job_class, waited=0.0):
+    job = location_queue(base, location_id, job_class).enqueue("os.getpid")
+    if waited:
+        enqueued_at = datetime.now(timezone.utc) - timedelta(seconds=waited)
+        base.connection.hset(job.key, "enqueued_at", utcformat(enqueued_at))
+    return job
+
+
+def _names(queues):
+    return [q.name for q in queues]
+
+
+def test_no_sub_queues_uses_base(base):
+    assert _names(fair_queue_order(base)) == ["production"]
+
+
+def test_locations_rotate_between_passes(base):
+    _enqueue(base, "locA", "reply")
+    _enqueue(base, "locB", "reply")
+    firsts = {fair_queue_order(base)[0].name for _ in range(3)}
+    assert firsts == {"production:locA:reply", "production:locB:reply", "production"}
+
+
+def test_each_pass_lists_every_waiting_queue_once(base):
+    _enqueue(base, "locA", "reply")
+    _enqueue(base, "locB", "outreach")
+    names = _names(fair_queue_order(base))
+    assert sorted(names) == ["production", "production:locA:reply", "production:locB:outreach"]
+
+
+def test_higher_class_first_within_a_location(base):
+    _enqueue(base, "locA", "outreach")
+    _enqueue(base, "locA", "reply")
+    _enqueue(base, "locA", "closing")
+    names = [n for n in _names(fair_queue_order(base)) if n.startswith("production:locA")]
+    assert names == ["production:locA:closing", "production:locA:reply", "production:locA:outreach"]
+
+
+def test_waiting_outreach_ages_past_fresh_replies(base):
+    _enqueue(base, "locA", "reply")
+    _enqueue(base, "locA", "outreach", waited=150)  # 1 + 150/60 > 2
+    names = [n for n in _names(fair_queue_order(base)) if n.startswith("production:locA")]
+    assert names == ["production:locA:outreach", "production:locA:reply"]
+
+
+def test_location_at_cap_is_skipped(base):
+    _enqueue(base, "locA", "reply")
+    _enqueue(base, "locB", "reply")
+    for job_id in ("running-1", "running-2"):
+        job = type("Job", (), {"id": job_id, "enqueued_at": None})()
+        mark_started(base.connection, job, "production:locA:reply")
+    assert "production:locA:reply" not in _names(fair_queue_order(base))
+    assert "production:locB:reply" in _names(fair_queue_order(base))
+
+
+def _drain(base, location_id, job_class):
+    queue = Queue(f"production:{location_id}:{job_class}", connection=base.connection)
+    for job_id in queue.job_ids:
+        queue.remove(job_id)
+
+
+def test_empty_queues_go_last_for_wake_ups(base, monkeypatch):
+    monkeypatch.setattr(fair_queue, "FAIR_IDLE_WAKE_QUEUES", 1)
+    _enqueue(base, "locA", "reply")
+    _enqueue(base, "locB", "closing")
+    _enqueue(base, "locC", "outreach")
+    _drain(base, "locB", "closing")
+    _drain(base, "locC", "outreach")
+    base.connection.set(fair_queue.PRUNE_LOCK_KEY, 1)  # Keep this pass from pruning them
+    names = _names(fair_queue_order(base))
+    assert names[-1] == "production:locB:closing"  # Highest class first, one wake-up queue
+    assert "production:locC:outreach" not in names
+
+
+def test_empty_sub_queues_are_pruned_and_come_back_on_enqueue(base):
+    _enqueue(base, "locA", "reply")
+    _drain(base, "locA", "reply")
+    fair_queue_order(base)
+    assert fair_queue.location_queue_names(base.connection) == []
+    _enqueue(base, "locA", "reply")
+    assert fair_queue.location_queue_names(base.connection) == ["production:locA:reply"]
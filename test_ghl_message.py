@@ -0,0 +1,39 @@
+# test_ghl_message.py - SMS retry backoff
+import pytest
+
+import ghl_message
+from ghl_message import sms_retry_delay
+
+
+@pytest.fixture(autouse=True)
+def delays(monkeypatch):
+    monkeypatch.setattr(ghl_message, "SMS_RETRY_BASE_DELAY", 5.0)
+    monkeypatch.setattr(ghl_message, "SMS_RETRY_MAX_DELAY", 300.0)
+    monkeypatch.setattr(ghl_message, "SMS_RATE_LIMIT_DELAY", 10)
+
+
+def test_full_jitter_under_exponential_ceiling(monkeypatch):
+    monkeypatch.setattr(ghl_message.random, "uniform", lambda low, high: high)
+    assert [sms_retry_delay(attempt, 500) for attempt in (1, 2, 3, 4)] == [5.0, 10.0, 20.0, 40.0]
+
+
+def test_ceiling_capped_at_max_delay(monkeypatch):
+    monkeypatch.setattr(ghl_message.random, "uniform", lambda low, high: high)
+    assert sms_retry_delay(20, 500) == 300.0
+
+
+def test_jitter_can_retry_almost_at_once(monkeypatch):
+    monkeypatch.setattr(ghl_message.random, "uniform", lambda low, high: low)
+    assert sms_retry_delay(3, 502) == 0
+
+
+def test_rate_limit_waits_at_least_the_floor(monkeypatch):
+    monkeypatch.setattr(ghl_message.random, "uniform", lambda low, high: low)
+    assert sms_retry_delay(1, 429) == 10
+    monkeypatch.setattr(ghl_message.random, "uniform", lambda low, high: high)
+    assert sms_retry_delay(5, 429) == 80.0
+
+
+def test_delays_stay_in_range():
+    for attempt in range(1, 8):
+        assert 0 <= sms_retry_delay(attempt, 500) <= 300.0
@@ -0,0 +1,69 @@
+# test_ingress.py - Admission control at /webhook
+import pytest
+
+import ingress
+from ingress import admission_decision
+
+
+@pytest.fixture(autouse=True)
+def thresholds(monkeypatch):
+    monkeypatch.setattr(ingress, "ADMISSION_CONTROL_ENABLED", True)
+    monkeypatch.setattr(ingress, "ADMISSION_SOFT_DEPTH", 300)
+    monkeypatch.setattr(ingress, "ADMISSION_HARD_DEPTH", 1000)
+    monkeypatch.setattr(ingress, "ADMISSION_SOFT_AGE", 60.0)
+    monkeypatch.setattr(ingress, "ADMISSION_HARD_AGE", 240.0)
+    monkeypatch.setattr(ingress, "_pressure_cache", {})
+
+
+def _pressure(monkeypatch, depth, oldest_age):
+    monkeypatch.setattr(ingress, "queue_pressure", lambda redis_conn, base_name: {"depth": depth, "oldest_age": oldest_age})
+
+
+@pytest.mark.parametrize("job_class,engaged", [("outreach", False), ("reply", False), ("closing", True)])
+def test_normal_admits_everything(monkeypatch, job_class, engaged):
+    _pressure(monkeypatch, 10, 1.0)
+    decision, state = admission_decision(None, "production", job_class, engaged)
+    assert (decision, state["level"]) == ("admit", "normal")
+
+
+def test_elevated_defers_outreach_only(monkeypatch):
+    _pressure(monkeypatch, 300, 0.0)
+    assert admission_decision(None, "production", "outreach", False)[0] == "defer"
+    assert admission_decision(None, "production", "reply", False)[0] == "admit"
+
+
+def test_elevated_by_age(monkeypatch):
+    _pressure(monkeypatch, 5, 61.0)
+    decision, state = admission_decision(None, "production", "outreach", False)
+    assert (decision, state["level"]) == ("defer", "elevated")
+
+
+def test_overloaded_protects_engaged_replies(monkeypatch):
+    _pressure(monkeypatch, 1000, 0.0)
+    assert admission_decision(None, "production", "reply", True)[0] == "admit"
+    assert admission_decision(None, "production", "closing", True)[0] == "admit"
+    assert admission_decision(None, "production", "reply", False)[0] == "reject"
+    assert admission_decision(None, "production", "outreach", True)[0] == "reject"
+
+
+def test_demo_and_disabled_skip_the_check(monkeypatch):
+    _pressure(monkeypatch, 5000, 999.0)
+    assert admission_decision(None, "production", "demo", False) == ("admit", {})
+    monkeypatch.setattr(ingress, "ADMISSION_CONTROL_ENABLED", False)
+    assert admission_decision(None, "production", "outreach", False) == ("admit", {})
+
+
+def test_redis_failure_admits(monkeypatch):
+    def broken(redis_conn, base_name):
+        raise ConnectionError("down")
+    monkeypatch.setattr(ingress, "queue_pressure", broken)
+    decision, state = admission_decision(None, "production", "outreach", False)
+    assert (decision, state["level"], state["depth"]) == ("admit", "normal", None)
+
+
+def test_state_cached_per_queue(monkeypatch):
+    _pressure(monkeypatch, 2000, 0.0)
+    assert admission_decision(None, "production", "outreach", False)[0] == "reject"
+    _pressure(monkeypatch, 0, 0.0)
+    assert admission_decision(None, "production", "outreach", False)[0] == "reject"  # Within ADMISSION_CACHE_SECONDS
+    assert admission_decision(None, "pro", "outreach", False)[0] == "admit"
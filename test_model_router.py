@@ -0,0 +1,68 @@
+# test_model_router.py - Per-reply model choice
+import pytest
+
+import model_router
+from conversation_engine import ConversationStage, LogicSignal
+from model_router import route_reply
+
+
+def _signal(stage, move="statement", pain=0, depth=0, gap=False):
+    return LogicSignal(stage=stage, last_move_type=move, gap_signal=gap, pain_score=pain,
+                       depth_score=depth, voss_no_signal=False)
+
+
+@pytest.fixture(autouse=True)
+def router_on(monkeypatch):
+    monkeypatch.setattr(model_router, "LLM_ROUTER_ENABLED", True)
+
+
+def test_router_off_always_reasons(monkeypatch):
+    monkeypatch.setattr(model_router, "LLM_ROUTER_ENABLED", False)
+    route = route_reply(_signal(ConversationStage.CLOSED), "ok")
+    assert (route.name, route.reason) == ("reasoning", "router_off")
+
+
+def test_merged_call_needs_reasoning():
+    assert route_reply(_signal(ConversationStage.CLOSED), "ok", merged=True).reason == "merged_json"
+
+
+def test_booked_or_closed_is_fast():
+    assert route_reply(None, "see you then", booking_made=True).name == "fast"
+    route = route_reply(_signal(ConversationStage.CLOSED), "thanks!")
+    assert (route.name, route.model) == ("fast", model_router.LLM_FAST_MODEL)
+
+
+def test_no_signal_reasons():
+    assert route_reply(None, "hi").reason == "no_signal"
+
+
+def test_pain_beats_short_closing_turn():
+    route = route_reply(_signal(ConversationStage.CLOSING, pain=2), "yes")
+    assert (route.name, route.reason) == ("reasoning", "pain")
+    assert route_reply(_signal(ConversationStage.CLOSING, gap=True), "yes").reason == "pain"
+
+
+@pytest.mark.parametrize("stage", [ConversationStage.DISCOVERY, ConversationStage.CONSEQUENCE,
+                                   ConversationStage.RESISTANCE])
+def test_reasoning_stages(stage):
+    route = route_reply(_signal(stage), "ok")
+    assert (route.name, route.reason) == ("reasoning", f"stage:{stage.value}")
+
+
+def test_short_shallow_objection_is_fast():
+    route = route_reply(_signal(ConversationStage.OBJECTION_HANDLING, move="rejection", depth=1), "not interested")
+    assert (route.name, route.reason) == ("fast", "short_rejection")
+
+
+def test_deep_or_long_objection_reasons():
+    deep = _signal(ConversationStage.OBJECTION_HANDLING, move="rejection", depth=3)
+    assert route_reply(deep, "no").reason == "stage:objection"
+    shallow = _signal(ConversationStage.OBJECTION_HANDLING, move="rejection", depth=0)
+    assert route_reply(shallow, "x" * (model_router.LLM_FAST_MAX_CHARS + 1)).reason == "stage:objection"
+
+
+def test_short_closing_is_fast_long_closing_reasons():
+    assert route_reply(_signal(ConversationStage.CLOSING), "Tuesday works").reason == "short_closing"
+    long_message = "x" * (model_router.LLM_FAST_MAX_CHARS + 1)
+    route = route_reply(_signal(ConversationStage.CLOSING), long_message)
+    assert (route.name, route.model, route.reason) == ("reasoning", model_router.DEFAULT_MODEL, "long_message")
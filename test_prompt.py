@@ -0,0 +1,92 @@
+# test_prompt.py - Token budget trimming of the system prompt and the chat request
+import prompt
+from prompt import fit_to_budget, build_chat_messages, estimate_tokens, estimate_message_tokens
+
+
+def _render(exchanges, underwriting, story):
+    flow = "\n".join(f"{m['role']}: {m['text']}" for m in exchanges)
+    return f"MINDSET\n{flow}\n{underwriting}\n{story}\nLATEST: yes"
+
+
+def _exchanges(n, size=200):
+    return [{"role": "lead" if i % 2 == 0 else "assistant", "text": f"{i}" * size} for i in range(n)]
+
+
+def test_under_budget_is_untouched(monkeypatch):
+    monkeypatch.setattr(prompt, "PROMPT_TOKEN_BUDGET", 10_000)
+    exchanges = _exchanges(4)
+    assert fit_to_budget(_render, exchanges, "rule", "story") == _render(exchanges, "rule", "story")
+
+
+def test_zero_budget_disables_trimming(monkeypatch):
+    monkeypatch.setattr(prompt, "PROMPT_TOKEN_BUDGET", 0)
+    exchanges = _exchanges(20)
+    assert fit_to_budget(_render, exchanges, "rule", "story") == _render(exchanges, "rule", "story")
+
+
+def test_oldest_exchanges_go_first(monkeypatch):
+    monkeypatch.setattr(prompt, "PROMPT_TOKEN_BUDGET", 200)
+    exchanges = _exchanges(10)
+    result = fit_to_budget(_render, exchanges, "rule", "story")
+    assert estimate_tokens(result) <= 200
+    assert "9" * 200 in result and "0" * 200 not in result
+    assert "rule" in result and "story" in result
+
+
+def test_underwriting_then_story_after_min_exchanges(monkeypatch):
+    monkeypatch.setattr(prompt, "PROMPT_TOKEN_BUDGET", 150)
+    exchanges = _exchanges(6, size=100)
+    underwriting = "\n".join(f"uw rule {i}" for i in range(50))
+    story = "word " * 200
+    result = fit_to_budget(_render, exchanges, underwriting, story)
+    assert all(m["text"] in result for m in exchanges[-prompt.PROMPT_MIN_EXCHANGES:])
+    assert "uw rule 0" not in result
+    assert "…" in result or "(trimmed for length)" in result
+    assert result.endswith("LATEST: yes")
+
+
+def test_still_over_budget_keeps_protected_sections(monkeypatch):
+    monkeypatch.setattr(prompt, "PROMPT_TOKEN_BUDGET", 10)
+    exchanges = _exchanges(3)
+    result = fit_to_budget(_render, exchanges, "rule", "")
+    assert result.startswith("MINDSET") and result.endswith("LATEST: yes")
+    assert len([m for m in exchanges if m["text"] in result]) == prompt.PROMPT_MIN_EXCHANGES
+
+
+def _history(n, size=40):
+    return [{"role": "lead" if i % 2 == 0 else "assistant", "text": f"turn {i} " + "x" * size} for i in range(n)]
+
+
+def test_chat_mode_sends_turns_once(monkeypatch):
+    monkeypatch.setattr(prompt, "PROMPT_HISTORY_MODE", "chat")
+    monkeypatch.setattr(prompt, "PROMPT_TOKEN_BUDGET", 0)
+    history = _history(4) + [{"role": "lead", "text": "latest"}]
+    messages = build_chat_messages("SYSTEM", history, "latest")
+    assert messages[0] == {"role": "system", "content": "SYSTEM"}
+    assert [m["role"] for m in messages[1:]] == ["user", "assistant", "user", "assistant", "user"]
+    assert messages[-1] == {"role": "user", "content": "latest"}  # Not appended twice
+
+
+def test_chat_mode_appends_unsaved_message(monkeypatch):
+    monkeypatch.setattr(prompt, "PROMPT_HISTORY_MODE", "chat")
+    messages = build_chat_messages("SYSTEM", _history(2), "new text")
+    assert messages[-1] == {"role": "user", "content": "new text"}
+    assert len(messages) == 4
+
+
+def test_history_limit(monkeypatch):
+    monkeypatch.setattr(prompt, "PROMPT_HISTORY_MODE", "chat")
+    monkeypatch.setattr(prompt, "PROMPT_TOKEN_BUDGET", 0)
+    messages = build_chat_messages("SYSTEM", _history(10), "", history_limit=3)
+    assert [m["content"].split(" x")[0] for m in messages[1:]] == ["turn 7", "turn 8", "turn 9"]
+
+
+def test_budget_drops_oldest_turns_in_both_modes(monkeypatch):
+    monkeypatch.setattr(prompt, "PROMPT_TOKEN_BUDGET", 60)
+    for mode in ("chat", "embedded"):
+        monkeypatch.setattr(prompt, "PROMPT_HISTORY_MODE", mode)
+        messages = build_chat_messages("SYSTEM", _history(12), "latest")
+        assert estimate_message_tokens(messages) <= 60
+        assert len(messages) > 1 + prompt.PROMPT_MIN_EXCHANGES
+        assert messages[0]["role"] == "system"
+        assert messages[-1] == {"role": "user", "content": "latest"}
@@ -0,0 +1,35 @@
+# test_tasks.py - Merged reply+narrative+facts parsing
+from tasks import parse_merged_response
+
+
+def test_plain_json():
+    content = '{"reply": " Sounds good ", "narrative": "Lead wants a call.", "new_facts": ["Has 2 kids", " "]}'
+    assert parse_merged_response(content) == ("Sounds good", "Lead wants a call.", ["Has 2 kids"])
+
+
+def test_fenced_json():
+    content = '```json\n{"reply": "Hi", "narrative": "", "new_facts": []}\n```'
+    assert parse_merged_response(content) == ("Hi", "", [])
+
+
+def test_json_inside_prose():
+    content = 'Here you go: {"reply": "Hi there", "new_facts": "Smoker"} hope that helps'
+    assert parse_merged_response(content) == ("Hi there", "", ["Smoker"])
+
+
+def test_truncated_json_never_becomes_the_reply():
+    content = '{"reply": "Tuesday works, I will send the link", "narrative": "Lead agreed to'
+    assert parse_merged_response(content) == ("", "", [])
+
+
+def test_missing_reply_is_empty():
+    reply, narrative, facts = parse_merged_response('{"narrative": "Still thinking it over."}')
+    assert reply == ""
+    assert narrative == "Still thinking it over."
+    assert facts == []
+
+
+def test_empty_and_non_object_content():
+    assert parse_merged_response("") == ("", "", [])
+    assert parse_merged_response(None) == ("", "", [])
+    assert parse_merged_response('["reply"]') == ("", "", [])
@@ -0,0 +1,39 @@
+# test_worker.py - Supervisor pool sizing
+import pytest
+
+import worker
+from worker import desired_worker_count
+
+
+@pytest.fixture(autouse=True)
+def bounds(monkeypatch):
+    monkeypatch.setattr(worker, "SUPERVISOR_MIN_WORKERS", 2)
+    monkeypatch.setattr(worker, "SUPERVISOR_MAX_WORKERS", 8)
+    monkeypatch.setattr(worker, "SUPERVISOR_TARGET_DRAIN_SECONDS", 30.0)
+    monkeypatch.setattr(worker, "SUPERVISOR_MAX_OLDEST_AGE", 60.0)
+
+
+def test_idle_queue_keeps_the_minimum():
+    assert desired_worker_count(depth=0, oldest_age=0, p95_seconds=10, current=5) == 2
+
+
+def test_backlog_sized_to_drain_in_target_window():
+    # 30s / 10s p95 = 3 jobs per worker in the window -> 15 jobs need 5 workers
+    assert desired_worker_count(depth=15, oldest_age=0, p95_seconds=10, current=2) == 5
+    assert desired_worker_count(depth=16, oldest_age=0, p95_seconds=10, current=2) == 6
+
+
+def test_concurrency_multiplies_per_worker_throughput():
+    assert desired_worker_count(depth=15, oldest_age=0, p95_seconds=10, current=2, concurrency=3) == 2
+
+
+def test_old_backlog_adds_one_more():
+    assert desired_worker_count(depth=3, oldest_age=90, p95_seconds=10, current=4) == 5
+
+
+def test_clamped_to_maximum():
+    assert desired_worker_count(depth=1000, oldest_age=500, p95_seconds=10, current=8) == 8
+
+
+def test_tiny_p95_does_not_divide_by_zero():
+    assert desired_worker_count(depth=10, oldest_age=0, p95_seconds=0, current=2) == 2
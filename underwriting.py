@@ -7,6 +7,8 @@ import re
 from datetime import datetime, timedelta
 from typing import List, Optional
 
+from deadline import Deadline, call_timeout
+
 logger = logging.getLogger(__name__)
 
 # === LIVE GOOGLE SHEET SOURCES ===
@@ -23,10 +25,11 @@ _CACHE: dict = {
     "ttl_seconds": 3600  # 60 minutes
 }
 
-def refresh_underwriting_data(force: bool = False) -> List[str]:
+def refresh_underwriting_data(force: bool = False, deadline: Optional[Deadline] = None) -> List[str]:
     """
     Fetches and merges all underwriting sheets into one searchable list.
     Returns cached data if fresh, or refreshes if expired/forced.
+    With a job deadline, the refresh is an optional stage: low budget keeps the stale cache.
     """
     now = datetime.now()
     if not force and _CACHE["rules"] and _CACHE["last_updated"]:
@@ -35,10 +38,13 @@ def refresh_underwriting_data(force: bool = False) -> List[str]:
             logger.debug(f"Underwriting cache hit (age: {age:.0f}s)")
             return _CACHE["rules"]
 
+    if deadline and not deadline.allows_optional("underwriting refresh"):
+        return _CACHE["rules"]
+
     combined_rules = []
     try:
         for source_name, url in SHEET_URLS.items():
-            resp = requests.get(url, timeout=12)
+            resp = requests.get(url, timeout=call_timeout(deadline, 12))
             resp.raise_for_status()
 
             reader = csv.reader(io.StringIO(resp.text))
@@ -67,7 +73,7 @@ def refresh_underwriting_data(force: bool = False) -> List[str]:
 
     return combined_rules
 
-def get_underwriting_context(message: str) -> str:
+def get_underwriting_context(message: str, deadline: Optional[Deadline] = None) -> str:
     """
     Detects health-related keywords in message and returns relevant carrier rules.
     Returns empty string if no health context detected.
@@ -100,7 +106,7 @@ def get_underwriting_context(message: str) -> str:
         return ""
 
     # Refresh data only if needed
-    rules = refresh_underwriting_data()
+    rules = refresh_underwriting_data(deadline=deadline)
 
     relevant_rules = []
     for rule in rules:
@@ -4,46 +4,425 @@ import redis
 import logging
 import uuid
 import sys
-from rq import Worker, Queue
+import time
+import signal
+import threading
+import multiprocessing
+from rq import Worker, SimpleWorker, Queue
+from rq.scheduler import RQScheduler
+from rq.timeouts import TimerDeathPenalty
+from fair_queue import (
+    FAIR_SCHEDULING, FAIR_REFRESH_SECONDS, FAIR_BASE_QUEUES, PRODUCTION_QUEUE,
+    fair_queue_order, mark_started, mark_finished, queue_pressure, location_queue_names, clean_location_registries
+)
+from ingress import admission_state
+from metrics import record_metric, metric_summary
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(name)s | %(levelname)s | %(message)s')
 logger = logging.getLogger(__name__)
 
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
 
-def main():
-    # 1. Determine which queue to listen to from command line args
-    # Usage: python worker.py production OR python worker.py demo
-    if len(sys.argv) > 1:
-        listen_queues = sys.argv[1:]
-    else:
-        listen_queues = ['production'] # Default to production if unspecified
+# === WORKER MODE ===
+# fork (default) — stock rq.Worker, forks a fresh child per job
+# warm           — jobs run inside one long-lived process (rq.SimpleWorker), so the DB pool,
+#                  HTTP keep-alive sessions and in-memory caches survive between jobs.
+#                  The process is recycled after WORKER_MAX_JOBS jobs, once RSS passes
+#                  WORKER_MAX_RSS_MB, or right after a job hits its timeout.
+WORKER_MODE = os.getenv('WORKER_MODE', 'fork').lower()
+WORKER_MAX_JOBS = int(os.getenv('WORKER_MAX_JOBS', '500'))
+WORKER_MAX_RSS_MB = int(os.getenv('WORKER_MAX_RSS_MB', '512'))
+WORKER_DEFAULT_JOB_TIMEOUT = int(os.getenv('WORKER_DEFAULT_JOB_TIMEOUT', '180'))
+
+# === CONCURRENCY ===
+# Jobs are I/O-bound (Grok, GHL, Postgres), so one warm process can run several at once.
+# WORKER_CONCURRENCY > 1 runs that many worker threads in one process (implies warm mode).
+# Size DB_POOL_MAX_SIZE to roughly WORKER_CONCURRENCY x STAGE_POOL_SIZE.
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', '1'))
+WORKER_THREAD_TTL = 20  # Short dequeue timeout (ttl - 15s) so stop requests land quickly
+
+# === ADAPTIVE SHARING ===
+# WORKER_ADAPTIVE=true (or --adaptive): production and demo workers also listen on each
+# other's queue. Home queue first, so idle capacity is lent out — but once production has
+# WORKER_ADAPTIVE_YIELD_DEPTH jobs waiting, demo workers put production first too.
+WORKER_ADAPTIVE = os.getenv('WORKER_ADAPTIVE', 'false').lower() == 'true'
+WORKER_ADAPTIVE_YIELD_DEPTH = int(os.getenv('WORKER_ADAPTIVE_YIELD_DEPTH', '5'))
+LEND_TARGETS = {PRODUCTION_QUEUE: ['demo'], 'demo': [PRODUCTION_QUEUE]}
+
+# === SUPERVISOR (python worker.py supervise production) ===
+# Keeps between MIN and MAX local worker processes. Target size = enough workers to drain the
+# backlog within SUPERVISOR_TARGET_DRAIN_SECONDS at the recorded p95 job duration; an oldest job
+# older than SUPERVISOR_MAX_OLDEST_AGE adds one more. Scale-ups and scale-downs each have a
+# cool-down, and retiring workers get SIGTERM so they finish their current job first.
+# MIN defaults to the four fixed production workers the supervisor replaced, so idle capacity never drops.
+SUPERVISOR_MIN_WORKERS = int(os.getenv('SUPERVISOR_MIN_WORKERS', '4'))
+SUPERVISOR_MAX_WORKERS = int(os.getenv('SUPERVISOR_MAX_WORKERS', '8'))
+SUPERVISOR_TARGET_DRAIN_SECONDS = float(os.getenv('SUPERVISOR_TARGET_DRAIN_SECONDS', '30'))
+SUPERVISOR_MAX_OLDEST_AGE = float(os.getenv('SUPERVISOR_MAX_OLDEST_AGE', '60'))
+SUPERVISOR_INTERVAL = float(os.getenv('SUPERVISOR_INTERVAL', '5'))
+SUPERVISOR_SCALE_UP_COOLDOWN = float(os.getenv('SUPERVISOR_SCALE_UP_COOLDOWN', '15'))
+SUPERVISOR_SCALE_DOWN_COOLDOWN = float(os.getenv('SUPERVISOR_SCALE_DOWN_COOLDOWN', '120'))
+SUPERVISOR_DEFAULT_JOB_SECONDS = 10.0  # Until enough durations have been recorded
+
+
+def _current_rss_mb() -> float:
+    """Resident memory of this process in MB."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Peak, KB on Linux
 
-    logger.info(f"Starting Worker for queues: {listen_queues}")
 
+def _job_error(job) -> str:
+    try:
+        result = job.latest_result()
+        if result and result.exc_string:
+            return result.exc_string
+    except Exception:
+        pass
+    return getattr(job, 'exc_info', None) or ''
+
+
+class FairDequeueMixin:
+    """Production workers pull from per-location, per-class sub-queues in fair order (see fair_queue.py)."""
+
+    home_queue_names = None  # Adaptive mode: the queues this worker is for; anything else is borrowed
+
+    def _fair_bases(self) -> list:
+        if not FAIR_SCHEDULING:
+            return []
+        return [q for q in self.queues if q.name in FAIR_BASE_QUEUES]
+
+    def _plan_queues(self, bases: list) -> list:
+        order = list(self.queues)
+        if self.home_queue_names and PRODUCTION_QUEUE not in self.home_queue_names:
+            depth = admission_state(self.connection, PRODUCTION_QUEUE).get("depth") or 0
+            if depth >= WORKER_ADAPTIVE_YIELD_DEPTH:
+                order.sort(key=lambda q: q.name != PRODUCTION_QUEUE)  # Production wins under contention
+        return [sub for q in order for sub in (fair_queue_order(q) if q in bases else [q])]
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        bases = self._fair_bases()
+        if (not bases and not self.home_queue_names) or timeout is None:
+            result = super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+            if result is not None:
+                mark_started(self.connection, result[0], result[1].name)  # Queue-wait metrics only
+            return result
+
+        idle_since = time.time()
+        while not self._stop_requested:
+            # Re-plan every FAIR_REFRESH_SECONDS so new locations, freed-up caps and backlogs are noticed
+            try:
+                self._ordered_queues = self._plan_queues(bases)
+            except redis.RedisError as e:
+                logger.warning(f"Fair ordering unavailable, using plain queues: {e}")
+                self._ordered_queues = list(self.queues)
+            result = super().dequeue_job_and_maintain_ttl(FAIR_REFRESH_SECONDS, max_idle_time=FAIR_REFRESH_SECONDS)
+            if result is not None:
+                mark_started(self.connection, result[0], result[1].name)
+                if self.home_queue_names and result[1].name.partition(':')[0] not in self.home_queue_names:
+                    logger.info(f"🤝 {self.name} lending capacity to {result[1].name}")
+                return result
+            if max_idle_time is not None and time.time() - idle_since >= max_idle_time:
+                return None
+        return None
+
+    def clean_registries(self):
+        super().clean_registries()
+        # Stock rq only cleans self.queues; sub-queues have their own started/failed registries
+        for base in self._fair_bases():
+            try:
+                for name in location_queue_names(self.connection, base.name):
+                    queue = Queue(name, connection=self.connection)
+                    if queue.acquire_maintenance_lock():
+                        try:
+                            clean_location_registries(queue, self._exc_handlers)
+                        finally:
+                            queue.release_maintenance_lock()
+            except redis.RedisError as e:
+                logger.warning(f"Sub-queue registry cleanup failed for {base.name}: {e}")
+
+    def execute_job(self, job, queue):
+        started = time.monotonic()
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            if self._fair_bases():
+                mark_finished(self.connection, job, queue.name)
+            # The supervisor sizes pools off this p95
+            record_metric(self.connection, f"job_duration:{queue.name.partition(':')[0]}", time.monotonic() - started)
+
+
+class ForkWorker(FairDequeueMixin, Worker):
+    """Stock forking worker plus fair per-location dequeueing."""
+
+
+class WarmWorker(FairDequeueMixin, SimpleWorker):
+    """In-process worker that asks to be recycled once it stops looking healthy."""
+
+    recycle_event = None  # Shared by sibling threads in concurrent mode
+
+    def request_recycle(self, reason: str):
+        logger.warning(f"♻ {reason} — recycling {self.name}")
+        self._stop_requested = True
+        if self.recycle_event is not None:
+            self.recycle_event.set()
+
+    def execute_job(self, job, queue):
+        result = super().execute_job(job, queue)
+
+        rss_mb = _current_rss_mb()
+        if rss_mb > WORKER_MAX_RSS_MB:
+            self.request_recycle(f"RSS {rss_mb:.0f}MB > {WORKER_MAX_RSS_MB}MB")
+        elif job.is_failed and 'JobTimeoutException' in _job_error(job):
+            # A timeout can interrupt a job mid-write; don't let the next job inherit that state
+            self.request_recycle(f"Job {job.id} timed out")
+        return result
+
+
+class ThreadedWarmWorker(WarmWorker):
+    """
+    WarmWorker that runs on a thread: timer-based job timeouts, no signal handlers.
+    A timeout is raised in the job's own thread only; stage-pool work it started keeps
+    running until its own call timeout (see tasks._run_stages), and the process recycles.
+    """
+
+    death_penalty_class = TimerDeathPenalty
+
+    def _install_signal_handlers(self):
+        pass  # Only the main thread may own signals — see run_concurrent()
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        # Stock rq only leaves an idle wait via a signal; threads poll the stop flag between short waits
+        if timeout is None:
+            return super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+        while not self._stop_requested:
+            result = super().dequeue_job_and_maintain_ttl(timeout, max_idle_time=timeout)
+            if result is not None:
+                return result
+        return None
+
+
+def run_concurrent(queues: list, redis_conn: redis.Redis, base_name: str, concurrency: int, home_queue_names=None):
+    """
+    Run `concurrency` warm workers as threads of this process.
+    They recycle together: if one stops (max jobs, RSS, timeout) the rest finish
+    their current job and stop too, and run_warm() starts a fresh process.
+    """
+    recycle = threading.Event()
+    jobs_per_thread = max(1, WORKER_MAX_JOBS // concurrency)
+
+    workers = []
+    for i in range(concurrency):
+        w = ThreadedWarmWorker(queues, connection=redis_conn, name=f"{base_name}-t{i}", worker_ttl=WORKER_THREAD_TTL)
+        w.recycle_event = recycle
+        w.home_queue_names = home_queue_names
+        workers.append(w)
+
+    def _stop_all(signum=None, frame=None):
+        for w in workers:
+            w._stop_requested = True
+
+    signal.signal(signal.SIGTERM, _stop_all)
+    signal.signal(signal.SIGINT, _stop_all)
+
+    # The rq scheduler runs in a forked process. Fork it here, before any worker thread exists,
+    # so the child can't inherit a lock another thread held mid-call. It takes its scheduler
+    # locks itself and retries them every 10 minutes if another worker holds them.
+    scheduler = RQScheduler(queues, connection=redis_conn)
+    scheduler.start()
+
+    threads = [
+        threading.Thread(target=w.work, kwargs={"max_jobs": jobs_per_thread}, name=w.name)
+        for w in workers
+    ]
+    for t in threads:
+        t.start()
+    logger.info(f"Running {concurrency} concurrent workers in pid {os.getpid()}")
+
+    try:
+        while any(t.is_alive() for t in threads):
+            if recycle.is_set() or not all(t.is_alive() for t in threads):
+                _stop_all()
+            time.sleep(1)
+    finally:
+        try:
+            os.kill(scheduler._process.pid, signal.SIGTERM)  # It releases its locks on the way out
+        except OSError:
+            pass
+        scheduler._process.join(timeout=10)
+
+
+def connect_redis() -> redis.Redis:
     try:
         redis_conn = redis.from_url(REDIS_URL)
         redis_conn.ping()
+        return redis_conn
     except redis.ConnectionError as e:
         logger.critical(f"Redis connection failed: {e}", exc_info=True)
         raise SystemExit(1)
 
+
+def run_worker(listen_queues: list, warm: bool = False, concurrency: int = 1, adaptive: bool = False):
+    redis_conn = connect_redis()
+
     unique_id = uuid.uuid4().hex[:8]
     # Name the worker based on the queue it serves for easier debugging
     worker_name = f"worker-{listen_queues[0]}-{unique_id}"
-    
-    queues = [Queue(name, connection=redis_conn) for name in listen_queues]
+
+    home_queue_names = None
+    if adaptive:
+        home_queue_names = set(listen_queues)
+        borrowed = [n for home in listen_queues for n in LEND_TARGETS.get(home, []) if n not in home_queue_names]
+        listen_queues = list(listen_queues) + list(dict.fromkeys(borrowed))
+
+    queues = [
+        Queue(name, connection=redis_conn, default_timeout=WORKER_DEFAULT_JOB_TIMEOUT)
+        for name in listen_queues
+    ]
 
     try:
-        worker = Worker(
-            queues,
-            connection=redis_conn,
-            name=worker_name
-        )
-        worker.work()
+        if warm:
+            import tasks  # noqa: F401 — load API clients & caches once, before the first job
+            if concurrency > 1:
+                run_concurrent(queues, redis_conn, worker_name, concurrency, home_queue_names)
+            else:
+                worker = WarmWorker(queues, connection=redis_conn, name=worker_name)
+                worker.home_queue_names = home_queue_names
+                worker.work(max_jobs=WORKER_MAX_JOBS, with_scheduler=True)
+        else:
+            worker = ForkWorker(queues, connection=redis_conn, name=worker_name)
+            worker.home_queue_names = home_queue_names
+            # Scheduler moves enqueue_in() jobs (burst coalescing) onto the queue; rq elects one per queue
+            worker.work(with_scheduler=True)
     except Exception as e:
         logger.critical(f"Worker startup failed: {e}", exc_info=True)
         raise SystemExit(1)
 
+
+def run_warm(listen_queues: list, concurrency: int = 1, adaptive: bool = False):
+    """Keep one warm worker process alive, replacing it every time it recycles."""
+    state = {"stopping": False, "child": None}
+
+    def _shutdown(signum, frame):
+        state["stopping"] = True
+        child = state["child"]
+        if child and child.is_alive():
+            os.kill(child.pid, signal.SIGTERM)  # rq warm shutdown: finish current job
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    while not state["stopping"]:
+        child = multiprocessing.Process(target=run_worker, args=(listen_queues, True, concurrency, adaptive))
+        state["child"] = child
+        child.start()
+        child.join()
+        if state["stopping"]:
+            break
+        logger.info(f"Warm worker exited (code={child.exitcode}) — starting a fresh one")
+        time.sleep(1)  # Don't spin if startup keeps failing
+
+
+def desired_worker_count(depth: int, oldest_age: float, p95_seconds: float, current: int, concurrency: int = 1) -> int:
+    """Pool size needed to drain `depth` jobs within the target window, clamped to the bounds."""
+    per_worker = SUPERVISOR_TARGET_DRAIN_SECONDS / max(p95_seconds, 0.1) * concurrency
+    desired = -(-depth // max(1, int(per_worker)))  # ceil
+    if oldest_age > SUPERVISOR_MAX_OLDEST_AGE:
+        desired = max(desired, current + 1)
+    return max(SUPERVISOR_MIN_WORKERS, min(SUPERVISOR_MAX_WORKERS, desired))
+
+
+def run_supervisor(listen_queues: list, warm: bool = False, concurrency: int = 1, adaptive: bool = False):
+    """Spawn and retire local run_worker() processes for `listen_queues` from live queue pressure."""
+    redis_conn = connect_redis()
+    bases = list(dict.fromkeys(name.partition(':')[0] for name in listen_queues))
+    state = {"stopping": False}
+    active, retiring = [], []
+    last_up = last_down = 0.0
+
+    def _shutdown(signum, frame):
+        state["stopping"] = True
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    def _spawn():
+        child = multiprocessing.Process(target=run_worker, args=(listen_queues, warm, concurrency, adaptive))
+        child.start()
+        active.append(child)
+
+    while not state["stopping"]:
+        # Reap exited workers (recycled warm workers, crashes, finished retirements)
+        active[:] = [c for c in active if c.is_alive()]
+        retiring[:] = [c for c in retiring if c.is_alive()]
+
+        try:
+            pressure = [queue_pressure(redis_conn, base) for base in bases]
+            depth = sum(p["depth"] for p in pressure)
+            oldest_age = max(p["oldest_age"] for p in pressure)
+            durations = [metric_summary(redis_conn, f"job_duration:{base}") for base in bases]
+            p95 = max((d["p95"] for d in durations if d), default=SUPERVISOR_DEFAULT_JOB_SECONDS)
+            desired = desired_worker_count(depth, oldest_age, p95, len(active), concurrency)
+        except redis.RedisError as e:
+            logger.warning(f"Supervisor can't read queue pressure, holding at {len(active)}: {e}")
+            desired = max(SUPERVISOR_MIN_WORKERS, len(active))
+            depth, oldest_age, p95 = None, None, None
+
+        now = time.monotonic()
+        if len(active) < SUPERVISOR_MIN_WORKERS:
+            while len(active) < SUPERVISOR_MIN_WORKERS:
+                _spawn()
+        elif desired > len(active) and now - last_up >= SUPERVISOR_SCALE_UP_COOLDOWN:
+            logger.info(f"📈 Scaling {bases} {len(active)} → {desired} | depth={depth} oldest={oldest_age}s p95={p95}s")
+            while len(active) < desired:
+                _spawn()
+            last_up = now
+        elif desired < len(active) and now - max(last_up, last_down) >= SUPERVISOR_SCALE_DOWN_COOLDOWN:
+            child = active.pop()  # Newest first; one at a time
+            logger.info(f"📉 Retiring worker pid={child.pid} | {len(active) + 1} → {len(active)} | depth={depth}")
+            os.kill(child.pid, signal.SIGTERM)  # rq warm shutdown: finish current job
+            retiring.append(child)
+            last_down = now
+
+        time.sleep(SUPERVISOR_INTERVAL)
+
+    logger.info(f"Supervisor stopping — waiting for {len(active) + len(retiring)} workers to finish")
+    for child in active:
+        if child.is_alive():
+            os.kill(child.pid, signal.SIGTERM)
+    for child in active + retiring:
+        child.join()
+
+
+def main():
+    # 1. Determine which queue to listen to from command line args
+    # Usage: python worker.py production OR python worker.py demo   (also: pro, observer)
+    #        python worker.py --warm production   (or WORKER_MODE=warm)
+    #        python worker.py --concurrency=8 production   (or WORKER_CONCURRENCY=8)
+    #        python worker.py --adaptive demo   (or WORKER_ADAPTIVE=true) — lends idle capacity across demo/production
+    #        python worker.py supervise production   — autoscaled pool (SUPERVISOR_* settings)
+    args = sys.argv[1:]
+    concurrency = WORKER_CONCURRENCY
+    for a in args:
+        if a.startswith('--concurrency='):
+            concurrency = max(1, int(a.split('=', 1)[1]))
+    warm = '--warm' in args or WORKER_MODE == 'warm' or concurrency > 1
+    adaptive = '--adaptive' in args or WORKER_ADAPTIVE
+    supervise = 'supervise' in args
+    listen_queues = [a for a in args if not a.startswith('--') and a != 'supervise'] or ['production']  # Default to production if unspecified
+
+    logger.info(f"Starting {'warm' if warm else 'forking'} Worker for queues: {listen_queues} (concurrency={concurrency}, adaptive={adaptive})")
+
+    if supervise:
+        run_supervisor(listen_queues, warm, concurrency, adaptive)
+    elif warm:
+        run_warm(listen_queues, concurrency, adaptive)
+    else:
+        run_worker(listen_queues, adaptive=adaptive)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file